@@ -14,9 +14,11 @@
 # MWA_PROJECT=G0080
 # LOG=${GPMLOG}/gpm_automatic_processing_$(date +'%Y-%m-%dT%T').log
 #
-# for obsid in [obsid1] [obsid2] ...; do
-#    singularity exec $GPMCONTAINER $GPMBASE/gpm_track.py import_obs --obs_id ${obsid} 2>&1 | tee -a $LOG
-# done
+# singularity exec $GPMCONTAINER $GPMBASE/gpm_track.py import_obs_list --obs_id [obsid1] [obsid2] ... 2>&1 | tee -a $LOG
+#
+# or, with the ObsIDs listed in a file (one per line):
+#
+# singularity exec $GPMCONTAINER $GPMBASE/gpm_track.py import_obs_list --obs_file [obsid_file] 2>&1 | tee -a $LOG
 #
 #################
 # Initial setup #
@@ -82,11 +84,8 @@ else
 
   echo "Found ${NUM_NEW_OBS} new observations (from $(echo "${NEW_OBS}" | head -1) to $(echo "${NEW_OBS}" | tail -1))"
   echo "Importing them into the database:"
-  for obsid in ${NEW_OBS}
-  do
-    echo -n "  - "
-    ${gpmdb} import_obs --obs_id $obsid 2>&1
-  done
+  # All the new observations are imported by a single process, in one transaction
+  echo "${NEW_OBS}" | ${gpmdb} import_obs_list --obs_file - 2>&1
 fi
 
 echo
@@ -58,69 +58,83 @@ else
     obs_ids="$(echo ${obs_ids} | tr ' ' ',')"
 fi
 
-for task in "${tasks[@]}"; do
+# Create the jobs of all tasks at once. The response contains the rendered sbatch
+# script and task script of every task, and which job each depends on.
+prefix=run_GPM_$(date +'%s')
+response="${prefix}.json"
+tasks_csv="$(echo ${tasks[@]} | tr ' ' ',')"
+curl -f -s -S -G -X GET \
+  -H "Authorization: Token ${GPMDBTOKEN}" \
+  -H "Accept: application/json" \
+  --data-urlencode "pipeline=${pipeline}" \
+  --data-urlencode "tasks=${tasks_csv}" \
+  --data-urlencode "hpc=${GPMHPC}" \
+  --data-urlencode "hpc_user=${whoami}" \
+  --data-urlencode "obs_ids=${obs_ids}" \
+  --data-urlencode "debug_mode=${debug}" \
+  -o "${response}" \
+  "${GPMURL}/processing/api/create_pipeline_jobs"
+
+if [ $? -eq 22 ]; then
+  echo "Could not create jobs via ${GPMURL}/processing/api/create_pipeline_jobs using:"
+  echo "\tpipeline=${pipeline}"
+  echo "\ttasks=${tasks_csv}"
+  echo "\thpc=${GPMHPC}"
+  echo "\thpc_user=${whoami}"
+  echo "\tobs_ids=${obs_ids}"
+  echo "\tdebug_mode=${debug}"
+  echo "\tGPMDBTOKEN=\${GPMDBTOKEN}"
+  exit 1
+fi
+
+# Write out the sbatch script (and the batch script that it will call) of each task,
+# and list them in order as "task sbatch_script depends_on"
+jobs_list=$(python3 - "${response}" "${prefix}" << 'END_PYTHON'
+import sys, json, os
+response, prefix = sys.argv[1:3]
+with open(response) as f:
+    jobs = json.load(f)["jobs"]
+for i, job in enumerate(jobs):
+    sbatch_script = f"{prefix}_{i}_{job['task']}.sbatch"
+    with open(sbatch_script, "w") as f:
+        f.write(job["sbatch"])
+    script = sbatch_script[:-len(".sbatch")] + ".sh"
+    with open(script, "w") as f:
+        f.write(job["script"])
+    os.chmod(script, 0o755)
+    depends_on = "-" if job["depends_on"] is None else job["depends_on"]
+    print(job["task"], sbatch_script, depends_on)
+END_PYTHON
+)
+
+if [[ $? -ne 0 ]]; then
+  echo "Could not parse the response ${response}"
+  exit 1
+fi
 
-  # Set dependency
+declare -a job_ids
+
+while read -r task sbatch_script depends_on; do
+
+  # Set dependency, either on the job of an earlier task, or for the first, the one supplied with -d
+  if [[ ${depends_on} != "-" ]]; then
+    dep=${job_ids[${depends_on}]}
+  fi
   if [[ ! -z ${dep} ]]; then
     depend="--dependency=aftercorr:${dep}"
   else
     depend=
   fi
 
-  # Create an sbatch script
-  sbatch_script=run_GPM_$(date +'%s').sbatch
-  curl -s -S -G -X GET \
-    -H "Authorization: Token ${GPMDBTOKEN}" \
-    -H "Accept: application/json" \
-    --data-urlencode "pipeline=${pipeline}" \
-    --data-urlencode "task=${task}" \
-    --data-urlencode "hpc=${GPMHPC}" \
-    --data-urlencode "hpc_user=${whoami}" \
-    --data-urlencode "obs_ids=${obs_ids}" \
-    --data-urlencode "sbatch=1" \
-    --data-urlencode "debug_mode=${debug}" \
-    -o "${sbatch_script}" \
-    "${GPMURL}/processing/api/create_processing_job"
-
-  if [ $? -eq 22 ]; then
-    echo "Could not retrieve sbatch script from ${GPMURL}/processing/api/create_processing_job using:"
-    echo "\tpipeline=${pipeline}"
-    echo "\ttask=${task}"
-    echo "\thpc=${GPMHPC}"
-    echo "\thpc_user=${whoami}"
-    echo "\tobs_ids=${obs_ids}"
-    echo "\tsbatch=1"
-    echo "\tdebug_mode=${debug}"
-    echo "\tGPMDBTOKEN=\${GPMDBTOKEN}"
-    exit 1
-  fi
-
-  # Create a batch script that the sbatch script will call
-  script=${sbatch_script%.sbatch}.sh
-  curl -f -s -S -G -X GET \
-    -H "Authorization: Token ${GPMDBTOKEN}" \
-    -H "Accept: application/json" \
-    --data-urlencode "task=${task}" \
-    -o "${script}" \
-    "${GPMURL}/processing/api/get_template"
-
-  if [ $? -eq 22 ]; then
-    echo "Could not retrieve template from ${GPMURL}/processing/api/get_template using:"
-    echo "\ttask=${task}"
-    echo "\tGPMDBTOKEN=\${GPMDBTOKEN}"
-    exit 1
-  fi
-
-  chmod +x "${script}"
-
   # Construct the line for submitting the sbatch script to the queue
   sub="sbatch ${depend} --export=SCRIPT_PATH=$(realpath "${sbatch_script}") ${sbatch_script}"
 
-  # If user requested "test" mode, then only display this line and exit
+  # If user requested "test" mode, then only display this line
   if [[ ! -z ${tst} ]]
   then
     echo "Submit ${task} job via:"
     echo "  ${sub}"
+    job_ids+=("[${task} job id]")
   else
     # Submit job!
     job_id=($(${sub}))
@@ -133,8 +147,8 @@ for task in "${tasks[@]}"; do
     job_id=${job_id[3]}
     echo "Submitted ${sbatch_script} as ${job_id}"
 
-    # Set this JobID as dependency of next task
-    dep="$job_id"
+    # Record this JobID as a possible dependency of later tasks
+    job_ids+=("${job_id}")
   fi
 
-done
+done <<< "${jobs_list}"
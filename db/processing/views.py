@@ -3,6 +3,7 @@ from django.http import HttpResponse, JsonResponse
 from django.utils.http import urlencode
 from django.contrib.auth.decorators import login_required
 from processing.hpc_login import hpc_login_required
+from django.db import transaction
 from django.db.models import Q, F, Case, When, Value, IntegerField
 from django.db.models.functions import RowNumber
 from django.db.models.expressions import Window
@@ -30,6 +31,9 @@ MWA = EarthLocation.of_site('MWA')
 MWA_ctr_freq_MHz = 200.32 # WARNING! This info is not in the database, but it should be!
 # The DM delay calculation will be wrong for observations not taken at this frequency!!!
 
+# Maximum number of rows per INSERT when adding observations to a semester plan
+SEMESTER_PLAN_BATCH_SIZE = 500
+
 def dmdelay(dm, f_MHz):
     return 4.148808e3 * dm / f_MHz**2
 
@@ -746,21 +750,12 @@ def get_antennaflags(request):
     return HttpResponse(obs.antenna_flags_as_str, content_type="text/plain", status=200)
 
 
-@api_view(['GET'])
-@authentication_classes([TokenAuthentication])
-@permission_classes([IsAuthenticated])
-def create_processing_job(request):
+def find_observations(obs_ids_and_epochs):
     '''
-    Creates new Processing and ArrayJob objects, and responds with text/plain of sbatch script
-    Required parameters = obs_ids, pipeline, task, hpc_user, hpc
-    Optional parameters = sbatch(=1), debug_mode(=1)
+    Returns the Observations (ordered by obs_id) that are in the database,
+    given a comma-separated list of obs_ids and/or epochs (e.g. "1234567890,Epoch0032")
     '''
-    # TODO: Make a way to ignore obsids under certin conditions, e.g. status
-
-    if request.GET.get('obs_ids') is None:
-        output_text = f"ERROR: obs_ids is a required parameter\n"
-        return HttpResponse(output_text, content_type="text/plain", status=400)
-    all_obs_ids_and_epochs = set(request.GET.get('obs_ids').split(','))
+    all_obs_ids_and_epochs = set(obs_ids_and_epochs.split(','))
 
     # Keep only obs_ids and epochs that are already in the database
     obs_ids_only = {s for s in list(all_obs_ids_and_epochs) if s.isnumeric()}
@@ -768,45 +763,36 @@ def create_processing_job(request):
     obss = models.Observation.objects.filter(
         Q(obs__in=list(obs_ids_only)) | Q(epoch__epoch__in=list(epochs_only)),
     ).order_by('obs')
-    obs_ids = [str(obs.obs) for obs in obss]
 
-    # Select hpc_user and their settings
-    try:
-        hpc_user = find_hpc_user(request.user, request.GET.get('hpc_user'), request.GET.get('hpc'))
-    except Exception as e:
-        output_text = f"ERROR: {e}\n"
-        return HttpResponse(output_text, content_type="text/plain", status=400)
+    return list(obss)
 
-    if hpc_user.hpc_user_settings is None:
-        output_text = f"ERROR: No settings exist for {hpc_user}\n"
-        return HttpResponse(output_text, content_type="text/plain", status=400)
 
-    hpc_user_settings = hpc_user.hpc_user_settings
+def new_processing(pipeline_step, obss, hpc_user, debug_mode=False):
+    '''
+    Creates (and saves) a new Processing object for the given pipeline step, along with
+    one ArrayJob object per Observation
+    '''
+    if len(obss) == 0:
+        raise Exception("None of the requested observations are in the database")
 
-    # Select the pipeline step
-    try:
-        pipeline_step = find_pipeline_step(
-            request.GET.get('pipeline'),
-            request.GET.get('task')
-        )
-    except Exception as e:
-        output_text = f"ERROR: {e}\n"
-        return HttpResponse(output_text, content_type="text/plain", status=400)
+    if hpc_user.hpc_user_settings is None:
+        raise Exception(f"No settings exist for {hpc_user}")
 
-    pipeline = pipeline_step.pipeline
+    hpc_user_settings = hpc_user.hpc_user_settings
     task = pipeline_step.task
 
     slurm_settings = models.SlurmSettings.objects.filter(pipeline_step=pipeline_step).first()
     if not slurm_settings:
-        output_text = f"ERROR: Could not find SLURM settings for pipeline step {pipeline_step}\n"
-        return HttpResponse(output_text, content_type="text/plain", status=400)
+        raise Exception(f"Could not find SLURM settings for pipeline step {pipeline_step}")
+
+    obs_ids = [str(obs.obs) for obs in obss]
 
     if len(obs_ids) > 1:
-        batch_file = f"{pipeline_step.task.script_name}_{obs_ids[0]}-{obs_ids[-1]}"
+        batch_file = f"{task.script_name}_{obs_ids[0]}-{obs_ids[-1]}"
         stdout = batch_file + ".o%A_%a"
         stderr = batch_file + ".e%A_%a"
     else:
-        batch_file = f"{pipeline_step.task.script_name}_{obs_ids[0]}"
+        batch_file = f"{task.script_name}_{obs_ids[0]}"
         stdout = batch_file + ".o%A"
         stderr = batch_file + ".e%A"
 
@@ -821,18 +807,14 @@ def create_processing_job(request):
         hpc_user=hpc_user,
         pipeline_step=pipeline_step,
         commit=settings.GITVERSION,
-        debug_mode=(request.GET.get('debug_mode') == '1'),
+        debug_mode=debug_mode,
     )
-
-    try:
-        processing.save()
-    except Exception as e:
-        return HttpResponse(f'ERROR: {e}', content_type="text/plain", status=400)
+    processing.save()
 
     end_time = int(Time.now().unix) # Just a dummy value for now, so that epoch overview page picks it up as the "latest" job. Will be updated when job actually starts
 
-    for i, obs in enumerate(obss):
-        array_job = models.ArrayJob(
+    models.ArrayJob.objects.bulk_create([
+        models.ArrayJob(
             processing=processing,
             array_idx=i+1,
             obs=obs,
@@ -840,7 +822,50 @@ def create_processing_job(request):
             cal_obs=obs.cal_obs if task.name == 'apply_cal' else None,
             end_time=end_time,
         )
-        array_job.save()
+        for i, obs in enumerate(obss)
+    ])
+
+    return processing
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def create_processing_job(request):
+    '''
+    Creates new Processing and ArrayJob objects, and responds with text/plain of sbatch script
+    Required parameters = obs_ids, pipeline, task, hpc_user, hpc
+    Optional parameters = sbatch(=1), debug_mode(=1)
+    '''
+    # TODO: Make a way to ignore obsids under certin conditions, e.g. status
+
+    if request.GET.get('obs_ids') is None:
+        output_text = f"ERROR: obs_ids is a required parameter\n"
+        return HttpResponse(output_text, content_type="text/plain", status=400)
+    obss = find_observations(request.GET.get('obs_ids'))
+    obs_ids = [str(obs.obs) for obs in obss]
+
+    # Select hpc_user and their settings
+    try:
+        hpc_user = find_hpc_user(request.user, request.GET.get('hpc_user'), request.GET.get('hpc'))
+    except Exception as e:
+        output_text = f"ERROR: {e}\n"
+        return HttpResponse(output_text, content_type="text/plain", status=400)
+
+    # Select the pipeline step
+    try:
+        pipeline_step = find_pipeline_step(
+            request.GET.get('pipeline'),
+            request.GET.get('task')
+        )
+    except Exception as e:
+        output_text = f"ERROR: {e}\n"
+        return HttpResponse(output_text, content_type="text/plain", status=400)
+
+    try:
+        processing = new_processing(pipeline_step, obss, hpc_user, debug_mode=(request.GET.get('debug_mode') == '1'))
+    except Exception as e:
+        return HttpResponse(f'ERROR: {e}', content_type="text/plain", status=400)
 
     if request.GET.get('sbatch') == '1':
         return HttpResponse(processing.sbatch, content_type="text/plain", status=200)
@@ -848,6 +873,73 @@ def create_processing_job(request):
         return HttpResponse(f"Processing object created (id={processing.id}) for Observations {', '.join(obs_ids)}", content_type="text/plain", status=200)
 
 
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def create_pipeline_jobs(request):
+    '''
+    Creates the Processing and ArrayJob objects of several tasks of a pipeline at once,
+    each to be run after the previous one, and responds with application/json containing
+    the rendered sbatch script and task script of every task, e.g.
+        {"pipeline": "GPM2024_transient", "obs_ids": [...], "jobs": [
+            {"task": "calibrate", "processing_id": 1, "batch_file": "...", "sbatch": "...", "script": "...", "depends_on": null},
+            {"task": "image", "processing_id": 2, "batch_file": "...", "sbatch": "...", "script": "...", "depends_on": 0},
+            ...]}
+    where depends_on is the index (in jobs) of the job that must finish first.
+    Either all the jobs are created, or (on any error) none of them are.
+    Required parameters = obs_ids, pipeline, tasks (comma-separated, in order), hpc_user, hpc
+    Optional parameters = debug_mode(=1)
+    '''
+    if request.GET.get('obs_ids') is None:
+        output_text = f"ERROR: obs_ids is a required parameter\n"
+        return HttpResponse(output_text, content_type="text/plain", status=400)
+
+    if request.GET.get('tasks') is None:
+        output_text = f"ERROR: tasks is a required parameter\n"
+        return HttpResponse(output_text, content_type="text/plain", status=400)
+    task_names = [t for t in request.GET.get('tasks').replace(',', ' ').split() if t]
+
+    # The observations are looked up once, for all tasks
+    obss = find_observations(request.GET.get('obs_ids'))
+
+    try:
+        hpc_user = find_hpc_user(request.user, request.GET.get('hpc_user'), request.GET.get('hpc'))
+        pipeline_steps = [find_pipeline_step(request.GET.get('pipeline'), task_name) for task_name in task_names]
+    except Exception as e:
+        output_text = f"ERROR: {e}\n"
+        return HttpResponse(output_text, content_type="text/plain", status=400)
+
+    debug_mode = (request.GET.get('debug_mode') == '1')
+    scripts = {}
+    jobs = []
+
+    try:
+        with transaction.atomic():
+            for i, pipeline_step in enumerate(pipeline_steps):
+                processing = new_processing(pipeline_step, obss, hpc_user, debug_mode=debug_mode)
+
+                task = pipeline_step.task
+                if task.name not in scripts:
+                    scripts[task.name] = task.script_contents
+
+                jobs.append({
+                    "task": task.name,
+                    "processing_id": processing.id,
+                    "batch_file": f"{processing.batch_file}_{processing.id}",
+                    "sbatch": processing.sbatch,
+                    "script": scripts[task.name],
+                    "depends_on": i - 1 if i > 0 else None,
+                })
+    except Exception as e:
+        return HttpResponse(f"ERROR: {e}\n", content_type="text/plain", status=400)
+
+    return JsonResponse({
+        "pipeline": request.GET.get('pipeline'),
+        "obs_ids": [obs.obs for obs in obss],
+        "jobs": jobs,
+    }, status=200)
+
+
 @api_view(['GET'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
@@ -942,18 +1034,33 @@ def add_observations_to_semester_plan(request):
         elif calibration_option == 'target':
             obss = obss.filter(calibration=False)
 
-        context['added_obs_ids'] = []
-        for obs in obss.all():
-            semester_plan = models.SemesterPlan(
-                obs=obs,
+        # Observations can only appear once per semester (see SemesterPlan's
+        # unique_together), so find the ones that are already there with a
+        # single query, and bulk insert only the rest
+        existing_obs_ids = set(models.SemesterPlan.objects.filter(
+            semester=semester,
+            obs__in=obss,
+        ).values_list('obs', flat=True))
+
+        new_obs_ids = obss.exclude(obs__in=existing_obs_ids).values_list('obs', flat=True)
+        semester_plans = [
+            models.SemesterPlan(
+                obs_id=obs_id,
                 pipeline=pipeline,
                 semester=semester,
             )
-            try:
-                semester_plan.save()
-                context['added_obs_ids'].append(obs.obs)
-            except Exception as e:
-                context['error'] = f'{e}'
+            for obs_id in new_obs_ids
+        ]
+
+        try:
+            models.SemesterPlan.objects.bulk_create(semester_plans, batch_size=SEMESTER_PLAN_BATCH_SIZE)
+            context['added_obs_ids'] = [semester_plan.obs_id for semester_plan in semester_plans]
+        except Exception as e:
+            context['added_obs_ids'] = []
+            context['error'] = f'{e}'
+
+        context['nadded'] = len(context['added_obs_ids'])
+        context['nskipped'] = len(existing_obs_ids)
 
         if request.POST.get('next'):
             return redirect(request.POST.get('next'))
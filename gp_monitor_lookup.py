@@ -2,8 +2,10 @@
 
 import urllib.request
 import json
+import time
 import argparse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable, Dict, Any, Optional
 
 from astropy.time import Time
@@ -19,6 +21,14 @@ BASEURL = "http://ws.mwatelescope.org/"
 OBS_STATUS = gpmt.OBS_STATUS
 # CENTCHAN = (157, )
 
+# Maximum number of concurrent web-service requests made while checking observations
+MAX_WORKERS = 8
+# Number of seconds a web-service response is reused before being requested again
+META_CACHE_TTL = 60
+
+# Responses keyed by request URL, each stored with the time it was retrieved
+_meta_cache: Dict[str, Any] = {}
+
 def getmeta(servicetype: str='metadata', service: str='obs', params: Dict[Any, Any]=None) -> Dict[Any, Any]:
     """Given a JSON web servicetype ('observation' or 'metadata'), a service name (eg 'obs', find, or 'con')
        and a set of parameters as a Python dictionary, return a Python dictionary containing the result.
@@ -38,9 +48,17 @@ def getmeta(servicetype: str='metadata', service: str='obs', params: Dict[Any, A
     else:
         data = ''
 
+    url = BASEURL + servicetype + '/' + service + '?' + data
+
+    # Reuse a recent response for the same request, if there is one
+    cached = _meta_cache.get(url)
+    if cached is not None and time.monotonic() - cached[0] < META_CACHE_TTL:
+        logger.debug(f"Using cached response for {url=}")
+        return cached[1]
+
     # Get the data
     try:
-        result = json.load(urllib.request.urlopen(BASEURL + servicetype + '/' + service + '?' + data))
+        result = json.load(urllib.request.urlopen(url))
     except urllib.error.HTTPError as err:
         logging.error("HTTP error from server: code=%d, response:\n %s" % (err.code, err.read()))
         raise err
@@ -48,6 +66,8 @@ def getmeta(servicetype: str='metadata', service: str='obs', params: Dict[Any, A
         logging.error("URL or network error: %s" % err.reason)
         raise err
 
+    _meta_cache[url] = (time.monotonic(), result)
+
     # Return the result dictionary
     return result
 
@@ -70,26 +90,60 @@ def filter_obs_in_db(rlist: Iterable[int], mode: str='notin', allowed_status: Op
     filter_modes = ('notin', )
 
     if mode == 'notin':
-        present_lambda = lambda obs: not gpmt.check_imported_obs_id(obs)
-        
+        # Get the statuses of all candidate obsids in a single database query
+        statuses = gpmt.check_observation_statuses(rlist)
+
+        if logger.level == logging.DEBUG:
+            for obs, status in statuses.items():
+                logger.debug(f"{status=} {obs=}")
+
         if allowed_status is None:
-            check_lambda = present_lambda
+            keep_statuses = ('notimported', )
         else:
             logger.debug(f"Building obsid list where {allowed_status=}")
-            check_lambda = lambda obs: gpmt.check_observation_status(obs) in (allowed_status, 'notimported')
-            
-            if logger.level == logging.DEBUG:
-                logger.debug("Printing explicit observation status (through many separate calls to database)")
-                for obs in rlist:
-                    logger.debug(f"{gpmt.check_observation_status(obs)=} {obs=}")
-
-        return [obs for obs in rlist if check_lambda(obs)]
+            keep_statuses = (allowed_status, 'notimported')
+
+        return [obs for obs in rlist if statuses[int(obs)] in keep_statuses]
         
     else:
         msg = f"Filter mode not known. Received {mode=}, expected modes in {filter_modes}"
         logger.error(msg)
         raise ValueError(msg)
 
+
+def check_obs_ready(obs_id: int, cal: int, calsrc: str) -> bool:
+    """Check whether a single observation should be processed, i.e. whether it uses
+    the desired calibrator (calibrator scans only) and whether ASVO is ready to hand
+    out its data
+
+    Args:
+        obs_id (int): Obsid to check
+        cal (int): Whether the observation is a calibration scan (1 for True, 0 for False)
+        calsrc (str): Name of the desired calibrator
+
+    Returns:
+        bool: True if the observation should be included in the list of obsids to process
+    """
+    logger.debug(f"Checking {obs_id=}")
+
+    # Select calibrator that matches, default = HerA
+    if cal == 1:
+        oinfo = getmeta(service='obs', params={'obs_id':obs_id})
+        if oinfo['metadata']['calibrators'] != calsrc:
+            logger.debug(f"Checking calibrator {obs_id=} not {calsrc=}")
+            return False
+
+    # Confirm that ASVO is ready to hand out the data
+    oready = getmeta(service='data_ready', params={'obs_id':obs_id})
+
+    if oready["dataready"] is True:
+        logger.debug(f"Data ready {obs_id=} appending")
+        return True
+
+    logger.debug(f"Data for {obs_id=} is not ready")
+    return False
+
+
 def do_lookup(
     start: Time, 
     stop: Time, 
@@ -98,7 +152,8 @@ def do_lookup(
     calsrc: str,
     check_in_db: bool=True,
     allowed_status: Optional[str]=None,
-    cent_chan: Optional[int]=None
+    cent_chan: Optional[int]=None,
+    max_workers: int=MAX_WORKERS
 ) -> Iterable[int]:
     """Obtain a list of obsids to process based on criteria required throughout processing
 
@@ -111,6 +166,7 @@ def do_lookup(
         check_in_db (bool, optional): Confirm that these data have not been processed by the GP monitor database. Defaults to True.
         allowed_stats (str, optional): Allow an obsid already loaded in the database to be returned if its recorded status matches to this value. If None, this argument is ignored. Defaults to None. 
         cent_chan (int, optional): Only return the calibrator scans at the specified central frequecy. If None no specification is required. Defaults to None.
+        max_workers (int, optional): Maximum number of observations checked against the webservice concurrently. Defaults to MAX_WORKERS.
 
     Returns:
         Iterable[int]: set of obsids to process
@@ -137,24 +193,13 @@ def do_lookup(
     )
 
     if olist is not None:
-        for obs in olist:
-            oinfo = getmeta(service='obs', params={'obs_id':obs['mwas.starttime']})
-            obs_id = obs['mwas.starttime']
-            logger.debug(f"Checking {obs_id=}")
-
-            # Select calibrator that matches, default = HerA
-            if cal == 1 and oinfo['metadata']['calibrators'] != calsrc:
-                logger.debug(f"Checking calibrator {obs_id=} not {calsrc=}")
-                continue
-                
-            # Confirm that ASVO is ready to hand out the data
-            oready = getmeta(service='data_ready', params={'obs_id':obs['mwas.starttime']})
-            
-            if oready["dataready"] is True:
-                logger.debug(f"Data ready {obs_id=} appending")
-                rlist.append(obs_id)
-            else:
-                logger.debug(f"Data for {obs_id=} is not ready")
+        obs_ids = [obs['mwas.starttime'] for obs in olist]
+
+        # The web-service checks are independent for each observation, so run them concurrently
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            ready = list(executor.map(lambda obs_id: check_obs_ready(obs_id, cal, calsrc), obs_ids))
+
+        rlist = [obs_id for obs_id, is_ready in zip(obs_ids, ready) if is_ready]
         
     # ignore sources not already processed
     if check_in_db:
@@ -210,6 +255,12 @@ if __name__ == "__main__":
         type=int,
         help=f"Limit search to the specified central channel. "
     )
+    parser.add_argument(
+        '--max-workers',
+        default=MAX_WORKERS,
+        type=int,
+        help=f"Maximum number of observations to check against the webservice concurrently (default = {MAX_WORKERS})"
+    )
     
     args = parser.parse_args()
 
@@ -252,7 +303,8 @@ if __name__ == "__main__":
         args.calsrc,
         check_in_db=not args.skip_db_check,
         allowed_status=args.allowed_status,
-        cent_chan=args.cent_chan
+        cent_chan=args.cent_chan,
+        max_workers=args.max_workers
     )
 
     if rlist is False:
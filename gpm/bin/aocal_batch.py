@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""Ionospheric triage of many calibration solution files in one run.
+
+Each solution file is loaded and reduced to a handful of per-obsid metrics (the
+median, histogram peak and standard deviation of the phase change across the
+observation, and of the phase rms) by a pool of worker processes. The metrics of
+all files are written to a single table. The diagnostic plots of aocal_diff.py
+and aocal_plot.py are optional and only made once all the metrics have been
+written, e.g.
+
+    aocal_batch.py *_solutions_ts*.bin --output ionodiff.csv --plot
+"""
+
+import os
+import logging
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from calplots import aocal
+from gpm.bin.aocal_diff import diff, phi_rms, histogram_stats, histo_diffs, histo_rmss, phase_map
+from gpm.bin.aocal_plot import plot
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+REFANT = 127
+# Columns shared with the per-obsid [obsid]_ionodiff.csv files read by iono_update.py
+COLUMNS = ["obsid", "median", "peak", "std", "rms_median", "rms_peak", "rms_std", "filename"]
+
+
+def iono_metrics(filename, refant=REFANT):
+    """Ionospheric metrics of a single calibration solution file
+
+    Args:
+        filename (str): Path to the solution file, whose name starts with the obsid
+        refant (int, optional): Reference antenna. Defaults to REFANT.
+
+    Returns:
+        dict: The metrics, keyed by the names in COLUMNS
+    """
+    ao = aocal.fromfile(filename)
+    obsid = int(os.path.basename(filename)[0:10])
+
+    diffs = diff(ao, None, refant)
+    median, peak, std = histogram_stats(diffs[~np.isnan(diffs)], bins=60, range=[-180, 180])
+
+    rmss = phi_rms(ao, None, refant)
+    if np.all(np.isnan(rmss)):
+        rms_median, rms_peak, rms_std = np.nan, np.nan, np.nan
+    else:
+        rms_median, rms_peak, rms_std = histogram_stats(rmss[~np.isnan(rmss)], bins=60)
+
+    return {
+        "obsid": obsid,
+        "median": median,
+        "peak": peak,
+        "std": std,
+        "rms_median": rms_median,
+        "rms_peak": rms_peak,
+        "rms_std": rms_std,
+        "filename": filename,
+    }
+
+
+def _iono_metrics(args):
+    filename, refant = args
+    try:
+        return iono_metrics(filename, refant=refant)
+    except Exception as e:
+        logger.error(f"Failed to process {filename}: {e}")
+        return None
+
+
+def batch_metrics(filenames, refant=REFANT, nprocs=1):
+    """Ionospheric metrics of many solution files, computed in parallel
+
+    Args:
+        filenames (list[str]): Paths to the solution files
+        refant (int, optional): Reference antenna. Defaults to REFANT.
+        nprocs (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: One row per solution file that could be processed
+    """
+    with Pool(nprocs) as pool:
+        rows = pool.map(_iono_metrics, [(filename, refant) for filename in filenames])
+
+    return pd.DataFrame([row for row in rows if row is not None], columns=COLUMNS)
+
+
+def write_table(df, output):
+    """Write the metrics to a Parquet file if the output ends in .parquet, otherwise to CSV"""
+    if output.endswith(".parquet"):
+        df.to_parquet(output, index=False)
+    else:
+        df.to_csv(output, index=False)
+
+
+def plot_solutions(filename, refant=REFANT, metafits=None, outdir=None):
+    """Make the aocal_diff.py histograms (and phase map) and the aocal_plot.py figures of one solution file"""
+    ao = aocal.fromfile(filename)
+    obsid = os.path.basename(filename)[0:10]
+
+    cwd = os.getcwd()
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+        os.chdir(outdir)
+    try:
+        diffs = diff(ao, metafits, refant)
+        histo_diffs(diffs[~np.isnan(diffs)], obsid)
+        rmss = phi_rms(ao, metafits, refant)
+        histo_rmss(rmss[~np.isnan(rmss)], obsid)
+        if metafits is not None:
+            phase_map(diffs[:, 0, 15], metafits, False, obsid)
+    finally:
+        os.chdir(cwd)
+
+    plot(ao, os.path.splitext(filename)[0], refant, amp_max=2, outdir=outdir, metafits=metafits)
+
+
+def _plot_solutions(args):
+    filename, refant, metafits, outdir = args
+    try:
+        plot_solutions(filename, refant=refant, metafits=metafits, outdir=outdir)
+    except Exception as e:
+        logger.error(f"Failed to plot {filename}: {e}")
+
+
+def find_metafits(filename):
+    """The [obsid].metafits file next to a solution file, if there is one"""
+    obsid = os.path.basename(filename)[0:10]
+    metafits = os.path.join(os.path.dirname(filename), f"{obsid}.metafits")
+    return metafits if os.path.exists(metafits) else None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Difference time-based calibration solutions of many observations to determine ionospheric variation")
+    parser.add_argument("solutions", nargs="+", help="Calibration solution (.bin) files, whose names start with the obsid")
+    parser.add_argument("--refant", default=REFANT, type=int, help=f"Reference antenna (default = {REFANT})")
+    parser.add_argument("--output", default="ionodiff.csv", help="Output table, written as Parquet if it ends in .parquet, otherwise CSV (default = ionodiff.csv)")
+    parser.add_argument("--nprocs", default=1, type=int, help="Number of worker processes (default = 1)")
+    parser.add_argument("--plot", action="store_true", default=False, help="Also make the aocal_diff.py and aocal_plot.py figures, after the table is written")
+    parser.add_argument("--outdir", default=None, help="Output directory of the figures (default = the current directory for histograms, same as the solutions otherwise)")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Enable debug logging")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    missing = [f for f in args.solutions if not os.path.exists(f)]
+    if len(missing) > 0:
+        parser.error(f"Solution files not found: {missing}")
+
+    df = batch_metrics(args.solutions, refant=args.refant, nprocs=args.nprocs)
+    write_table(df, args.output)
+    logger.info(f"Wrote metrics of {len(df)} of {len(args.solutions)} solution files to {args.output}")
+
+    if args.plot:
+        with Pool(args.nprocs) as pool:
+            pool.map(
+                _plot_solutions,
+                [(f, args.refant, find_metafits(f), args.outdir) for f in df["filename"]],
+            )
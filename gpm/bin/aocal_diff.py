@@ -27,54 +27,49 @@ def get_tile_info(metafits):
     East = tiles["East"]
     return Names, North, East
 
+def valid_intervals(ao, refant):
+    """First and last intervals in which the reference antenna is not entirely flagged"""
+    non_nan_intervals = np.flatnonzero(~np.all(np.isnan(ao[:, refant, :, 0]), axis=1))
+    return non_nan_intervals.min(), non_nan_intervals.max()
+
 def diff(ao, metafits, refant):
-    diffs = []
-    non_nan_intervals = np.where([not np.isnan(ao[i, refant, :, 0]).all() for i in range(ao.n_int)])[0]
-    t_start = non_nan_intervals.min()
-    t_end = non_nan_intervals.max()
-    
+    """Phase change (degrees) between the first and last valid intervals, for all
+    antennas and the XX and YY pols at once. Shape is (n_ant, 2, n_chan)."""
+    t_start, t_end = valid_intervals(ao, refant)
+
     # Divide through by refant
+    ao = np.asarray(ao)
     ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-    ant_iter = np.arange(ao.n_ant)
-    for a, antenna in enumerate(ant_iter):
-        temp = []
-        # Only XX and YY
-        for pol in 0, 3:
-            # Difference the complex gains, then convert to angles
-           temp.append(np.angle(ao[t_end, antenna, :, pol] / ao[t_start, antenna, :, pol], deg=True))
-        diffs.append(temp)
-    return diffs
+    # Only XX and YY
+    # Difference the complex gains, then convert to angles
+    diffs = np.angle(ao[t_end][:, :, [0, 3]] / ao[t_start][:, :, [0, 3]], deg=True)
+    return diffs.transpose(0, 2, 1)
 
 def phi_rms(ao, metafits, refant):
-    phi_rmss = []
-    non_nan_intervals = np.where([not np.isnan(ao[i, refant, :, 0]).all() for i in range(ao.n_int)])[0]
-    t_start = non_nan_intervals.min()
-    t_end = non_nan_intervals.max()
+    """RMS over time of the phase (degrees) of every antenna, for the XX and YY
+    pols at once. Shape is (n_ant*2, n_chan), ordered antenna-major."""
+    t_start, t_end = valid_intervals(ao, refant)
     # Calculate middle interval
-    t_mid = int((t_end - t_start)/2.0)
-    print(t_mid)
+    t_mid = t_start + (t_end - t_start)//2
 
     # Divide through by refant
     # (Probably unnecessary)
+    ao = np.asarray(ao)
     ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-    ant_iter = np.arange(ao.n_ant)
-    for a, antenna in enumerate(ant_iter):
-        temp = []
-        # Only XX and YY
-        for pol in 0, 3:
-            # Difference the complex gains
-            # Divide all gains by t_mid value so central phase is zero (solves wrapping problem)
-           temp_gains = ao[:, antenna, :, pol] / ao[t_mid, antenna, :, pol]
-            
-            # then convert to angles
-           temp_angles = np.angle(ao[:, antenna, :, pol], deg=True)
-            
-            # Then find RMS -- over time axis only
-           phi_rmss.append(np.std(temp_angles, axis=0))
-        #    print(np.std(ao[:, antenna, :, pol], axis=0))
-           print(temp_angles.shape)
-           print(np.std(temp_angles, axis=0).shape)
-    return phi_rmss
+    # Only XX and YY
+    # Divide all gains by t_mid value so central phase is zero (solves wrapping problem)
+    gains = ao[t_start:t_end+1, ..., [0, 3]] / ao[t_mid][np.newaxis, ..., [0, 3]]
+    # then convert to angles
+    angles = np.angle(gains, deg=True)
+    # Then find RMS -- over time axis only
+    rmss = np.std(angles, axis=0)
+    return rmss.transpose(0, 2, 1).reshape(-1, ao.shape[2])
+
+def histogram_stats(values, bins=60, range=None):
+    """Median, histogram peak and standard deviation of a set of values, as shown by histo_diffs() and histo_rmss()"""
+    n, edges = np.histogram(values, bins=bins, range=range)
+    peak = edges[np.where(n == n.max())][0]
+    return np.median(values), peak, np.std(values)
 
 def histo_diffs(diffs, obsid):
     fig = plt.figure()
@@ -92,6 +87,7 @@ def histo_diffs(diffs, obsid):
     ax.add_artist(at)
     outname = obsid+"_histogram.png"
     fig.savefig(outname)
+    plt.close(fig)
 
     return np.median(diffs), peak, np.std(diffs)
 
@@ -112,6 +108,7 @@ def histo_rmss(rmss, obsid):
     ax.add_artist(at)
     outname = obsid+"_rms_histogram.png"
     fig.savefig(outname)
+    plt.close(fig)
 
     return np.median(rmss), peak, np.std(rmss)
 
@@ -132,6 +129,7 @@ def phase_map(diffs, metafits, names, obsid):
     cb.set_label('Phase change / degrees')
     outname = obsid+"_phasemap.png"
     fig.savefig(outname)
+    plt.close(fig)
     
 def phase_wrt_East(diffs, metafits, names, obsid):
     fig = plt.figure(figsize = (10,8))
@@ -111,9 +111,9 @@ def plot(ao, plot_filename, refant=None, n_cols=16, plot_title="", amp_max=None,
     # Order by receiver/slot if metafits is requested
     if metafits is not None:
         rec_slot_dict = get_receiver_slot_order(metafits)
-        ant_iter = iter_rec_slot(rec_slot_dict)
+        ant_iter = list(iter_rec_slot(rec_slot_dict))
     else:
-        ant_iter = range(ao.n_ant)
+        ant_iter = [(a, a) for a in range(ao.n_ant)]
 
     for timestep in range(ao.n_int):
 
@@ -183,6 +183,8 @@ def plot(ao, plot_filename, refant=None, n_cols=16, plot_title="", amp_max=None,
         phsfig.tight_layout()
         ampfig.savefig("%s%s_amp.%s" % (plot_filename, int_str, format))
         phsfig.savefig("%s%s_phase.%s" % (plot_filename, int_str, format))
+        pylab.close(ampfig)
+        pylab.close(phsfig)
 
 
 if __name__ == '__main__':
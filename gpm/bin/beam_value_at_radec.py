@@ -11,7 +11,8 @@ from astropy.wcs import WCS
 from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
 import astropy.units as u
-from mwa_pb_lookup.lookup_beam import beam_lookup_1d
+from gpm.utils.metadata_cache import read_header
+from gpm.utils.beam_cache import beam_response
 
 import argparse
 
@@ -26,14 +27,14 @@ MWA = EarthLocation.from_geodetic(
 )
 
 ######################################################################
-def beam_value(ra, dec, t, delays, freq, gridnum, pol="i", interp=True):
+def beam_value(ra, dec, t, delays, freq, gridnum, pol="i", interp=True, cache_dir=None):
 
     logger.info("Computing for %s" % t)
 
     pol = pol.upper()
     assert pol in ("I", "XX", "YY"), "pol %s is not supported" % pol
 
-    rX, rY = beam_lookup_1d(ra, dec, gridnum, t, freq)
+    rX, rY = beam_response(ra, dec, gridnum, t, freq, cache_dir=cache_dir)
 
     if pol == "I":
         return np.squeeze(rX), np.squeeze(rY)
@@ -49,29 +50,29 @@ def beam_value(ra, dec, t, delays, freq, gridnum, pol="i", interp=True):
 def parse_metafits(metafits):
     # Delays needed for beam model calculation
     try:
-        f = fits.open(metafits)
+        header = read_header(metafits)
     except Exception as e:
         logger.error("Unable to open FITS file %s: %s" % (metafits, e))
         sys.exit(1)
-    if not "DELAYS" in f[0].header.keys():
-        logger.error("Cannot find DELAYS in %s" % options.metafits)
+    if not "DELAYS" in header.keys():
+        logger.error("Cannot find DELAYS in %s" % metafits)
         sys.exit(1)
-    delstr = f[0].header["DELAYS"].split(",")
+    delstr = header["DELAYS"].split(",")
     delays = [int(e) for e in delstr]
 
     # get the date so we can convert to Az,El
-    start_time = f[0].header["DATE-OBS"]
-    duration = f[0].header["EXPOSURE"] * u.s
+    start_time = header["DATE-OBS"]
+    duration = header["EXPOSURE"] * u.s
     t = Time(start_time, format="isot", scale="utc") + 0.5 * duration
 
     # Just use the central frequency
     # Nice update would be to use the whole bandwidth and calculate spectral term
     try:
-        freq = f[0].header["FREQCENT"] * 1000000.0
+        freq = header["FREQCENT"] * 1000000.0
     except:
         logger.error("Unable to read frequency FREQCENT from %s" % metafits)
 
-    gridnum = f[0].header["GRIDNUM"]
+    gridnum = header["GRIDNUM"]
 
     return t, delays, freq, gridnum
 
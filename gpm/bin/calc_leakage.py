@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import os
 from astropy.io import fits
 import numpy as np
+from multiprocessing import Pool
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import argparse
@@ -9,6 +11,8 @@ import matplotlib as mpl
 import sys
 from scipy.optimize import curve_fit
 
+from gpm.utils.local_stats import sigma_clipped_std
+
 # explicit function to normalize array
 def normalize_2d(array):
     mx = np.nanmax(array)
@@ -16,16 +20,67 @@ def normalize_2d(array):
     array = (array - mn) / (mx - mn)
     return array
 
-def scstd(data):
-    std = np.nanstd(data)
-    std = np.nanstd(data[np.abs(data) < 3*std])
-    return std
+scstd = sigma_clipped_std
+
+# Number of rows of an image read or written at a time by the fast path
+BLOCK_ROWS = 512
 
 # https://www.geeksforgeeks.org/3d-curve-fitting-with-python/
 def func(xy, a, b, c, d, e, f):
     x, y = xy
     return a + b*x + c*y + d*x**2 + e*y**2 + f*x*y
 
+def plot_fit(x, y, z, popt, xmax, ymax, obsid, subchan=None):
+    """Diagnostic plots of the fractional leakage of the fitted pixels (x: row, y: column), the fit, and the residuals"""
+    minleakage = np.nanmin(z)
+    maxleakage = np.nanmax(z)
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
+    sc = ax.scatter(y, x, c=z, vmin=minleakage, vmax=maxleakage)
+    ax.set_xlabel("RA / pix")
+    ax.set_ylabel("Dec / pix")
+    cb = plt.colorbar(sc)
+    cb.set_label("Fractional leakage / %")
+    ax.set_xlim(0, xmax)
+    ax.set_ylim(0, ymax)
+    ax.set_aspect('equal')
+    outpng = f"{obsid}_{subchan}_leakage_map.png" if subchan is not None else f"{obsid}_leakage_map.png"
+    fig.savefig(outpng, bbox_inches="tight")
+
+    # Create 3D plot of the data points and the fitted curve
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection='3d')
+    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
+    ax.scatter(y, x, z, c=z, vmin=minleakage, vmax=maxleakage)
+    x_range = np.linspace(0, xmax, 50)
+    y_range = np.linspace(0, ymax, 50)
+    Y, X = np.meshgrid(x_range, y_range)
+    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
+    Z = func((Y, X), *popt)
+    ax.plot_surface(Y, X, Z, color='red', alpha=0.5)
+    ax.set_xlabel('RA')
+    ax.set_ylabel('Dec')
+    ax.set_zlabel('Fractional leakage / %')
+    outpng = f"{obsid}_{subchan}_leakage_fit.png" if subchan is not None else f"{obsid}_leakage_fit.png"
+    fig.savefig(outpng, bbox_inches="tight")
+
+    # Make a residuals plot
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
+    sc = ax.scatter(y, x, c = (z - func((y,x), *popt)), vmin=minleakage, vmax=maxleakage)
+    ax.set_xlabel("RA / pix")
+    ax.set_ylabel("Dec / pix")
+    cb = plt.colorbar(sc)
+    cb.set_label("Residual leakage / %")
+    ax.set_xlim(0, xmax)
+    ax.set_ylim(0, ymax)
+    ax.set_aspect('equal')
+    outpng = f"{obsid}_{subchan}_corrected_map.png" if subchan is not None else f"{obsid}_corrected_map.png"
+    fig.savefig(outpng, bbox_inches="tight")
+
 def do_fit(Inonpb, Ipb, Vpb, nsigma=20, makePlots=False, subchan=None):
 
     img_I_npb = np.squeeze(fits.open(Inonpb)[0].data)
@@ -54,55 +109,7 @@ def do_fit(Inonpb, Ipb, Vpb, nsigma=20, makePlots=False, subchan=None):
     popt, pcov = curve_fit(func, (y, x), z)
 
     if makePlots is True:
-        obsid = Inonpb[0:10]
-        minleakage = np.nanmin(z)
-        maxleakage = np.nanmax(z)
-
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
-        sc = ax.scatter(y, x, c=z, vmin=minleakage, vmax=maxleakage)
-        ax.set_xlabel("RA / pix")
-        ax.set_ylabel("Dec / pix")
-        cb = plt.colorbar(sc)
-        cb.set_label("Fractional leakage / %")
-        ax.set_xlim(0, xmax)
-        ax.set_ylim(0, ymax)
-        ax.set_aspect('equal')
-        outpng = f"{obsid}_{subchan}_leakage_map.png" if subchan is not None else f"{obsid}_leakage_map.png"
-        fig.savefig(outpng, bbox_inches="tight")
-
-    # Create 3D plot of the data points and the fitted curve
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
-    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
-        ax.scatter(y, x, z, c=z, vmin=minleakage, vmax=maxleakage)
-        x_range = np.linspace(0, xmax, 50)
-        y_range = np.linspace(0, ymax, 50)
-        Y, X = np.meshgrid(x_range, y_range)
-    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
-        Z = func((Y, X), *popt)
-        ax.plot_surface(Y, X, Z, color='red', alpha=0.5)
-        ax.set_xlabel('RA')
-        ax.set_ylabel('Dec')
-        ax.set_zlabel('Fractional leakage / %')
-        outpng = f"{obsid}_{subchan}_leakage_fit.png" if subchan is not None else f"{obsid}_leakage_fit.png"
-        fig.savefig(outpng, bbox_inches="tight")
-
-    # Make a residuals plot
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-    # Reversing these to match that the RA and Dec axes are reversed in the FITS image
-        sc = ax.scatter(y, x, c = (z - func((y,x), *popt)), vmin=minleakage, vmax=maxleakage)
-        ax.set_xlabel("RA / pix")
-        ax.set_ylabel("Dec / pix")
-        cb = plt.colorbar(sc)
-        cb.set_label("Residual leakage / %")
-        ax.set_xlim(0, xmax)
-        ax.set_ylim(0, ymax)
-        ax.set_aspect('equal')
-        outpng = f"{obsid}_{subchan}_corrected_map.png" if subchan is not None else f"{obsid}_corrected_map.png"
-        fig.savefig(outpng, bbox_inches="tight")
+        plot_fit(x, y, z, popt, xmax, ymax, Inonpb[0:10], subchan=subchan)
 
     return(popt)
 
@@ -118,6 +125,137 @@ def correct_image(Vpb, Ipb, popt, Vout):
     hdu_V[0].data = np.array(hdu_V[0].data - (1.e-2*Z * np.squeeze(fits.open(Ipb)[0].data)), dtype='float32')
     hdu_V.writeto(Vout, overwrite=True)
 
+
+def image_plane(hdul):
+    """The (memory-mapped) 2D image of an opened FITS file, dropping any degenerate leading axes without reading the data"""
+    data = hdul[0].data
+    return data[(0,) * (data.ndim - 2)]
+
+def to_pixel_coefficients(p, cx, cy, scale):
+    """Convert the coefficients of the quadratic surface fitted in the normalised
+    coordinates u = (x - cx)/scale, v = (y - cy)/scale back to those of func()"""
+    a, b, c, d, e, f = p
+    return np.array([
+        a - (b*cx + c*cy)/scale + (d*cx**2 + e*cy**2 + f*cx*cy)/scale**2,
+        b/scale - (2*d*cx + f*cy)/scale**2,
+        c/scale - (2*e*cy + f*cx)/scale**2,
+        d/scale**2,
+        e/scale**2,
+        f/scale**2,
+    ])
+
+def bin_points(x, y, z, bin_size):
+    """Average the points falling in each bin_size x bin_size box of pixels.
+    Returns the mean positions and values, and the number of points in each box as the weights."""
+    keys = (x // bin_size).astype(np.int64) * (int(np.max(y)) // bin_size + 1) + (y // bin_size).astype(np.int64)
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    mean = lambda v: np.bincount(inverse, weights=v) / counts
+    return mean(x), mean(y), mean(z), counts.astype(np.float64)
+
+def fast_fit(Inonpb, Ipb, Vpb, nsigma=20, makePlots=False, subchan=None, bin_size=None, block_rows=BLOCK_ROWS):
+    """As do_fit(), but opening each image once through memmap, selecting the
+    high-S/N pixels a block of rows at a time, and fitting the (linear in its
+    parameters) quadratic surface with a closed-form weighted least-squares solve
+
+    Args:
+        Inonpb (str): Stokes I non-primary-beam-corrected image
+        Ipb (str): Stokes I primary-beam-corrected image
+        Vpb (str): Stokes V primary-beam-corrected image
+        nsigma (float, optional): Sigma cutoff for source brightness. Defaults to 20.
+        makePlots (bool, optional): Make diagnostic plots. Defaults to False.
+        subchan (str, optional): The subchannel, for naming the plots. Defaults to None.
+        bin_size (int, optional): If set, average the selected pixels in boxes of this many pixels before fitting, weighting by the number of pixels in each box. Defaults to None.
+        block_rows (int, optional): Number of rows read at a time. Defaults to BLOCK_ROWS.
+
+    Returns:
+        np.ndarray: The parameters of func(), in percent
+    """
+    with fits.open(Inonpb, memmap=True) as hdu_I_npb, fits.open(Ipb, memmap=True) as hdu_I, fits.open(Vpb, memmap=True) as hdu_V:
+        img_I_npb = image_plane(hdu_I_npb)
+        img_I = image_plane(hdu_I)
+        img_V = image_plane(hdu_V)
+        xmax, ymax = img_I.shape[0], img_I.shape[1]
+
+        # Make a box of the inside 1/3rd of the image where hopefully we're artefact-free
+        imsize = img_I.shape[0]
+        l = int(np.round(imsize/3))
+        r = imsize - l
+
+        # Not worth looking at anything under some brightness (use sigma-clipping to find rms)
+        threshold = nsigma*scstd(np.array(img_I_npb[l:r,l:r]))
+
+        xs, ys, zs = [], [], []
+        for r0 in range(0, xmax, block_rows):
+            r1 = min(r0 + block_rows, xmax)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                frac = np.array(img_V[r0:r1], dtype=np.float64) / np.array(img_I[r0:r1], dtype=np.float64)
+                frac[np.array(img_I_npb[r0:r1]) < threshold] = np.nan
+            rows, cols = np.nonzero(~np.isnan(frac))
+            xs.append(rows + r0)
+            ys.append(cols)
+            zs.append(1.e2*frac[rows, cols])
+
+    x = np.concatenate(xs).astype(np.float64)
+    y = np.concatenate(ys).astype(np.float64)
+    z = np.concatenate(zs)
+
+    if bin_size is not None and bin_size > 1:
+        xb, yb, zb, w = bin_points(x, y, z, bin_size)
+    else:
+        xb, yb, zb, w = x, y, z, np.ones_like(z)
+
+    # Solve in coordinates normalised to the image size, for a well-conditioned design matrix
+    cx, cy, scale = ymax/2, xmax/2, max(xmax, ymax)/2
+    u, v = (yb - cx)/scale, (xb - cy)/scale
+    design = np.stack((np.ones_like(u), u, v, u**2, v**2, u*v), axis=-1)
+    sw = np.sqrt(w)
+    p, _, _, _ = np.linalg.lstsq(design * sw[:, None], zb * sw, rcond=None)
+    popt = to_pixel_coefficients(p, cx, cy, scale)
+
+    if makePlots is True:
+        plot_fit(x, y, z, popt, xmax, ymax, os.path.basename(Inonpb)[0:10], subchan=subchan)
+
+    return popt
+
+def fast_correct_image(Vpb, Ipb, popt, Vout, block_rows=BLOCK_ROWS):
+    """As correct_image(), but streaming the images through memory a block of rows at a time"""
+    with fits.open(Vpb, memmap=True) as hdu_V, fits.open(Ipb, memmap=True) as hdu_I:
+        img_V = image_plane(hdu_V)
+        img_I = image_plane(hdu_I)
+        xmax, ymax = img_V.shape
+
+        header = hdu_V[0].header.copy()
+        header["BITPIX"] = -32
+        for key in ("BSCALE", "BZERO"):
+            header.remove(key, ignore_missing=True)
+
+        if os.path.exists(Vout):
+            os.remove(Vout)
+        out = fits.StreamingHDU(Vout, header)
+        try:
+            cols = np.arange(ymax, dtype=np.float64)[None, :]
+            for r0 in range(0, xmax, block_rows):
+                r1 = min(r0 + block_rows, xmax)
+                rows = np.arange(r0, r1, dtype=np.float64)[:, None]
+                Z = func((cols, rows), *popt)
+                # Converting from percentage back to fraction
+                out.write(np.array(img_V[r0:r1] - (1.e-2*Z * img_I[r0:r1]), dtype='float32'))
+        finally:
+            out.close()
+
+def fit_and_correct(Inonpb, Ipb, Vpb, Vout, nsigma=20, makePlots=False, subchan=None, bin_size=None, old_method=False):
+    """Fit the leakage surface, and write the corrected Stokes V image"""
+    if old_method:
+        popt = do_fit(Inonpb, Ipb, Vpb, nsigma, makePlots, subchan=subchan)
+        correct_image(Vpb, Ipb, popt, Vout)
+    else:
+        popt = fast_fit(Inonpb, Ipb, Vpb, nsigma, makePlots, subchan=subchan, bin_size=bin_size)
+        fast_correct_image(Vpb, Ipb, popt, Vout)
+    return popt
+
+def _fit_and_correct(kwargs):
+    return fit_and_correct(**kwargs)
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--Inonpb', type=str, dest="Inonpb", help='Stokes I non-primary-beam-corrected image')
@@ -127,12 +265,35 @@ if __name__=='__main__':
     parser.add_argument('--Vout', type=str, dest="Vout", help='Output leakage-corrected Stokes V image (default _fixed)', default=None)
     parser.add_argument('--nsigma', type=float, default=20, help='Sigma cutoff for source brightness to calculate leakage screen (default=20)')
     parser.add_argument('--plots', action="store_true", default=False, help='Make diagnostic plots (default=False)')
+    parser.add_argument('--subchans', type=str, nargs="+", default=None, help='Process several subchannels in parallel. The image names (--Inonpb, --Ipb, --Vpb, --Vout) should then contain "{subchan}", which is replaced by each of these')
+    parser.add_argument('--nprocs', type=int, default=1, help='Number of subchannels processed at once (default=1)')
+    parser.add_argument('--bin', type=int, dest="bin_size", default=None, help='Average the selected pixels in boxes of this many pixels before fitting (default=no binning)')
+    parser.add_argument('--old-method', action="store_true", default=False, help='Use the original curve_fit based fit and in-memory correction (default=False)')
     args = parser.parse_args()
 
-    popt = do_fit(args.Inonpb, args.Ipb, args.Vpb, args.nsigma, args.plots, subchan=args.subchan)
-    if args.Vout is not None:
-        Vout = args.Vout
+    subchans = args.subchans if args.subchans is not None else [args.subchan]
+    jobs = []
+    for subchan in subchans:
+        fmt = (lambda name: name.format(subchan=subchan)) if args.subchans is not None else (lambda name: name)
+        Vpb = fmt(args.Vpb)
+        if args.Vout is not None:
+            Vout = fmt(args.Vout)
+        else:
+            Vout = Vpb.replace('.fits', '_fixed.fits')
+        jobs.append(dict(
+            Inonpb=fmt(args.Inonpb),
+            Ipb=fmt(args.Ipb),
+            Vpb=Vpb,
+            Vout=Vout,
+            nsigma=args.nsigma,
+            makePlots=args.plots,
+            subchan=subchan,
+            bin_size=args.bin_size,
+            old_method=args.old_method,
+        ))
+
+    if len(jobs) == 1:
+        fit_and_correct(**jobs[0])
     else:
-        Vout = args.Vpb.replace('.fits', '_fixed.fits')
-    correct_image(args.Vpb, args.Ipb, popt, Vout) 
-    
+        with Pool(args.nprocs) as pool:
+            pool.map(_fit_and_correct, jobs)
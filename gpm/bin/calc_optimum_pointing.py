@@ -9,16 +9,83 @@ from astropy import units as u
 import argparse
 import numpy as np
 
-def calc_peak_beam(metafits, gridsize = 8, cellsize = 1):
+# Each refinement searches around the best cell of the previous grid, with cells this many times smaller
+REFINE_FACTOR = 8
+
+
+def peak_on_grid(ras, decs, t, delays, freq, gridnum):
+    """The position of the peak of the Stokes I beam on a grid, evaluated with a
+    single beam lookup of every cell
+
+    Args:
+        ras (np.ndarray): RAs of the grid (deg)
+        decs (np.ndarray): Decs of the grid (deg)
+        t (astropy.time.Time): Time of the observation
+        delays (list[int]): Beamformer delays
+        freq (float): Frequency (Hz)
+        gridnum (int): Gridpoint number of the pointing
+
+    Returns:
+        tuple[float, float, float]: The RA and Dec of the peak, and the beam value there
+    """
+    # "ij" indexing visits the cells in the same order as looping over ras then decs,
+    # so that ties are broken in the same way
+    rr, dd = np.meshgrid(ras, decs, indexing="ij")
+    rr, dd = rr.ravel(), dd.ravel()
+
+    bX, bY = beam_value(rr, dd, t, delays, freq, gridnum)
+    bval = np.atleast_1d((bX + bY) / 2)
+    bval = np.where(np.isfinite(bval), bval, -np.inf)
+
+    ipeak = np.argmax(bval)
+
+    return rr[ipeak], dd[ipeak], bval[ipeak]
+
+
+def calc_peak_beam(metafits, gridsize = 8, cellsize = 1, refine = 0):
+    """Find the position of the peak of the primary beam, by searching a grid around
+    the pointing centre and then, optionally, successively finer grids around the peak
+
+    Args:
+        metafits (str): The metafits file of the observation
+        gridsize (float, optional): Size of the grid (deg). Defaults to 8.
+        cellsize (float, optional): Size of the grid cells (deg). Defaults to 1.
+        refine (int, optional): Number of refinements, each with cells REFINE_FACTOR times smaller. Defaults to 0.
+
+    Returns:
+        SkyCoord: The position of the peak
+    """
+    t, delays, freq, gridnum = parse_metafits(metafits)
+    hdu = fits.open(metafits)
+
+    ra = hdu[0].header["RA"]
+    dec = hdu[0].header["DEC"]
+    ras = np.arange(ra - (gridsize/2), ra + (gridsize/2), cellsize)
+    decs = np.arange(dec - (gridsize/2), dec + (gridsize/2), cellsize)
+
+    newra, newdec, val = peak_on_grid(ras, decs, t, delays, freq, gridnum)
+
+    for _ in range(refine):
+        # Search the cells either side of the peak, at finer resolution
+        offsets = np.linspace(-cellsize, cellsize, 2 * REFINE_FACTOR + 1)
+        cellsize = cellsize / REFINE_FACTOR
+        newra, newdec, val = peak_on_grid(newra + offsets, newdec + offsets, t, delays, freq, gridnum)
+
+    newradec = SkyCoord(newra, newdec, unit = (u.deg, u.deg))
+
+    return newradec
+
+
+def old_calc_peak_beam(metafits, gridsize = 8, cellsize = 1):
     t, delays, freq, gridnum = parse_metafits(metafits)
     hdu = fits.open(metafits)
-    
+
     ra = hdu[0].header["RA"]
     dec = hdu[0].header["DEC"]
     ras = np.arange(ra - (gridsize/2), ra + (gridsize/2), cellsize)
     decs = np.arange(dec - (gridsize/2), dec + (gridsize/2), cellsize)
     val = 0
-    
+
     for r in ras:
         for d in decs:
             bval = beam_value(r, d,  t, delays, freq, gridnum)
@@ -29,7 +96,7 @@ def calc_peak_beam(metafits, gridsize = 8, cellsize = 1):
                 newdec = d
 
     newradec = SkyCoord(newra, newdec, unit = (u.deg, u.deg))
-    
+
     return newradec
 
 if __name__ == "__main__":
@@ -38,13 +105,23 @@ if __name__ == "__main__":
     group1.add_argument("--metafits", type=str, help="The metafits file for your observation")
     group1.add_argument("--gridsize", type=float, help="The size of grid to search over (default = 8 degrees)", default=8)
     group1.add_argument("--cellsize", type=float, help="The cellsize of grid to search over (default = 1 degree)", default=1)
-    
+    group1.add_argument("--refine", type=int, help=f"Number of times to refine the search around the peak, each with cells {REFINE_FACTOR} times smaller (default = 0)", default=0)
+    group1.add_argument("-o", "--old-method", action="store_true", default=False, help="Evaluate the beam one cell at a time, as the original implementation did")
+
     options = parser.parse_args()
-    
-    radec = calc_peak_beam(
-        options.metafits, 
-        options.gridsize, 
-        options.cellsize
-    )
-    
+
+    if options.old_method:
+        radec = old_calc_peak_beam(
+            options.metafits,
+            options.gridsize,
+            options.cellsize
+        )
+    else:
+        radec = calc_peak_beam(
+            options.metafits,
+            options.gridsize,
+            options.cellsize,
+            options.refine,
+        )
+
     print(radec.to_string("hmsdms"))
@@ -16,8 +16,12 @@ TODO: Load in the metafits files and count the number of tiles that are known to
 
 import os
 import sys
+import json
+import struct
 import logging 
 from argparse import ArgumentParser
+from collections import namedtuple
+from multiprocessing import Pool
 
 import numpy as np
 
@@ -38,6 +42,17 @@ THRESHOLD = (
     0.25  # acceptable level of flagged solutions before the file is considered ratty
 )
 MWABW = 30720 # Spectral coverage in kilohertz  
+CACHE_PATH = os.environ.get(
+    "GPMSOLCACHE", os.path.join(os.path.expanduser("~"), ".cache", "gpm", "solution_checks.json")
+)
+
+# Header of the ao-calibrate binary solutions format, as read by calplots.aocal.fromfile
+AOCAL_HEADER = struct.Struct("<8s6I2d")
+AOCAL_INTRO = b"MWAOCAL\0"
+
+SolutionStats = namedtuple(
+    "SolutionStats", ["n_int", "n_ant", "n_chan", "n_pol", "ant_flagged", "seg_flagged"]
+)
 
 def obtain_cen_chan(obsids, disable_db_check=False):
     """Retrieve the cenchan for a set of specified pointings. This will be done through the 
@@ -112,6 +127,53 @@ def derive_edge_channel_flagged(ao_results, edge_bw_flag, no_sub_bands):
 
     return total_chans_flag
 
+def memmap_solutions(aofile):
+    """Memory-map the solutions of an ao-calibrate binary solutions file, without reading them
+
+    Args:
+        aofile (str): aocal solutions file to open
+
+    Returns:
+        numpy.memmap: complex solutions of shape (interval, antenna, channel, pol)
+    """
+    with open(aofile, "rb") as f:
+        intro, _, _, n_int, n_ant, n_chan, n_pol, _, _ = AOCAL_HEADER.unpack(f.read(AOCAL_HEADER.size))
+
+    if intro != AOCAL_INTRO:
+        raise ValueError(f"{aofile} is not a calibrate binary file")
+
+    return np.memmap(
+        aofile, dtype="<c16", mode="r", offset=AOCAL_HEADER.size, shape=(n_int, n_ant, n_chan, n_pol)
+    )
+
+
+def flag_statistics(aofile, segments=None):
+    """Fraction of flagged (NaN) solutions of each antenna and of each frequency segment,
+    computed in a single pass over the solutions
+
+    Args:
+        aofile (str): aocal solutions file to inspect
+
+    Keyword Args:
+        segments (int): If not None, also compute the flagged fraction of each of this many segments of the frequency axis (default: None)
+
+    Returns:
+        SolutionStats: shape of the solutions and the flagged fractions
+    """
+    ao_results = memmap_solutions(aofile)
+    n_int, n_ant, n_chan, n_pol = ao_results.shape
+
+    flagged = np.isnan(ao_results)
+    ant_flagged = flagged.mean(axis=(0, 2, 3))
+
+    seg_flagged = None
+    if segments is not None:
+        assert n_chan % segments == 0, f"{n_chan} channels is not evenly divisible by {segments} segments"
+        seg_flagged = flagged.reshape(n_int, n_ant, segments, n_chan // segments, n_pol).mean(axis=(0, 1, 3, 4))
+
+    return SolutionStats(n_int, n_ant, n_chan, n_pol, ant_flagged, seg_flagged)
+
+
 def check_solutions(
     aofile, 
     * ,
@@ -145,30 +207,28 @@ def check_solutions(
         return False
 
     logger.debug(f"Loading {aofile=}")
-    ao_results = fromfile(aofile)
+    segments = int(segments) if segments is not None else None
+    if segments is not None:
+        stats = flag_statistics(aofile, segments=segments)
+        assert stats.n_int == 1, "Segment checks not implemented across multiple time steps"
+    else:
+        stats = flag_statistics(aofile)
 
-    no_chan = ao_results.n_chan
-    no_ant = ao_results.n_ant
+    no_chan = stats.n_chan
+    no_ant = stats.n_ant
+    size = stats.n_int * stats.n_ant * stats.n_chan * stats.n_pol
 
     if logger.level == logging.DEBUG:
-        total_flag = 0
+        for ant, flag_lvl in enumerate(stats.ant_flagged):
+            logger.debug(f"{ant=} Flagged={flag_lvl*100:.2f}% {no_chan=}")
 
-        for ant in range(ao_results.shape[1]):
-            ant_data = ao_results[:,ant,:,:]
-            flag_lvl = np.sum(np.isnan(ant_data)) / np.prod(ant_data.shape)
-            
-            logger.debug(f"{ant=} {ant_data.shape=} Flagged={flag_lvl*100:.2f}% {no_chan=}")
+        logger.debug(f"Total set of antennas completely flagged: {np.sum(stats.ant_flagged == 1.)}")
 
-            if flag_lvl == 1.:
-                total_flag += 1
-
-        logger.debug(f"Total set of antennas completely flagged: {total_flag}")
-
-    logger.debug(f"AOFile datashape {ao_results.shape=}")
+    logger.debug(f"AOFile datashape {(stats.n_int, stats.n_ant, stats.n_chan, stats.n_pol)=}")
     
     # For each antenna this number of edge channels are flagged
     no_edges = derive_edge_channel_flagged(
-        ao_results, 
+        stats, 
         edge_bw_flag,
         no_sub_bands
         ) if ignore_edge_channels else 0
@@ -180,21 +240,14 @@ def check_solutions(
     no_edges *= 4
 
     logger.debug(f"Removing {no_edges=} from statistic")
-    ao_flagged = (np.sum(np.isnan(ao_results)) - no_edges) / (np.prod(ao_results.shape) - no_edges)
+    no_flagged = np.sum(stats.ant_flagged) * (size // no_ant)
+    ao_flagged = (no_flagged - no_edges) / (size - no_edges)
 
     logger.debug(f"{ao_flagged:.4f} fraction flagged")
     if ao_flagged > threshold:
         return False
 
     if segments is not None: 
-        segments = int(segments)
-
-        assert ao_results.shape[0] == 1, "Segment checks not implemented across multiple time steps"
-        
-        # shape is timestep, antenna, channel, pol
-        no_chan = ao_results.shape[2]
-        
-        assert no_chan % segments == 0, f"{no_chan} channels is not evenly divisible by {segments} segments"
         stride = no_chan // segments        
         logger.debug(f"{segments=} and {stride=}")
         
@@ -206,19 +259,131 @@ def check_solutions(
         if no_edges > 0:
             logger.debug(f"Assuming {no_seg_edges=} per segment")
 
-        for i in range(segments):
-            chan_slice = slice(i*stride, (i+1)*stride)
-            seg_ao_data = ao_results[:,:,chan_slice,:]
-            seg_ao_flagged = (np.sum(np.isnan(seg_ao_data)) - no_seg_edges) / (np.prod(seg_ao_data.shape) - no_seg_edges)
+        seg_size = size // segments
+        seg_ao_flagged = (stats.seg_flagged * seg_size - no_seg_edges) / (seg_size - no_seg_edges)
+        logger.debug(f"{seg_ao_flagged=}")
 
-            logger.debug(f"segment={i} {chan_slice} {seg_ao_data.shape} {seg_ao_flagged=}")
-
-            if seg_ao_flagged > segment_threshold:
-                return False
+        if np.any(seg_ao_flagged > segment_threshold):
+            return False
         
     return True
 
 
+def _cache_key(aofile, **kwargs):
+    """Key of a check result: the file (and its modification time and size) and the check options"""
+    path = os.path.abspath(aofile)
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    options = json.dumps(kwargs, sort_keys=True, default=str)
+
+    return f"{path}|{stat.st_mtime_ns}|{stat.st_size}|{options}"
+
+
+def load_check_cache(cache_path=CACHE_PATH):
+    """Previously computed results of check_solutions(), keyed by _cache_key()"""
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning(f"Ignoring unreadable cache {cache_path}")
+        return {}
+
+
+def save_check_cache(cache, cache_path=CACHE_PATH):
+    """Write the results of check_solutions() to the cache. The file is written to a
+    temporary name and moved into place, so concurrent readers never see a partial file."""
+    if cache_path is None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def _check_solutions(args):
+    aofile, kwargs = args
+    try:
+        return check_solutions(aofile, **kwargs)
+    except (OSError, ValueError, struct.error) as e:
+        # An unreadable or malformed file (e.g. a transient I/O error) is treated as invalid for now
+        # but not cached. Anything else, e.g. bad options, is a bug and is raised.
+        logger.warning(f"Unable to check {aofile}: {e}")
+        return None
+
+
+def check_solutions_batch(aofiles, nprocs=1, cache_path=CACHE_PATH, **kwargs):
+    """Evaluate many ao-calibrate solutions files in parallel, reusing the results of
+    files that were already checked with the same options and have not changed since
+
+    Args:
+        aofiles (iterable): aocal solutions files to inspect
+
+    Keyword Args:
+        nprocs (int): Number of processes to check files with (default: 1)
+        cache_path (str): JSON file of previous results. If None no cache is used (default: CACHE_PATH)
+        All other keyword arguments are passed to check_solutions()
+
+    Returns:
+        numpy.ndarray: Parallel array of whether each solutions file is valid. Files that could
+        not be read are reported as invalid, but are not cached so they are checked again next time
+    """
+    options = {k: kwargs[k] for k in (
+        "threshold", "segments", "segment_threshold", "ignore_edge_channels", "edge_bw_flag", "no_sub_bands"
+    ) if k in kwargs}
+
+    cache = load_check_cache(cache_path)
+    keys = [_cache_key(f, **options) for f in aofiles]
+
+    results = np.zeros(len(aofiles), dtype=bool)
+    todo = []
+    for i, key in enumerate(keys):
+        if key is None:
+            logger.debug(f"{aofiles[i]} not found")
+        elif key in cache:
+            results[i] = cache[key]
+        else:
+            todo.append(i)
+
+    logger.debug(f"{len(aofiles) - len(todo)} of {len(aofiles)} solution checks found in cache")
+
+    if len(todo) > 0:
+        with Pool(nprocs) as pool:
+            checked = pool.map(_check_solutions, [(aofiles[i], options) for i in todo])
+
+        for i, valid in zip(todo, checked):
+            results[i] = bool(valid)
+            if valid is not None:
+                cache[keys[i]] = bool(valid)
+        save_check_cache(cache, cache_path)
+
+    return results
+
+
+def nearest_valid(obsids, valid):
+    """For each obsid, the closest obsid in time with valid solutions. Ties go to the earlier obsid.
+
+    Args:
+        obsids (numpy.ndarray): Array of obsids
+        valid (numpy.ndarray): Parallel array of whether each obsid has valid solutions
+
+    Returns:
+        numpy.ndarray: Parallel array of the nearest valid obsid
+    """
+    candidates = np.sort(obsids[valid])
+    if len(candidates) == 0:
+        raise ValueError("No valid calibration solutions to assign from")
+
+    right = np.clip(np.searchsorted(candidates, obsids), 0, len(candidates) - 1)
+    left = np.clip(right - 1, 0, len(candidates) - 1)
+    use_left = np.abs(obsids - candidates[left]) <= np.abs(candidates[right] - obsids)
+
+    return np.where(use_left, candidates[left], candidates[right])
+
+
 def report(obsids, cobsids, file=None, only_calids=False):
     """Report when an obsid has been associated with a new copied obsid solution file
 
@@ -266,16 +431,13 @@ def find_valid_solutions(
     Returns:
         calids (numpy.ndarray): Parrallel array with calibration solution obsid corresponding to the obsids specified in `obsids`
     """
-    obsids = obsids.astype(np.int)
+    obsids = obsids.astype(int)
     calids = obsids.copy()
 
     logger.debug(f"{len(obsids)=} in presented set of obsids")
 
-    sol_present = np.array(
-        [
-            check_solutions(f"{base_path}/{obsid}/{obsid}{suffix}", **kwargs)
-            for obsid in obsids
-        ]
+    sol_present = check_solutions_batch(
+        [f"{base_path}/{obsid}/{obsid}{suffix}" for obsid in obsids], **kwargs
     )
 
     if np.all(sol_present == False):
@@ -286,17 +448,14 @@ def find_valid_solutions(
         cen_chan = obtain_cen_chan(obsids, disable_db_check=disable_db_check)
     else:
         cen_chan = np.array([1 for obsid in obsids])
+    cen_chan = np.broadcast_to(cen_chan, obsids.shape)
 
-    chan_lookup = {k: k == cen_chan for k in np.unique(cen_chan)}
-
-    for pos in np.argwhere(~sol_present):
-        obsid = obsids[pos]
-
-        obs_chan = cen_chan[pos][0]
-        present = sol_present & chan_lookup[obs_chan]
-
-        cobsid = obsids[present][np.argmin(np.abs(obsids[present] - obsid))]
-        calids[pos] = cobsid
+    for chan in np.unique(cen_chan):
+        same_chan = cen_chan == chan
+        missing = same_chan & ~sol_present
+        if not np.any(missing):
+            continue
+        calids[missing] = nearest_valid(obsids[same_chan], sol_present[same_chan])[~sol_present[same_chan]]
 
     return calids
 
@@ -346,6 +505,24 @@ if __name__ == "__main__":
         default=24,
         help='The number of sub-bands that make up a MWA measurement set, where each side of a subband would be flagged'
     )
+    parser.add_argument(
+        '--nprocs',
+        type=int,
+        default=1,
+        help='Number of processes used to check solution files in parallel. Default is 1. '
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        default=CACHE_PATH,
+        help=f'JSON file in which check results are cached, keyed by file, modification time and thresholds. Default is {CACHE_PATH}. '
+    )
+    parser.add_argument(
+        '--no-cache',
+        default=False,
+        action='store_true',
+        help='Do not read or write the cache of check results. '
+    )
     
     subparsers = parser.add_subparsers(dest="mode")
 
@@ -456,17 +633,19 @@ if __name__ == "__main__":
         if args.segments is not None:
             print(f"Applying nan threshold checks to {args.segments} sub-bands")
         
-        for f in args.aofile:
-            if check_solutions(
-                f, 
-                threshold=args.threshold, 
-                segments=args.segments,
-                segment_threshold=args.segment_threshold,
-                ignore_edge_channels=not args.include_edge_channels,
-                flag_edge_width=args.flag_edge_width,
-                no_sub_bands=args.no_subbands
-
-            ):
+        results = check_solutions_batch(
+            args.aofile,
+            nprocs=args.nprocs,
+            cache_path=None if args.no_cache else args.cache,
+            threshold=args.threshold, 
+            segments=args.segments,
+            segment_threshold=args.segment_threshold,
+            ignore_edge_channels=not args.include_edge_channels,
+            edge_bw_flag=args.flag_edge_width,
+            no_sub_bands=args.no_subbands
+        )
+        for f, valid in zip(args.aofile, results):
+            if valid:
                 print(f"{f} passed")
             else:
                 print(f"{f} failed")
@@ -486,8 +665,10 @@ if __name__ == "__main__":
             segments=args.segments,
             segment_threshold=args.segment_threshold,
             ignore_edge_channels=not args.include_edge_channels,
-            flag_edge_width=args.flag_edge_width,
-            no_sub_bands=args.no_subbands
+            edge_bw_flag=args.flag_edge_width,
+            no_sub_bands=args.no_subbands,
+            nprocs=args.nprocs,
+            cache_path=None if args.no_cache else args.cache,
         )
 
         if not args.no_report:
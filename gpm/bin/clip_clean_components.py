@@ -9,22 +9,83 @@ from __future__ import print_function
 __author__ = ["Tim Galvin",
               "Natasha Hurley-Walker"]
 
+import sys
+
 import numpy as np
 from astropy.io import fits
 from argparse import ArgumentParser
 
+from gpm.utils.image_post import STRIDE, process_image, process_images
+
+
+def summarise(summary, clip_level):
+    """Outputs a summary of the clipping performed on a single model"""
+    print('Processed {0}'.format(summary['input']))
+    print('Clipping range is +/- {0}'.format(clip_level))
+    print('{0} pixels in input model'.format(summary['npix']))
+    print('{0} pixels being set to zero'.format(summary['nclipped']))
+    print('{0} pixels retained their original value'.format(summary['npix'] - summary['nclipped']))
+    if summary['output'] is not None:
+        print('Writing to {0}'.format(summary['output']))
+
+
 def clip_components(
-    comp_file, write_out=True, clip_level=1e-10, summary=True
+    comp_file, write_out=True, clip_level=1e-10, summary=True, stride=STRIDE
 ):
     """Accepts a cleaned component model and will clip out pixels between certain values, setting them to zero.
+    The model is streamed through memory a block of rows at a time.
 
     Args:
         comp_file (str): Input cleaned component model to reset values to
         write_out (bool, optional): Creates a new file, with the `-clip.fits` suffix. Defaults to True.
         clip_level (float, optional): Pixels ub range (-clip_level, clip_level) are set to zero. Defaults to 1e-10.
         summary (bool, optional): Outputs a summary of the actions performed. Defaults to True
+        stride (int, optional): Approximate number of pixels to process at a time. Defaults to STRIDE.
     """
     assert comp_file[-5:] == '.fits', 'Expected a `fits` files, but recieved {0}'.format(comp_file)
+
+    out_file = comp_file.replace('.fits', '-clip.fits') if write_out else None
+    s = process_image(comp_file, out_file, clip_level=clip_level, stride=stride)
+
+    if summary:
+        summarise(s, clip_level)
+
+
+def clip_many_components(
+    comp_files, write_out=True, clip_level=1e-10, summary=True, nprocs=1, stride=STRIDE
+):
+    """clip_components() of many cleaned component models, in parallel
+
+    Args:
+        comp_files (list[str]): Input cleaned component models
+        nprocs (int, optional): Number of worker processes. Defaults to 1.
+        Other arguments are as for clip_components().
+
+    Returns:
+        bool: Whether every model was clipped. The reason for each failure is logged.
+    """
+    for comp_file in comp_files:
+        assert comp_file[-5:] == '.fits', 'Expected a `fits` files, but recieved {0}'.format(comp_file)
+
+    out_files = [comp_file.replace('.fits', '-clip.fits') if write_out else None for comp_file in comp_files]
+
+    summaries = process_images(
+        comp_files, out_files, nprocs=nprocs, clip_level=clip_level, stride=stride
+    )
+
+    if summary:
+        for s in summaries:
+            if s is not None:
+                summarise(s, clip_level)
+
+    return all(s is not None for s in summaries)
+
+
+def old_clip_components(
+    comp_file, write_out=True, clip_level=1e-10, summary=True
+):
+    """The original clip_components(), which loads the whole model into memory"""
+    assert comp_file[-5:] == '.fits', 'Expected a `fits` files, but recieved {0}'.format(comp_file)
     
     comp_data = fits.getdata(comp_file)
     comp_head = fits.getheader(comp_file)
@@ -58,19 +119,32 @@ def clip_components(
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='Clip pixels in a clean component model that appear to be meaningless (and prevent efficient compress!)')
-    parser.add_argument('components', help='The clean comonent model in fits format')
+    parser.add_argument('components', nargs='+', help='The clean comonent model(s) in fits format')
     parser.add_argument('-c','--clip-level', default=1e-10, type=float, help='Pixels in the range +/- clip_level are set to zero')
     parser.add_argument('-q','--quiet', default=False, action='store_true', help='Suppressess output')
     parser.add_argument('-d', '--dry-run', default=False, action='store_true', help='Prevents any new files from being created')
+    parser.add_argument('-n', '--nprocs', default=1, type=int, help='Number of models to process in parallel')
+    parser.add_argument('-o', '--old-method', default=False, action='store_true', help='Load each whole model into memory, as originally done')
 
     args = parser.parse_args()
 
     print(args)
 
-    clip_components(
-        args.components,
-        write_out = not args.dry_run,
-        clip_level=args.clip_level,
-        summary = not args.quiet
-    )
-    
\ No newline at end of file
+    if args.old_method:
+        for comp_file in args.components:
+            old_clip_components(
+                comp_file,
+                write_out = not args.dry_run,
+                clip_level=args.clip_level,
+                summary = not args.quiet
+            )
+    else:
+        success = clip_many_components(
+            args.components,
+            write_out = not args.dry_run,
+            clip_level=args.clip_level,
+            summary = not args.quiet,
+            nprocs=args.nprocs
+        )
+        if not success:
+            sys.exit(1)
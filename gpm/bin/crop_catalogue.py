@@ -13,6 +13,7 @@ from astropy.io import fits
 from argparse import ArgumentParser
 
 from gpm.bin.beam_value_at_radec import beam_value, parse_metafits
+from gpm.utils.beam_cache import CACHE_DIR as BEAM_CACHE_DIR
 
 
 def flux_cut(sources, min_flux):
@@ -242,7 +243,9 @@ if __name__ == "__main__":
             print("No metafits file selected.")
             sys.exit(1)
 
-    if args.beamselect is True:
+    if args.beamselect is True or args.attenuate is True:
+        # Look up the beam towards all the candidate sources once, and reuse it
+        # for both the selection and the attenuation
         t, delays, freq, gridnum = parse_metafits(args.metafits)
         x, y = beam_value(
             data[args.racol][indices],
@@ -251,8 +254,12 @@ if __name__ == "__main__":
             delays,
             freq,
             gridnum,
+            cache_dir=BEAM_CACHE_DIR,
         )
-        i = (x + y) / 2
+        beam_i = np.atleast_1d((x + y) / 2)
+
+    if args.beamselect is True:
+        i = beam_i
 
         # Attenuate the fluxes
         data[args.fluxcol][indices] = i * data[args.fluxcol][indices]
@@ -275,20 +282,11 @@ if __name__ == "__main__":
 
         # Select the final indices
         indices = indices[subindices]
+        beam_i = beam_i[subindices]
 
     if args.attenuate is True:
-        t, delays, freq, gridnum = parse_metafits(args.metafits)
-        x, y = beam_value(
-            data[args.racol][indices],
-            data[args.decol][indices],
-            t,
-            delays,
-            freq,
-            gridnum,
-        )
-
         # Perform a crude attenuation of the source flux densities
-        i = (x + y) / 2
+        i = beam_i
 
         # Attenuate the fluxes
         data[args.fluxcol][indices] = i * data[args.fluxcol][indices]
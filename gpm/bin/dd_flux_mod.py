@@ -8,71 +8,230 @@
 # and reduced peak flux densities from ionospheric blurring
 # should be boosted back to where they should have been.
 
+# The blur correction map depends only on the mosaic WCS and the PSF map. If a
+# cache directory is given (--cache-dir or $GPMBLURCACHE), it is computed once, in
+# blocks of rows, and cached on disk, so that reruns, and the matching _bkg and
+# _rms images (which share the mosaic's WCS), reuse it. Otherwise each block of
+# rows of the map is computed as it is needed. The mosaic itself is streamed
+# through memory in blocks of rows, so that images much larger than the available
+# memory can be corrected.
+
+import os
+import hashlib
+import logging
+
 import numpy as np
 
 from astropy.io import fits
+from astropy.io.fits.hdu.base import BITPIX2DTYPE
 from astropy import wcs
 from argparse import ArgumentParser
 
-parser = ArgumentParser(
-    description="Apply direction dependent de-blurring flux correction"
-)
-parser.add_argument(
-    "mosaic", type=str, help="The filename of the mosaic you want to read in."
-)
-parser.add_argument(
-    "psf",
-    type=str,
-    help="The filename of the psf image you want to read in. The fourth slice should contain the blur factor to apply.",
-)
-parser.add_argument(
-    "output", type=str, help="The filename of the output rescaled image."
-)
-parser.add_argument(
-    "-o",
-    "--old-method",
-    default=False,
-    action="store_true",
-    help="Invoke original correction code based on list comphrensions. By default will used a numpy approach that is significantly faster.",
-)
-parser.add_argument(
-    "-s",
-    "--stride",
-    default=10000,
-    type=int,
-    help="The number of pixels to process at a time",
-)
-
-args = parser.parse_args()
-
-input_mosaic = args.mosaic
-input_root = input_mosaic.replace(".fits", "")
-
-# Read in the mosaic to be modified
-mosaic = fits.open(input_mosaic)
-w = wcs.WCS(mosaic[0].header)
-
-# create an array but don't set the values (they are random)
-indexes = np.empty((mosaic[0].data.shape[0] * mosaic[0].data.shape[1], 2), dtype=int)
-# since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-# we do this only once and then recycle it
-idx = np.array([(j, 0) for j in range(mosaic[0].data.shape[1])])
-j = mosaic[0].data.shape[1]
-for i in range(mosaic[0].data.shape[0]):
-    idx[:, 1] = i
-    indexes[i * j : (i + 1) * j] = idx
-
-# put ALL the pixels into our vectorized functions and minimise our overheads
-
-# Read in the PSF
-psf = fits.open(args.psf)
-# Specifically, the blur factor
-blur = psf[0].data[3]
-
-w_psf = wcs.WCS(psf[0].header, naxis=2)
-
-if args.old_method:
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+# Maps are full-size float32 images, so they are only cached on disk if asked to
+CACHE_DIR = os.environ.get("GPMBLURCACHE", None)
+# Default number of mosaic pixels processed at a time
+STRIDE = 2**24
+
+
+def file_hash(path, block_size=2**20):
+    """SHA-256 of the contents of a file"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def blur_map_key(w, shape, psf_file):
+    """Cache key of a blur correction map: identical for all images that share
+    the same celestial WCS and size, corrected with the same PSF map"""
+    sha = hashlib.sha256()
+    sha.update(w.to_header_string(relax=True).encode("utf-8"))
+    sha.update(str(tuple(shape)).encode("utf-8"))
+    sha.update(file_hash(psf_file).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def blur_lookup(w, w_psf, blur, x, y):
+    """Blur factors at the given mosaic pixels, from the nearest (lower) PSF map pixel.
+    Pixels that fall outside of the PSF map take the value of its first pixel."""
+    ra, dec = w.wcs_pix2world(x, y, 1)
+    k, l = w_psf.wcs_world2pix(ra, dec, 1)
+
+    with np.errstate(invalid="ignore"):
+        k_int = np.floor(k)
+        l_int = np.floor(l)
+        mask = (k_int >= 0) & (k_int < blur.shape[1]) & (l_int >= 0) & (l_int < blur.shape[0])
+    k_int = np.where(mask, k_int, 0).astype(int)
+    l_int = np.where(mask, l_int, 0).astype(int)
+
+    return blur[l_int, k_int]
+
+
+class BlurRows:
+    """The blur correction map of a mosaic, of which only the blocks of rows that are
+    sliced out (e.g. rows[r0:r1]) are computed, so that the full map is never held in memory
+
+    Args:
+        w (astropy.wcs.WCS): Celestial WCS of the mosaic
+        shape (tuple[int, int]): Shape of the mosaic
+        blur (np.ndarray): Blur factor plane of the PSF map
+        w_psf (astropy.wcs.WCS): Celestial WCS of the PSF map
+    """
+
+    def __init__(self, w, shape, blur, w_psf):
+        self.w = w
+        self.shape = tuple(shape)
+        self.blur = blur
+        self.w_psf = w_psf
+
+    def __getitem__(self, rows):
+        r0, r1, step = rows.indices(self.shape[0])
+        if step != 1:
+            raise IndexError("Only contiguous blocks of rows can be computed")
+        x = np.arange(self.shape[1])[None, :]
+        y = np.arange(r0, r1)[:, None]
+        xx, yy = np.broadcast_arrays(x, y)
+        return blur_lookup(self.w, self.w_psf, self.blur, xx, yy).astype(np.float32)
+
+
+def compute_blur_map(w, shape, blur, w_psf, out, stride=STRIDE):
+    """Fill `out` with the blur correction of every mosaic pixel, a block of rows at a time
+
+    Args:
+        w (astropy.wcs.WCS): Celestial WCS of the mosaic
+        shape (tuple[int, int]): Shape of the mosaic
+        blur (np.ndarray): Blur factor plane of the PSF map
+        w_psf (astropy.wcs.WCS): Celestial WCS of the PSF map
+        out (np.ndarray): Array (or memmap) of the mosaic's shape to fill
+        stride (int, optional): Approximate number of pixels to process at a time. Defaults to STRIDE.
+    """
+    rows = BlurRows(w, shape, blur, w_psf)
+    nrows, ncols = shape
+    block_rows = max(stride // ncols, 1)
+
+    for r0 in range(0, nrows, block_rows):
+        r1 = min(r0 + block_rows, nrows)
+        out[r0:r1] = rows[r0:r1]
+        logger.debug(f"Computed blur correction for rows {r0}-{r1} of {nrows}")
+
+
+def load_blur_map(w, shape, psf_file, cache_dir=CACHE_DIR, stride=STRIDE):
+    """The blur correction map of a mosaic. If a cache directory is given, the map is
+    read from it if it has been computed before, otherwise computed and added to it.
+    Without a cache directory, each block of rows is computed as it is sliced out.
+
+    Args:
+        w (astropy.wcs.WCS): Celestial WCS of the mosaic
+        shape (tuple[int, int]): Shape of the mosaic
+        psf_file (str): Path to the PSF map. The fourth slice should contain the blur factor.
+        cache_dir (str, optional): Directory of cached maps, or None to not cache the map. Defaults to CACHE_DIR.
+        stride (int, optional): Approximate number of pixels to process at a time. Defaults to STRIDE.
+
+    Returns:
+        np.ndarray or BlurRows: The blur correction map (a read-only memmap if it is cached)
+    """
+    with fits.open(psf_file) as psf:
+        # Specifically, the blur factor
+        blur = np.array(psf[0].data[3], dtype=np.float32)
+        w_psf = wcs.WCS(psf[0].header, naxis=2)
+
+    if cache_dir is None:
+        logger.info(f"Computing blur correction for a {shape[0]}x{shape[1]} mosaic as it is applied")
+        return BlurRows(w, shape, blur, w_psf)
+
+    key = blur_map_key(w, shape, psf_file)
+    cache_path = os.path.join(cache_dir, f"{key}.npy")
+
+    if os.path.exists(cache_path):
+        logger.info(f"Using cached blur correction map {cache_path}")
+        return np.load(cache_path, mmap_mode="r")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=tuple(shape))
+    logger.info(f"Computing blur correction map for a {shape[0]}x{shape[1]} mosaic")
+    compute_blur_map(w, shape, blur, w_psf, out, stride=stride)
+    out.flush()
+    del out
+    os.replace(tmp_path, cache_path)
+
+    return np.load(cache_path, mmap_mode="r")
+
+
+def apply_blur_map(mosaic_file, output_file, blur_corr, stride=STRIDE):
+    """Stream the mosaic, a block of rows at a time, into the output image,
+    multiplying by the blur correction map. Scaled (BSCALE/BZERO) and integer
+    images are unscaled block by block and written as float32.
+
+    Args:
+        mosaic_file (str): Path to the mosaic
+        output_file (str): Path to the output rescaled image
+        blur_corr (np.ndarray or BlurRows): Blur correction map, of the mosaic's shape
+        stride (int, optional): Approximate number of pixels to process at a time. Defaults to STRIDE.
+    """
+    # Scaled data cannot be memory-mapped by astropy, so the raw values are mapped and scaled here
+    with fits.open(mosaic_file, memmap=True, do_not_scale_image_data=True) as mosaic:
+        data = mosaic[0].data
+        header = mosaic[0].header.copy()
+        bscale = header.get("BSCALE", 1.0)
+        bzero = header.get("BZERO", 0.0)
+        blank = header.get("BLANK", None)
+        scaled = any(key in header for key in ("BSCALE", "BZERO", "BLANK")) or header["BITPIX"] > 0
+
+        if scaled:
+            dtype = np.float32
+            for key in ("BSCALE", "BZERO", "BLANK"):
+                header.remove(key, ignore_missing=True)
+            header["BITPIX"] = -32
+        else:
+            dtype = BITPIX2DTYPE[header["BITPIX"]]
+
+        nrows, ncols = data.shape
+        block_rows = max(stride // ncols, 1)
+
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        out = fits.StreamingHDU(output_file, header)
+        try:
+            for r0 in range(0, nrows, block_rows):
+                r1 = min(r0 + block_rows, nrows)
+                block = data[r0:r1]
+                if scaled:
+                    raw = block
+                    block = raw.astype(np.float64) * bscale + bzero
+                    if blank is not None and np.issubdtype(raw.dtype, np.integer):
+                        block[raw == blank] = np.nan
+                out.write((block * blur_corr[r0:r1]).astype(dtype))
+        finally:
+            out.close()
+
+
+def old_blur_correction(mosaic, psf_file):
+    """The original correction code, based on list comprehensions, operating on the whole mosaic in memory"""
+    w = wcs.WCS(mosaic[0].header)
+
+    # create an array but don't set the values (they are random)
+    indexes = np.empty((mosaic[0].data.shape[0] * mosaic[0].data.shape[1], 2), dtype=int)
+    # since I know exactly what the index array needs to look like I can construct
+    # it faster than list comprehension would allow
+    idx = np.array([(j, 0) for j in range(mosaic[0].data.shape[1])])
+    j = mosaic[0].data.shape[1]
+    for i in range(mosaic[0].data.shape[0]):
+        idx[:, 1] = i
+        indexes[i * j : (i + 1) * j] = idx
+
+    # Read in the PSF
+    psf = fits.open(psf_file)
+    # Specifically, the blur factor
+    blur = psf[0].data[3]
+
+    w_psf = wcs.WCS(psf[0].header, naxis=2)
+
     # Apply the blur correction
     ra, dec = w.wcs_pix2world(indexes, 1).transpose()
     k, l = w_psf.wcs_world2pix(ra, dec, 1)
@@ -81,31 +240,63 @@ if args.old_method:
     l_int = [int(np.floor(x)) for x in l]
     l_int = [x if (x >= 0) and (x <= 180) else 0 for x in l_int]
     blur_tmp = blur[l_int, k_int]
-    blur_corr = blur_tmp.reshape(mosaic[0].data.shape[0], mosaic[0].data.shape[1])
-else:
-    stride = args.stride
-    count = 0
-    blur_tmp = np.zeros(len(indexes))
 
-    while count * stride < len(indexes):
-        s = slice(count * stride, (count + 1) * stride)
-        ra, dec = w.wcs_pix2world(indexes[s], 1).transpose()
-        k, l = w_psf.wcs_world2pix(ra, dec, 1)
+    return blur_tmp.reshape(mosaic[0].data.shape[0], mosaic[0].data.shape[1])
 
-        # Testing this suggests it is 100x+ faster.
-        k_int = np.floor(k).astype(np.int)
-        k_mask = (k_int >= 0) & (k_int <= 360)
-        k_int[~k_mask] = 0
 
-        l_int = np.floor(l).astype(np.int)
-        l_mask = (l_int >= 0) & (l_int <= 180)
-        l_int[~l_mask] = 0
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Apply direction dependent de-blurring flux correction"
+    )
+    parser.add_argument(
+        "mosaic", type=str, help="The filename of the mosaic you want to read in."
+    )
+    parser.add_argument(
+        "psf",
+        type=str,
+        help="The filename of the psf image you want to read in. The fourth slice should contain the blur factor to apply.",
+    )
+    parser.add_argument(
+        "output", type=str, help="The filename of the output rescaled image."
+    )
+    parser.add_argument(
+        "-o",
+        "--old-method",
+        default=False,
+        action="store_true",
+        help="Invoke original correction code based on list comphrensions. By default will used a numpy approach that is significantly faster.",
+    )
+    parser.add_argument(
+        "-s",
+        "--stride",
+        default=STRIDE,
+        type=int,
+        help=f"The number of pixels to process at a time (rounded to whole rows). Default: {STRIDE}",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        type=str,
+        help="Directory in which to cache blur correction maps (default = $GPMBLURCACHE, or no caching if unset)",
+    )
+    parser.add_argument(
+        "-v", "--verbose", default=False, action="store_true", help="Enable debug logging"
+    )
 
-        blur_tmp[s] = blur[l_int, k_int]
+    args = parser.parse_args()
 
-        count += 1
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
 
-    blur_corr = blur_tmp.reshape(mosaic[0].data.shape)
+    if args.old_method:
+        # Read in the mosaic to be modified
+        mosaic = fits.open(args.mosaic)
+        mosaic[0].data *= old_blur_correction(mosaic, args.psf)
+        mosaic.writeto(args.output, overwrite=True)
+    else:
+        header = fits.getheader(args.mosaic)
+        w = wcs.WCS(header, naxis=2)
+        shape = (header["NAXIS2"], header["NAXIS1"])
 
-mosaic[0].data *= blur_corr
-mosaic.writeto(args.output, overwrite=True)
+        blur_corr = load_blur_map(w, shape, args.psf, cache_dir=args.cache_dir, stride=args.stride)
+        apply_blur_map(args.mosaic, args.output, blur_corr, stride=args.stride)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""Extract the pixel values (and local rms) towards many sources from many images
+in a single run, as a batch version of image_value_at_radec.py.
+
+Source coordinates are loaded from the database once. Images that share the same
+WCS are grouped so that the world-to-pixel conversion is done once per group, and
+pixel values are read from memory-mapped images in parallel.
+"""
+
+import os
+import re
+import logging
+import argparse
+from glob import glob
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.time import Time
+from astropy.table import Table
+from astropy.coordinates import SkyCoord
+import astropy.units as u
+
+from gpm.bin.image_value_at_radec import gpmdb_connect, sc
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+# Number of rms boxes that are sigma-clipped together
+BOX_CHUNK = 64
+
+
+def load_sources(cur, names=None):
+    """Get the coordinates of the requested sources (or all of them) with a single query
+
+    Args:
+        cur (mysql.connector.cursor.MySQLCursor): Cursor to the database
+        names (list[str], optional): Names of the sources to load. If None, all sources are loaded. Defaults to None.
+
+    Returns:
+        tuple[list[int], list[str], SkyCoord]: The ids, names and coordinates of the sources
+    """
+    if names is None:
+        cur.execute("SELECT id, name, raj2000, decj2000 FROM source")
+    else:
+        format_string = ','.join(['%s'] * len(names)) # = '%s,%s,%s,...'
+        cur.execute(f"SELECT id, name, raj2000, decj2000 FROM source WHERE name IN ({format_string})", tuple(names))
+
+    res = cur.fetchall()
+
+    if names is not None:
+        missing = set(names) - {row[1] for row in res}
+        if len(missing) > 0:
+            raise Exception(f"No sources were found with the names {sorted(missing)}")
+
+    ids = [row[0] for row in res]
+    src_names = [row[1] for row in res]
+    coords = SkyCoord([row[2] for row in res], [row[3] for row in res], unit=(u.deg, u.deg), frame="fk5")
+
+    return ids, src_names, coords
+
+
+def obs_id_from_image(fits_image, header):
+    """The obs_id of an image, from its header if available, otherwise from the
+    leading digits of its filename (e.g. 1234567890_deep-MFS-image.fits)
+    """
+    if "GPSTIME" in header:
+        return int(header["GPSTIME"])
+
+    match = re.match(r"(\d{10})", os.path.basename(fits_image))
+    if match:
+        return int(match.group(1))
+
+    return int(np.round(Time(header["DATE-OBS"], format="isot", scale="utc").gps))
+
+
+def read_wcs_key(fits_image):
+    """Read just the header of an image, and return a key that is identical for
+    all images sharing the same celestial WCS and image size
+    """
+    header = fits.getheader(fits_image)
+    w = WCS(header, naxis=2)
+    key = (w.to_header_string(relax=True), header["NAXIS1"], header["NAXIS2"])
+
+    return fits_image, key, header["DATE-OBS"], obs_id_from_image(fits_image, header)
+
+
+def box_rms(data, x, y, err_size, chunk=BOX_CHUNK):
+    """The sigma-clipped rms (as image_value_at_radec.sc) of the box around each position.
+    Boxes that lie wholly within the image are stacked and clipped `chunk` at a time;
+    the result is the same as clipping each box on its own.
+
+    Args:
+        data (np.ndarray): The 2D image
+        x (np.ndarray): Pixel x coordinates (int)
+        y (np.ndarray): Pixel y coordinates (int)
+        err_size (int): Length of one side of the box
+        chunk (int, optional): Number of boxes clipped together. Defaults to BOX_CHUNK.
+
+    Returns:
+        np.ndarray: The rms of each box
+    """
+    rad = err_size//2
+    ny, nx = data.shape
+    rms = np.full(len(x), np.nan)
+
+    whole = (y - rad >= 0) & (y + rad <= ny) & (x - rad >= 0) & (x + rad <= nx)
+    iwhole = np.where(whole)[0]
+    for c0 in range(0, len(iwhole), chunk):
+        idx = iwhole[c0:c0 + chunk]
+        boxes = np.stack([data[y[i]-rad:y[i]+rad, x[i]-rad:x[i]+rad] for i in idx])
+        rms[idx] = sc(boxes, axis=(1, 2))
+
+    for i in np.where(~whole)[0]:
+        box = data[max(y[i]-rad, 0):y[i]+rad, max(x[i]-rad, 0):x[i]+rad]
+        rms[i] = sc(np.array(box))
+
+    return rms
+
+
+def extract_pixels(fits_image, x, y, err_size):
+    """Read the pixel values, and the rms of the surrounding box, at the given
+    pixel positions of a memory-mapped image
+
+    Args:
+        fits_image (str): Path to the image
+        x (np.ndarray): Pixel x coordinates (rounded to int)
+        y (np.ndarray): Pixel y coordinates (rounded to int)
+        err_size (int): Length of one side of the box used to compute the rms. If None, no rms is computed.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Values and rms at each position (NaN where unavailable)
+    """
+    values = np.full(len(x), np.nan)
+    rms = np.full(len(x), np.nan)
+
+    with fits.open(fits_image, memmap=True) as hdul:
+        data = hdul[0].data
+        # Drop any degenerate leading (frequency/Stokes) axes without reading the data
+        data = data[(0,) * (data.ndim - 2)]
+        ny, nx = data.shape
+
+        inside = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+        for i in np.where(inside)[0]:
+            values[i] = data[y[i], x[i]]
+
+        wanted = ~np.isnan(values)
+        if err_size is None or not np.any(wanted):
+            return values, rms
+
+        # The same clipping is used however many sources are in the image, so
+        # that the errors of a source are comparable between images
+        rms[wanted] = box_rms(data, x[wanted], y[wanted], err_size)
+
+    return values, rms
+
+
+def _extract_pixels(args):
+    return extract_pixels(*args)
+
+
+def extract_lightcurves(fits_images, ids, names, coords, err_size=200, nprocs=1):
+    """Extract the values towards all sources from all images
+
+    Args:
+        fits_images (list[str]): Paths to the images
+        ids (list[int]): Database ids of the sources
+        names (list[str]): Names of the sources
+        coords (SkyCoord): Coordinates of the sources
+        err_size (int, optional): Length of one side of the box used to compute the rms. Defaults to 200.
+        nprocs (int, optional): Number of processes used to read the images. Defaults to 1.
+
+    Returns:
+        astropy.table.Table: One row per (source, image) where the source lies in the image and its value is not NaN
+    """
+    with Pool(nprocs) as pool:
+        headers = pool.map(read_wcs_key, fits_images)
+
+        # Group images that share the same WCS, so that the pixel coordinates
+        # of the sources only need to be computed once per group
+        groups = defaultdict(list)
+        for fits_image, key, date_obs, obs_id in headers:
+            groups[key].append(fits_image)
+        logger.info(f"{len(fits_images)} images in {len(groups)} WCS groups")
+
+        pixels = {}
+        for key, group_images in groups.items():
+            w = WCS(fits.Header.fromstring(key[0]), naxis=2)
+            x, y = w.world_to_pixel(coords)
+            x = np.round(np.atleast_1d(x)).astype(int)
+            y = np.round(np.atleast_1d(y)).astype(int)
+            for fits_image in group_images:
+                pixels[fits_image] = (x, y)
+
+        results = pool.map(
+            _extract_pixels,
+            [(fits_image, *pixels[fits_image], err_size) for fits_image, _, _, _ in headers],
+        )
+
+    rows = []
+    for (fits_image, _, date_obs, obs_id), (values, rms) in zip(headers, results):
+        for i in np.where(~np.isnan(values))[0]:
+            rows.append((ids[i], names[i], obs_id, date_obs, fits_image, values[i], rms[i]))
+
+    return Table(
+        rows=rows if len(rows) > 0 else None,
+        names=("source_id", "source", "obs_id", "date_obs", "image", "flux_Jy", "flux_Jy_err"),
+        dtype=(int, str, int, str, str, float, float),
+    )
+
+
+def insert_lightcurves(cur, table):
+    """Bulk insert (or update) the extracted values into the lightcurve table
+
+    Args:
+        cur (mysql.connector.cursor.MySQLCursor): Cursor to the database
+        table (astropy.table.Table): Output of extract_lightcurves()
+    """
+    values = [
+        (
+            int(row["source_id"]),
+            Time(row["date_obs"], format="isot", scale="utc").datetime,
+            int(row["obs_id"]),
+            float(row["flux_Jy"]),
+            None if np.isnan(row["flux_Jy_err"]) else float(row["flux_Jy_err"]),
+        )
+        for row in table
+    ]
+
+    cur.executemany(
+        """
+        INSERT INTO lightcurve (source_id, timestamp, obs_id, flux_Jy, flux_Jy_err)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+          timestamp = VALUES(timestamp),
+          flux_Jy = VALUES(flux_Jy),
+          flux_Jy_err = VALUES(flux_Jy_err)
+        """,
+        values,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pull out the values of many images at the positions of many sources")
+    parser.add_argument("fits_images", nargs="*", help="The paths (or glob patterns) of the FITS images to open")
+    parser.add_argument("--image_list", default=None, help="A file containing the paths of the FITS images to open, one per line")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--sources", nargs="+", default=None, help="The source names (which must exist in the database) to use for coordinates")
+    source_group.add_argument("--all_sources", action="store_true", help="Use all sources in the database")
+    parser.add_argument("--error_region_size", default=200, type=int, help="The length of one side of a box (in pixels) used for the region used to calculate the rms error. Default: 200")
+    parser.add_argument("--nprocs", default=1, type=int, help="Number of processes used to read the images. Default: 1")
+    parser.add_argument("--output", default=None, help="Write the results to this table (format determined by the extension, e.g. .csv, .fits)")
+    parser.add_argument("--insert", action="store_true", help="Insert the results into the lightcurve table of the database")
+    args = parser.parse_args()
+
+    fits_images = []
+    for pattern in args.fits_images:
+        fits_images += sorted(glob(pattern)) or [pattern]
+    if args.image_list is not None:
+        with open(args.image_list, "r") as f:
+            fits_images += [line.strip() for line in f if line.strip()]
+
+    if len(fits_images) == 0:
+        parser.error("No images supplied")
+
+    # Connect to the database
+    conn = gpmdb_connect()
+    cur = conn.cursor()
+
+    # Get the source coordinates for all the requested sources at once
+    ids, names, coords = load_sources(cur, names=None if args.all_sources else args.sources)
+
+    table = extract_lightcurves(fits_images, ids, names, coords, err_size=args.error_region_size, nprocs=args.nprocs)
+    logger.info(f"Extracted {len(table)} measurements")
+
+    if args.output is not None:
+        table.write(args.output, overwrite=True)
+    else:
+        for row in table:
+            print(row["source"], row["date_obs"], row["flux_Jy"], row["flux_Jy_err"])
+
+    if args.insert:
+        insert_lightcurves(cur, table)
+        conn.commit()
+
+    # Disconnect from the database
+    conn.close()
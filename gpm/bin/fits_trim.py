@@ -7,20 +7,51 @@ A tool that does two things:
 1 - converts pixels that are identically zero into masked pixels
 2 - trims the fits image to the smallest rectangle that still contains all the data pixels
 
+The image is streamed through memory a block of rows at a time (see gpm/utils/image_post.py),
+and many images can be trimmed in one invocation with --suffix.
+
 Author: Paul Hancock
 Nov-2014
 """
 
 
+import sys
+
 import numpy as np
 from astropy.io import fits
-import sys
+from argparse import ArgumentParser
+
+from gpm.utils.image_post import STRIDE, process_image, process_images, output_name
+
+
+def trim(fin, fout, stride=STRIDE):
+    """Crops the image to remove any row or column made up entirely of nan pixels,
+    after turning pixels that are identically zero into nan pixels.
+
+    Arguments:
+        fin (str) -- Path to the input fits file with dimensions to crop
+        fout (str) -- Path to new output fits file with cropped dimensions
+        stride (int) -- Approximate number of pixels to process at a time
+    """
+    summary = process_image(fin, fout, mask_zeros=True, trim=True, stride=stride)
+    report(summary)
+
 
+def report(summary):
+    """Print the crop box and shapes of a trimmed image"""
+    jmin, jmax, imin, imax = summary["bounds"]
+    print(f"Input image shape: {summary['input_shape']}")
+    print(f"imin: {imin}")
+    print(f"imax: {imax}")
+    print(f"jmin: {jmin}")
+    print(f"jmax: {jmax}")
+    print(f"Output data shape: {summary['output_shape']}")
+    print("wrote", summary["output"])
 
-def trim(fin, fout):
-    """Searches for the four directions (top, bottom, left, right) for the first
-    valid row or column, where valid means not made up entirely of NaNs. Essentially
-    performs a crop to remove any row or column made up entirely of nan pixels. 
+
+def old_trim(fin, fout):
+    """The original trim, which searches the four directions (top, bottom, left, right)
+    for the first valid row or column, one row or column at a time, in memory.
 
     Arguments:
         fin (str) -- Path to the input fits file with dimensions to crop
@@ -78,12 +109,32 @@ def trim(fin, fout):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2:
-        fin = sys.argv[-2]
-        fout = sys.argv[-1]
-        print(fin, "=>", fout, "(mask and trim)")
+    parser = ArgumentParser(description="Mask zero-valued pixels and trim images to the smallest rectangle that contains all the data pixels")
+    parser.add_argument("images", nargs="+", help="infile.fits outfile.fits, or (with --suffix) any number of input images")
+    parser.add_argument("--suffix", default=None, help="Trim every image given, writing [image][suffix].fits")
+    parser.add_argument("--nprocs", default=1, type=int, help="Number of worker processes (default = 1)")
+    parser.add_argument("-s", "--stride", default=STRIDE, type=int, help=f"The number of pixels to process at a time (rounded to whole rows). Default: {STRIDE}")
+    parser.add_argument("-o", "--old-method", default=False, action="store_true", help="Use the original row-by-row search, holding the image in memory")
+    args = parser.parse_args()
+
+    if args.suffix is not None:
+        fins = args.images
+        fouts = [output_name(f, args.suffix) for f in fins]
+    elif len(args.images) == 2:
+        fins, fouts = args.images[:1], args.images[1:]
     else:
-        print("usage: python {0} infile.fits outfile.fits".format(__file__))
-        sys.exit()
-    trim(fin, fout)
+        parser.error("Expected infile.fits outfile.fits, or --suffix with any number of input images")
 
+    for fin, fout in zip(fins, fouts):
+        print(fin, "=>", fout, "(mask and trim)")
+
+    if args.old_method:
+        for fin, fout in zip(fins, fouts):
+            old_trim(fin, fout)
+    else:
+        summaries = process_images(fins, fouts, nprocs=args.nprocs, mask_zeros=True, trim=True, stride=args.stride)
+        for summary in summaries:
+            if summary is not None:
+                report(summary)
+        if any(summary is None for summary in summaries):
+            sys.exit(1)
@@ -13,9 +13,11 @@ from astropy.io import fits
 from astropy.coordinates import SkyCoord, EarthLocation, AltAz
 from astropy.time import Time
 from astropy.table import Table
-from mwa_pb_lookup.lookup_beam import beam_lookup_1d as gpm_beam_lookup
 from gpm.bin.beam_value_at_radec import parse_metafits, beam_value
 from gpm.db.check_src_fov import check_coords
+from gpm.utils.metadata_cache import read_header
+from gpm.utils.beam_cache import beam_response, CACHE_DIR as BEAM_CACHE_DIR
+from gpm.utils.sky_index import load_index, format_ra, format_dec
 
 # TODO: Move to a proper GPM location
 # MWA location from CONV2UVFITS/convutils.h
@@ -98,11 +100,13 @@ def read_source_txt(path: str) -> Tuple[Source, ...]:
     return tuple(sources)
 
 
-def ggsm_row_model(row):
+def ggsm_row_model(row, RA=None, Dec=None):
     """Transfer a row inro the Andre format for model components
 
     Args:
         row (astropy.table.row): A row from the astropy.Table of a component
+        RA (str, optional): Preformatted RA of the component. Defaults to None, in which case it is formatted here.
+        Dec (str, optional): Preformatted Dec of the component. Defaults to None, in which case it is formatted here.
 
     Returns:
         str: model description of row
@@ -110,9 +114,10 @@ def ggsm_row_model(row):
     gformatter = 'source {{\n  name "{Name:s}"\n  component {{\n    type {shape:s}\n    position {RA:s} {Dec:s}\n    shape {a:2.1f} {b:2.1f} {pa:4.1f}\n    sed {{\n      frequency {freq:3.0f} MHz\n      fluxdensity Jy {flux:4.7f} 0 0 0\n      spectral-index {{ {alpha:2.2f} {beta:2.2f} }}\n    }}\n  }}\n}}\n'
     pformatter = 'source {{\n  name "{Name:s}"\n  component {{\n    type {shape:s}\n    position {RA:s} {Dec:s}\n    sed {{\n      frequency {freq:3.0f} MHz\n      fluxdensity Jy {flux:4.7f} 0 0 0\n      spectral-index {{ {alpha:2.2f} {beta:2.2f} }}\n    }}\n  }}\n}}\n'
 
-    pos = SkyCoord(row["RAJ2000"], row["DEJ2000"], unit=(u.deg, u.deg))
-    RA = pos.ra.to_string(u.hour)
-    Dec = pos.dec.to_string(u.deg)
+    if RA is None:
+        RA = str(format_ra(row["RAJ2000"]))
+    if Dec is None:
+        Dec = str(format_dec(row["DEJ2000"]))
 
     point = np.isnan(row["a"])
     if point:
@@ -144,21 +149,22 @@ def ggsm_row_model(row):
     return out
 
 
-def search_ggsm(a_src, ggsm_sky, search_radius):
-    """Search for components around a A-team source and return a mask of components
-    that are within a specified search_radius
+def ggsm_model(comps):
+    """Transfer a table of components into the Andre format, formatting all of
+    their positions at once
 
     Args:
-        a_src (Source): A source to search around for nearby components
-        ggsm_sky (SkyCoord): Component positions from the GGSM
-        search_radius (units): The search radius to use
+        comps (astropy.table.Table): Components to transfer
 
     Returns:
-        np.ndarray: Boolean mask describing whether GSSM components were near a source position
+        str: model description of all components
     """
-    mask = a_src.separation(ggsm_sky) < search_radius
+    RAs = format_ra(comps["RAJ2000"])
+    Decs = format_dec(comps["DEJ2000"])
 
-    return mask
+    return "".join(
+        ggsm_row_model(comp, RA=str(RA), Dec=str(Dec)) for comp, RA, Dec in zip(comps, RAs, Decs)
+    )
 
 
 def check_coords_mask(w: WCS, coords: SkyCoord, border_size: int) -> bool:
@@ -430,7 +436,7 @@ def ateam_model_creation(
 
     time, delays, freq, grid = parse_metafits(metafits_file)
 
-    header = fits.open(metafits_file)[0].header
+    header = read_header(metafits_file)
 
     # Mid-point of the observation used for AltAz.
     gpstime = header["GPSTIME"]
@@ -450,29 +456,44 @@ def ateam_model_creation(
         model_text = "skymodel fileformat 1.1\n"
 
         assert ggsm is not None, "GGSM needs to be set for subtrmodel mode"
-        ggsm_tab = Table.read(ggsm)
-        ggsm_sky = SkyCoord(
-            ggsm_tab["RAJ2000"], ggsm_tab["DEJ2000"], unit=(u.deg, u.deg)
+        ggsm_index = load_index(ggsm)
+        # Components around every bright source, from a single query of the index
+        ggsm_matches = ggsm_index.query(
+            [src.pos.ra.deg for src in sources],
+            [src.pos.dec.deg for src in sources],
+            search_radius,
         )
     elif mode == "casa":
         model_text = ""
     elif mode in ("casaclean", "wsclean"):
         model_dict: DefaultDict[str, List] = defaultdict(list)
 
-    for src in sources:
-        response = gpm_beam_lookup(src.pos.ra.deg, src.pos.dec.deg, grid, time, freq)
+    # Mean of the XX and YY responses towards all the bright sources, looked up at once
+    responses = np.mean(
+        beam_response(
+            np.array([src.pos.ra.deg for src in sources]),
+            np.array([src.pos.dec.deg for src in sources]),
+            grid,
+            time,
+            freq,
+            cache_dir=BEAM_CACHE_DIR,
+        ),
+        axis=0,
+    ).ravel()
+
+    for s, (src, response) in enumerate(zip(sources, responses)):
         cal_flux = src.brightness(freq)
-        app_flux = cal_flux * np.mean(response)
+        app_flux = cal_flux * response
 
         in_fov = check_coords(metafits_wcs, src.pos)
 
         if app_flux < min_flux or (check_fov and in_fov):
             continue
 
-        if max_response is not None and np.mean(response) > max_response:
+        if max_response is not None and response > max_response:
             continue
 
-        if min_response is not None and np.mean(response) < min_response:
+        if min_response is not None and response < min_response:
             continue
 
         altaz = src.pos.transform_to(AltAz(obstime=obs_time, location=LOCATION))
@@ -496,25 +517,23 @@ def ateam_model_creation(
         elif mode == "count":
             no_comps += 1
         elif mode == "subtrmodel":
-            matches = search_ggsm(src.pos, ggsm_sky, search_radius)
-            comps = ggsm_tab[matches]
+            comps = ggsm_index.table(ggsm_matches[s])
             no_comps += len(comps)
 
             print(f"{src.name} is going to the model...")
-            if apply_beam:
+            if apply_beam and len(comps) > 0:
                 print("...Applying primary beam attenuation to the components")
-                comps_response = gpm_beam_lookup(
-                    ggsm_sky[matches].ra.deg,
-                    ggsm_sky[matches].dec.deg,
+                comps_response = beam_response(
+                    np.asarray(comps["RAJ2000"]),
+                    np.asarray(comps["DEJ2000"]),
                     grid,
                     time,
                     freq,
+                    cache_dir=BEAM_CACHE_DIR,
                 )
                 comps["S_200"] = comps["S_200"] * np.mean(comps_response, axis=0)
 
-            for comp in comps:
-                comp_model = ggsm_row_model(comp)
-                model_text += comp_model
+            model_text += ggsm_model(comps)
 
     if mode == "count":
         return no_comps
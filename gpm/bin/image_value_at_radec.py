@@ -10,6 +10,8 @@ import argparse
 import logging
 import mysql.connector as mysql
 
+from gpm.utils.local_stats import sigma_clipped_std
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
 logger.setLevel(logging.INFO)
@@ -39,10 +41,7 @@ def gpmdb_connect():
     return db_con
 
 
-def sc(data):
-    std = np.nanstd(data)
-    std = np.nanstd(data[np.abs(data) < 3*std])
-    return std
+sc = sigma_clipped_std
 
 
 def main(fits_image, coords, err_coords=None, err_size=None):
@@ -46,17 +46,18 @@ if __name__ == "__main__":
     if os.path.exists(args.ionocsv):
         filename, file_extension = os.path.splitext(args.ionocsv)
         if file_extension == ".csv":
-            arr = np.loadtxt(open(args.ionocsv, "rb"), delimiter=",", skiprows=1)
-            obsid = arr[0]
-            med = arr[1]
-            peak = arr[2]
-            std = arr[3]
+            # One row per obsid: either a single [obsid]_ionodiff.csv, or the table written by aocal_batch.py
+            arr = np.loadtxt(open(args.ionocsv, "rb"), delimiter=",", skiprows=1, usecols=(0, 1, 2, 3), ndmin=2)
+        elif file_extension == ".parquet":
+            import pandas as pd
+            arr = pd.read_parquet(args.ionocsv, columns=["obsid", "median", "peak", "std"]).to_numpy()
         else:
             print("Other file formats not yet enabled.")
             sys.exit(1)
 
     conn = mdb.connect()
     cur = conn.cursor()
-    update_ionosphere(obsid, med, peak, std, cur)
+    for obsid, med, peak, std in arr:
+        update_ionosphere(obsid, med, peak, std, cur)
     conn.commit()
     conn.close()
@@ -13,13 +13,12 @@ from astropy.coordinates import SkyCoord, EarthLocation, match_coordinates_sky
 from astropy.time import Time
 from astropy.table import Table 
 
+from gpm.db import observation_catalogue as obscat
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
 logger.setLevel(logging.INFO)
 
-MWA = EarthLocation.from_geodetic(
-    lat=-26.703319 * u.deg, lon=116.67081 * u.deg, height=377 * u.m
-)
 DEC_POINTINGS = [-71, -55, -41, -39, -26, -12, 3, 20]
 
 def process_df(df: pd.DataFrame) -> pd.DataFrame:
@@ -32,29 +31,10 @@ def process_df(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: Preprocessed observation table
     """
-    # Unwrap the LST which is going above 360 degrees
-    df['lst_deg_wrap'] = df['lst_deg'] % 360
-    
-    # Dec strip
-    dec = np.array([-71.0, -55.0, -41.0, -39.0, -26.0, -12.0, 3.0, 20.0])
-    logger.debug(f"Matching to nearest dec strip: {dec}")
-    min_dec = lambda x: dec[np.argmin(np.abs(dec - x["dec_pointing"]))]
-    df["dec_strip"] = df.apply(min_dec, axis=1)
-
-    # Hour angle
-    gps = Time(df["obs_id"], format="gps", location=MWA)
-    lst = gps.sidereal_time("mean")
-
-    ra = df["ra_pointing"].values
-    ha = np.round((lst.deg - ra) / 15)
-
-    mask = ha > 12
-    ha[mask] = ha[mask] - 24.0
+    # The dec strip and hour-angle columns are derived when the observations are loaded
+    if 'ha' not in df.columns:
+        df = obscat.add_derived_columns(df)
 
-    mask = ha < -12
-    ha[mask] = ha[mask] + 24.0
-
-    df['ha'] = ha.astype(int)
     df = df[df['ha'].isin((-1,0,1))]
 
     # target = SkyCoord(
@@ -81,55 +61,18 @@ def load_gpm_observations(gpm_db: str, filter_obsids: Collection[int]=None) -> p
         pd.DataFrame: Table of GPM observations and properties
     """
     logger.info(f"Polling {gpm_db}")
-    
-    df = pd.read_sql(
-        'select * from observation',
-        f'mysql://gpmdb@{gpm_db}/gpm'
-    )
-    
-    logger.info(f"GPM observations loaded: {len(df)} observations")
 
-    if filter_obsids is not None:
-        logger.info('Filtering the GPM observation table')
-        filt_mask = df['obs_id'].isin(filter_obsids)
-        df = df[filt_mask]
+    df = obscat.load_observations(
+        dbconn=f'mysql://gpmdb@{gpm_db}/gpm',
+        filter_obsids=filter_obsids,
+    )
 
-        logger.info(f"{len(df)} rows remaing")
+    logger.info(f"GPM observations loaded: {len(df)} observations")
 
     df = process_df(df)
 
     return df 
 
-def load_gpm_db(gpm_db: str, filter_obsids: Collection[int]=None) -> pd.DataFrame:
-    """Load in the GPM observation table
-
-    Args:
-        gpm_db (str): Address of the gpm pipeline database
-        filter_obsids (Collection[int], optional): Only include observation if the obsid is in this set. Defaults to None.
-
-    Returns:
-        pd.DataFrame: Table of GPM observations and properties
-    """
-    logger.info(f"Polling {gpm_db}")
-    df = pd.read_sql(
-        'select * from observation',
-        f'mysql://gpmdb@{gpm_db}/gpm'
-    )
-    
-    logger.info(f"GPM observations loaded: {len(df)} observations")
-    
-    if filter_obsids is not None:
-        logger.info('Filtering the GPM observation table')
-        filt_mask = df['obs_id'].isin(filter_obsids)
-        df = df[filt_mask]
-
-        logger.info(f"{len(df)} rows remaing")
-
-
-    df = process_df(df)
-   
-    return df
-
 
 def read_obsids(gpm_obsids: str) -> Collection[int]:
     """Read in a new-line delimited set of obsids from a text file. 
@@ -140,7 +83,7 @@ def read_obsids(gpm_obsids: str) -> Collection[int]:
     Returns:
         Collection[int]: Collection of obsids loaded from obsids file
     """
-    if not os.path.exists:
+    if not os.path.exists(gpm_obsids):
         logger.debug(f"{gpm_obsids} path does not exist. ")
         return None
 
@@ -156,9 +99,9 @@ def associate_metafits_to_gpm(
     out: str= None, 
     gpm_db: str='146.118.68.233', 
     gpm_obsids: str=None, 
-    gpm_obsids: str=None
+    idg_obsids: str=None
     ):
-    """Search for nearest GPM obsid for each GPM metafits file, ensuring matching
+    """Search for nearest GPM obsid for each IDG observation, ensuring matching
     central channels. Also provide three sets of results corresponding to each of the 
     three GPM hour-angles
 
@@ -166,11 +109,11 @@ def associate_metafits_to_gpm(
         out (str, optional): Base file name to create output fits and txt files. If None, no output files are created. Defaults to None.
         gpm_db (str, optional): Address to the gpm database. Defaults to 146.118.68.233.
         gpm_obsids (str, optional): Path to a new-line delimited file of gpm obsids to filter to. Defaults to None. 
-        gpm_obsids (str, optional): Path to a new-line delimited file of gpm obsids to filter to. Defaults to None. 
+        idg_obsids (str, optional): Path to a new-line delimited file of idg obsids to filter to. Defaults to None. 
     """
-    g_df = load_gpm_db(
+    idg_df = load_gpm_observations(
         gpm_db=gpm_db,
-        filter_obsids=read_obsids(gpm_obsids) if gpm_obsids is not None else None  
+        filter_obsids=read_obsids(idg_obsids) if idg_obsids is not None else None  
     )
 
     gpm_df = load_gpm_observations(
@@ -181,42 +124,42 @@ def associate_metafits_to_gpm(
     results = []
     for (cenchan, delays), gpm_sub_df in gpm_df.groupby(['cenchan', 'delays']):
         logger.info(f"GPM subset: {cenchan=} {delays=}")
-        g_sub_df = g_df[
-            (g_df['cenchan'] == cenchan) & 
-            (g_df['delays'] == delays)
+        idg_sub_df = idg_df[
+            (idg_df['cenchan'] == cenchan) & 
+            (idg_df['delays'] == delays)
         ]
 
         logger.info(f"Sub GPM df: {len(gpm_sub_df)} rows")
-        logger.info(f"Sub GPM df: {len(g_sub_df)} rows")
+        logger.info(f"Sub IDG df: {len(idg_sub_df)} rows")
 
-        if len(gpm_sub_df) == 0 or len(g_sub_df) == 0:
+        if len(gpm_sub_df) == 0 or len(idg_sub_df) == 0:
             logger.info("Empty catalogue. Next set. ")
             continue 
 
         gpm_sub_sky = SkyCoord(
-            gpm_sub_df['ra_pointing']*u.deg,
-            gpm_sub_df['dec_pointing']*u.deg,
+            gpm_sub_df['ra_pointing'].values*u.deg,
+            gpm_sub_df['dec_pointing'].values*u.deg,
         )
 
-        g_sub_sky = SkyCoord(
-                    g_sub_df['ra_pointing']*u.deg,
-                    g_sub_df['dec_pointing']*u.deg,
+        idg_sub_sky = SkyCoord(
+                    idg_sub_df['ra_pointing'].values*u.deg,
+                    idg_sub_df['dec_pointing'].values*u.deg,
         )
 
         # Do the match
         match_res = match_coordinates_sky(
             gpm_sub_sky,
-            g_sub_sky,
+            idg_sub_sky,
             nthneighbor=1
         )
 
         gpm_sub_df.columns = [f"{c}_gpm" for c in gpm_sub_df]
-        g_sub_df.columns = [f"{c}_gpm" for c in g_sub_df]
+        idg_sub_df.columns = [f"{c}_idg" for c in idg_sub_df]
 
         join_df = pd.concat(
             [
                 gpm_sub_df.reset_index(drop=True),
-                g_sub_df.iloc[match_res[0]].reset_index(drop=True)
+                idg_sub_df.iloc[match_res[0]].reset_index(drop=True)
             ],
             axis=1
         )
@@ -232,12 +175,12 @@ def associate_metafits_to_gpm(
     results_df = pd.concat(results).reset_index()
     logger.debug(results_df.columns.tolist())
     logger.debug(results_df[[
-            'obs_id_gpm','obs_id_gpm',
-            'lst_deg_wrap_gpm','lst_deg_wrap_gpm',
-            'ra_pointing_gpm','ra_pointing_gpm',
-            'dec_pointing_gpm','dec_pointing_gpm', 
-            'ha_gpm', 'ha_gpm',
-            # 'delays_gpm', 'delays_gpm',
+            'obs_id_gpm','obs_id_idg',
+            'lst_deg_wrap_gpm','lst_deg_wrap_idg',
+            'ra_pointing_gpm','ra_pointing_idg',
+            'dec_pointing_gpm','dec_pointing_idg', 
+            'ha_gpm', 'ha_idg',
+            # 'delays_gpm', 'delays_idg',
             'sep_arcmin']]
     )
 
@@ -249,7 +192,7 @@ def associate_metafits_to_gpm(
         results_df.to_csv(
             out_name,
             sep=' ',
-            columns=['obs_id_gpm','obs_id_gpm'],
+            columns=['obs_id_gpm','obs_id_idg'],
             header=False,
             index=False,
         )
@@ -258,12 +201,12 @@ def associate_metafits_to_gpm(
 
 
 if __name__ == '__main__':
-    parser = ArgumentParser(description='Simple obsid matcher to associate GPM observation with the nearest GPM obsid')
+    parser = ArgumentParser(description='Simple obsid matcher to associate IDG observation with the nearest GPM obsid')
     parser.add_argument('-o', '--out', type=str, default=None, help='Base path name to write to. Hour-angle and fits extension will be applied automatically. ')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Increase level of output')
     parser.add_argument('-gpm-db', type=str, default='146.118.68.233', help='Address to mysql server hosting historic GPM observation data, in GPM style observation schema')
     parser.add_argument('--gpm-obsids', type=str, default=None, help='A new-line delimited collection of obsids to filter the gpm observations against. ')
-    parser.add_argument('--gpm-obsids', type=str, default=None, help='A new-line delimited collection of obsids to filter the gpm observations against. ')
+    parser.add_argument('--idg-obsids', type=str, default=None, help='A new-line delimited collection of obsids to filter the idg observations against. ')
 
     args = parser.parse_args()
 
@@ -277,5 +220,5 @@ if __name__ == '__main__':
         out=args.out,
         gpm_db=args.gpm_db,
         gpm_obsids=args.gpm_obsids,
-        gpm_obsids=args.gpm_obsids
+        idg_obsids=args.idg_obsids
     )
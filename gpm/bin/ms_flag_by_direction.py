@@ -6,8 +6,12 @@ These data ultimately are aimed towards supporting the traveling ionospheric dis
 The measurement set will be divided into one of four directions: north, south, east, west. 
 Antennas that do not belong to some direction are flagged. 
 
-This script does not do any type of iteration over the directions -- a user will specify 
-a metafits file, a measurement set and a direction. 
+Flags are applied for a single direction -- a user will specify a measurement set and a
+direction. With --all, the flags of every direction are derived at once and can be written
+to one flag column per direction (FLAG_NORTH, ...), which --use-column later copies into FLAG,
+so that one copy of the data can be imaged in each direction in turn. The FLAG column as it was
+before any direction columns were written is kept in FLAG_ORIG, from which the direction
+columns are always derived. 
 
 The position listed in the ANTENNA table of the measurement set of interest will be used to derive
 positions, using th known MWA position. 
@@ -30,7 +34,7 @@ from astropy.io import fits
 from astropy.table import Table
 import numpy as np
 from astropy.coordinates import EarthLocation
-from casacore.tables import taql, table
+from casacore.tables import taql, table, default_ms, makecoldesc, maketabdesc
 
 import matplotlib.pyplot as plt
 
@@ -40,6 +44,10 @@ logger.setLevel(logging.INFO)
 
 
 DIRECTIONS = ("north", "south", "east", "west")
+# Default number of visibilities read and written at a time while flagging
+STRIDE = 2**26
+# Column holding the flags from before any direction flag columns were written
+ORIGINAL_FLAG_COLUMN = "FLAG_ORIG"
 MWA = EarthLocation.from_geodetic(
     lat=-26.703319 * u.deg, lon=116.67081 * u.deg, height=377 * u.m
 )
@@ -100,47 +108,64 @@ def create_rotation_matrices(ref0: EarthLocation) -> Tuple[np.ndarray, np.ndarra
 
 def derive_local_tangent_plane(
     geodetic_pos: Iterable[float], ref0: EarthLocation
-) -> Tuple[float,float,float]:
+) -> np.ndarray:
     """Convert the geodetic positions (XYZ) in meters to East-North-Up (ENU)
-    in meters at the supplied reference position. 
+    in meters at the supplied reference position. All positions are converted
+    with a single matrix product.
 
     Args:
-        geodetic_pos (Iterable[float]): A position in the geodetic frame to convert to ENU
+        geodetic_pos (Iterable[float]): Positions in the geodetic frame to convert to ENU, of shape (3,) or (N, 3)
         ref0 (EarthLocation): Reference/origin position of the LTP to produce the ENU positions
 
     Returns:
-        Tuple[float,float,float]: ENU positions 
+        np.ndarray: ENU positions, of the same shape as geodetic_pos
     """
     # any other preprocessing goes here
-    ant_xyz = np.array(geodetic_pos) * u.m
+    ant_xyz = np.asarray(geodetic_pos, dtype=np.float64)
 
     logger.debug(f"Antennas XYZ: {ant_xyz=}")
 
     # get the geodetic position from the EarthLocation
-    ref_xyz = u.Quantity(ref0.geocentric).to(u.m)
+    ref_xyz = u.Quantity(ref0.geocentric).to_value(u.m)
 
     # get the two rotations that depend on the reference/origin
     # of the local tangent plane
     rot1, rot2 = create_rotation_matrices(ref0)
 
-    # and finally apply the rotations to the offset XYZ position
-    ant_enu = rot2 @ rot1 @ (ant_xyz - ref_xyz).value
-    
-    return tuple(ant_enu)
+    # and finally apply the rotations to the offset XYZ positions, which are row vectors
+    return (ant_xyz - ref_xyz) @ (rot2 @ rot1).T
 
-def get_ant_subarray_flags(ant_table: pd.DataFrame, direction: str) -> Iterable[bool]:
-    """Using the ENU positions to derive the appropriate flags to split
-    the array into the desired quadrant sub-array. 
+def add_enu_positions(ant_table: pd.DataFrame, ref0: EarthLocation = MWA) -> pd.DataFrame:
+    """Add the East, North and Height (ENU) positions of every antenna to the ANTENNA table
 
     Args:
-        ant_table (pd.DataFrame): ANTENNA table from a measurement of interest
-        direction (str): Direction of interest, in either 'north', 'south', 'east', 'west'
+        ant_table (pd.DataFrame): ANTENNA table from a measurement set of interest
+        ref0 (EarthLocation, optional): Reference/origin position of the LTP. Defaults to MWA.
 
-    Raises:
-        ValueError: An invalid direction has been supplied
+    Returns:
+        pd.DataFrame: The ANTENNA table, with the East, North and Height columns added
+    """
+    logger.info(f"Using reference position of {ref0.lon} {ref0.lat}")
+
+    # do transformation from XYZ-> ENU
+    enu = derive_local_tangent_plane(np.stack(ant_table['POSITION'].to_numpy()), ref0)
+
+    # and save them to the table
+    ant_table[['East', 'North', 'Height']] = pd.DataFrame(enu, index=ant_table.index)
+
+    logger.debug(ant_table[['POSITION', 'East', 'North']])
+
+    return ant_table
+
+def get_all_subarray_flags(ant_table: pd.DataFrame) -> pd.DataFrame:
+    """Using the ENU positions to derive the flags that split the array into
+    each of the quadrant sub-arrays at once.
+
+    Args:
+        ant_table (pd.DataFrame): ANTENNA table from a measurement of interest, with ENU positions
 
     Returns:
-        Iterable[bool]: Whether an antenna will be flagged (True) or unflagged (False)
+        pd.DataFrame: One column per direction of DIRECTIONS, of whether an antenna will be flagged (True) or unflagged (False)
     """
 
     # From NHW, as described in the GPM survey paper
@@ -149,35 +174,53 @@ def get_ant_subarray_flags(ant_table: pd.DataFrame, direction: str) -> Iterable[
     # ants_west: East < -120 (44 antennas)
     # ants_north: North > 720 (44 antennas)
     # ants_south: North < -70 (43 antennas)
+    flags = pd.DataFrame(
+        {
+            "north": ant_table["North"] <= 720,
+            "south": ant_table["North"] >= -70,
+            "east": ant_table["East"] <= 700,
+            "west": ant_table["East"] >= -120,
+        },
+        index=ant_table.index,
+    )[list(DIRECTIONS)]
 
+    ant_names = ant_table['NAME'].str.lower()
+    rfipole = ant_names.str.contains('rfipole').to_numpy()
+    if np.any(rfipole):
+        logger.info(f"Detected 'rfipole' in antenna table. Flagging. ")
+        flags[rfipole] = True
+
+    return flags
+
+def get_ant_subarray_flags(ant_table: pd.DataFrame, direction: str) -> Iterable[bool]:
+    """Using the ENU positions to derive the appropriate flags to split
+    the array into the desired quadrant sub-array. 
+
+    Args:
+        ant_table (pd.DataFrame): ANTENNA table from a measurement of interest
+        direction (str): Direction of interest, in either 'north', 'south', 'east', 'west'
+
+    Raises:
+        ValueError: An invalid direction has been supplied
+
+    Returns:
+        Iterable[bool]: Whether an antenna will be flagged (True) or unflagged (False)
+    """
     logger.info(f"Flagging for direction {direction}")
 
-    if direction == "east":
-        mask = ant_table["East"] <= 700
-    elif direction == "west":
-        mask = ant_table["East"] >= -120
-    elif direction == "north":
-        mask = ant_table["North"] <= 720
-    elif direction == "south":
-        mask = ant_table["North"] >= -70
-    else:
+    if direction not in DIRECTIONS:
         logger.error(f"Supplied direction {direction} is invalid. ")
         raise ValueError("Invalid direction supplied")
 
+    mask = get_all_subarray_flags(ant_table)[direction]
+
     logger.debug(f"{mask=}")
     logger.debug(f"{np.sum(mask)}")
-    
-    idx_to_flag = np.argwhere(np.array(mask)).squeeze()
-
-    logger.info(f"{len(idx_to_flag)} antennas will be flagged")
 
-    ant_names = ant_table['NAME'].str.lower()
-    if 'rfipole' in ant_names:
-        logger.info(f"Detected 'rfipole' in antenna table. Flagging. ")
-        ant_table.index[ant_names=='rfipol'] = True
+    logger.info(f"{np.sum(mask)} antennas will be flagged")
 
-    assert len(
-        idx_to_flag
+    assert np.sum(
+        mask
     ), f"Fewer than 60 antennas are being flagged. Something likely wrong. "
 
     return mask 
@@ -226,9 +269,67 @@ def plot_layout(ant_table: pd.DataFrame, direction: str, path: Union[str,Path]=N
         fig.tight_layout()
         fig.savefig(path)
     
-def apply_flagging_to_ms(ms: Union[str, Path], idx_to_flag: Iterable[int]) -> None:
+def apply_flagging_to_ms(
+    ms: Union[str, Path], idx_to_flag: Iterable[int], stride: int = STRIDE
+) -> Tuple[int, int]:
     """Given a set of antenna IDs (based on the index position of a ANTENNA table),
-    use taql to flag visibilities
+    flag all visibilities of baselines that include any of them. The main table is
+    read and written in a single pass, a chunk of rows at a time, and the number of
+    newly flagged visibilities is counted in the same pass.
+
+    Args:
+        ms (Union[str,Path]): Measurement set to apply flagging to
+        idx_to_flag (Iterable[int]): Antennas to flag
+        stride (int, optional): Approximate number of visibilities to process at a time. Defaults to STRIDE.
+
+    Returns:
+        Tuple[int, int]: The number of visibilities that were flagged, and the number that remain unflagged
+    """
+    idx_to_flag = np.atleast_1d(np.asarray(idx_to_flag, dtype=int))
+
+    logger.info(f"Flagging {ms}")
+    logger.info(f"Antennas to flag: {idx_to_flag}")
+
+    nflagged = 0
+    nunflagged = 0
+
+    with table(str(ms), readonly=False, ack=False) as tab:
+        nrows = tab.nrows()
+        if nrows == 0:
+            logger.warning(f"{ms} has no rows")
+            return 0, 0
+
+        vis_per_row = int(np.prod(tab.getcell("FLAG", 0).shape))
+        chunk_rows = max(stride // vis_per_row, 1)
+
+        for r0 in range(0, nrows, chunk_rows):
+            n = min(chunk_rows, nrows - r0)
+            selected = np.isin(tab.getcol("ANTENNA1", r0, n), idx_to_flag) | np.isin(
+                tab.getcol("ANTENNA2", r0, n), idx_to_flag
+            )
+            flag = tab.getcol("FLAG", r0, n)
+
+            if np.any(selected):
+                nflagged += int(np.count_nonzero(~flag[selected]))
+                flag[selected] = True
+                tab.putcol("FLAG", flag, r0, n)
+
+                flag_row = tab.getcol("FLAG_ROW", r0, n)
+                flag_row[selected] = True
+                tab.putcol("FLAG_ROW", flag_row, r0, n)
+
+            nunflagged += int(np.count_nonzero(~flag))
+            logger.debug(f"Processed rows {r0}-{r0 + n} of {nrows}")
+
+    logger.info(f"Flagged {nflagged} visibilities")
+    logger.info(f"{nunflagged} visibilities remain unflagged")
+
+    return nflagged, nunflagged
+
+def old_apply_flagging_to_ms(ms: Union[str, Path], idx_to_flag: Iterable[int]) -> None:
+    """Given a set of antenna IDs (based on the index position of a ANTENNA table),
+    use taql to flag visibilities. This is the original approach, which makes two
+    passes over the measurement set per antenna, and is kept for benchmarking.
 
     Args:
         ms (Union[str,Path]): Measurement set to apply flagging to
@@ -247,11 +348,219 @@ def apply_flagging_to_ms(ms: Union[str, Path], idx_to_flag: Iterable[int]) -> No
 
     unflag2 = taql("CALC sum([select nfalse(FLAG) from $ms])")
 
-    logger.info(f"Flagged {int(unflag1 - unflag2)} visibilities")
-    logger.info(f"{int(unflag2)} visibilities remain unflagged")
+    logger.info(f"Flagged {int(np.sum(unflag1 - unflag2))} visibilities")
+    logger.info(f"{int(np.sum(unflag2))} visibilities remain unflagged")
+
+def make_synthetic_ms(
+    ms: Union[str, Path], nant: int = 128, ntimes: int = 4, nchan: int = 32, npol: int = 4
+) -> None:
+    """Create a small measurement set with all baselines (including autocorrelations)
+    of `nant` antennas, unflagged, for benchmarking the flagging
+
+    Args:
+        ms (Union[str,Path]): Path of the measurement set to create
+        nant (int, optional): Number of antennas. Defaults to 128.
+        ntimes (int, optional): Number of timesteps. Defaults to 4.
+        nchan (int, optional): Number of channels. Defaults to 32.
+        npol (int, optional): Number of polarisations. Defaults to 4.
+    """
+    ant1, ant2 = np.triu_indices(nant)
+    ant1 = np.tile(ant1, ntimes).astype(np.int32)
+    ant2 = np.tile(ant2, ntimes).astype(np.int32)
+
+    with default_ms(str(ms)) as tab:
+        tab.addrows(len(ant1))
+        tab.putcol("ANTENNA1", ant1)
+        tab.putcol("ANTENNA2", ant2)
+        tab.putcol("FLAG", np.zeros((len(ant1), nchan, npol), dtype=bool))
+        tab.putcol("FLAG_ROW", np.zeros(len(ant1), dtype=bool))
+
+
+def benchmark_flagging(
+    nant: int = 128, ntimes: int = 4, nchan: int = 32, nflag: int = 85
+) -> None:
+    """Time apply_flagging_to_ms() against old_apply_flagging_to_ms() on a synthetic
+    measurement set, and check that both flag the same visibilities
+
+    Args:
+        nant (int, optional): Number of antennas. Defaults to 128.
+        ntimes (int, optional): Number of timesteps. Defaults to 4.
+        nchan (int, optional): Number of channels. Defaults to 32.
+        nflag (int, optional): Number of antennas to flag. Defaults to 85.
+    """
+    import time
+    import shutil
+    import tempfile
+
+    idx_to_flag = np.random.default_rng(0).choice(nant, size=nflag, replace=False)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        old_ms = os.path.join(tmpdir, "old.ms")
+        new_ms = os.path.join(tmpdir, "new.ms")
+        make_synthetic_ms(old_ms, nant=nant, ntimes=ntimes, nchan=nchan)
+        shutil.copytree(old_ms, new_ms)
+
+        t0 = time.perf_counter()
+        old_apply_flagging_to_ms(old_ms, idx_to_flag)
+        t1 = time.perf_counter()
+        apply_flagging_to_ms(new_ms, idx_to_flag)
+        t2 = time.perf_counter()
+
+        with table(old_ms, ack=False) as old_tab, table(new_ms, ack=False) as new_tab:
+            same = np.array_equal(old_tab.getcol("FLAG"), new_tab.getcol("FLAG")) and np.array_equal(
+                old_tab.getcol("FLAG_ROW"), new_tab.getcol("FLAG_ROW")
+            )
+
+    logger.info(f"Synthetic measurement set: {nant} antennas, {ntimes} timesteps, {nchan} channels, {nflag} antennas flagged")
+    logger.info(f"Per-antenna taql updates: {t1 - t0:.3f} s")
+    logger.info(f"Single pass: {t2 - t1:.3f} s")
+    if not same:
+        raise RuntimeError("The two flagging methods produced different flags")
+    logger.info("Both methods produced identical flags")
+
+
+def make_products(
+    ms: Path, ant_table: pd.DataFrame, direction: str, plot: bool=False, dump_table: bool=False
+) -> None:
+    """Create the layout figure and/or the csv of the ANTENNA table of a single direction,
+    whose flags are in the FLAGGED column of the table
+
+    Args:
+        ms (Path): Path to the measurement set, from which the output names are derived
+        ant_table (pd.DataFrame): ANTENNA table with ENU positions and FLAGGED column
+        direction (str): Direction of interest
+        plot (bool, optional): Create a plot of the MWA layout and which tiles are to be flagged. Defaults to False.
+        dump_table (bool, optional): Save the processed ANTENNA table to a csv. Defaults to False.
+    """
+    if plot:
+        ext = f"_{direction}.png"
+        out_path = f"{Path(str(ms).replace('.ms', ext))}"
+        logger.info(f"Creating {out_path}")
+        plot_layout(
+            ant_table,
+            direction,
+            path=out_path
+        )
+        plt.close("all")
+
+    if dump_table:
+        ext = f"_{direction}_table.csv"
+        out_path = f"{Path(str(ms).replace('.ms', ext))}"
+        logger.info(f"Creating {out_path}")
+        ant_table.to_csv(out_path)
+
+def direction_flag_column(direction: str) -> str:
+    """Name of the column that holds the flags of a direction, e.g. FLAG_NORTH"""
+    return f"FLAG_{direction.upper()}"
+
+def write_direction_flag_columns(
+    ms: Union[str, Path], flags: pd.DataFrame, stride: int = STRIDE
+) -> None:
+    """Write one flag column per direction (see direction_flag_column()) to the measurement set,
+    each holding the original flags combined with the antenna flags of that direction.
+    All columns are written in a single pass over the main table, so that the one copy of the
+    data can be imaged in each direction in turn (see use_direction_flags()).
+
+    The first time this is run, FLAG is copied to ORIGINAL_FLAG_COLUMN. Later runs derive the
+    direction columns from that copy, as FLAG may since have been replaced by the flags of
+    one direction.
+
+    Args:
+        ms (Union[str,Path]): Measurement set to add the flag columns to
+        flags (pd.DataFrame): Antenna flags of each direction, as returned by get_all_subarray_flags()
+        stride (int, optional): Approximate number of visibilities to process at a time. Defaults to STRIDE.
+    """
+    directions = list(flags.columns)
+    ant_flags = {d: np.asarray(flags[d], dtype=bool) for d in directions}
+
+    with table(str(ms), readonly=False, ack=False) as tab:
+        flag_desc = tab.getcoldesc("FLAG")
+        save_original = ORIGINAL_FLAG_COLUMN not in tab.colnames()
+        if save_original:
+            logger.info(f"Saving FLAG of {ms} to {ORIGINAL_FLAG_COLUMN}")
+            tab.addcols(maketabdesc(makecoldesc(ORIGINAL_FLAG_COLUMN, flag_desc)))
+        else:
+            logger.info(f"Deriving the direction flags from {ORIGINAL_FLAG_COLUMN}")
+
+        for d in directions:
+            col = direction_flag_column(d)
+            if col not in tab.colnames():
+                logger.info(f"Adding column {col} to {ms}")
+                tab.addcols(maketabdesc(makecoldesc(col, flag_desc)))
+
+        nrows = tab.nrows()
+        if nrows == 0:
+            return
+
+        vis_per_row = int(np.prod(tab.getcell("FLAG", 0).shape))
+        chunk_rows = max(stride // vis_per_row, 1)
+
+        for r0 in range(0, nrows, chunk_rows):
+            n = min(chunk_rows, nrows - r0)
+            ant1 = tab.getcol("ANTENNA1", r0, n)
+            ant2 = tab.getcol("ANTENNA2", r0, n)
+            if save_original:
+                flag = tab.getcol("FLAG", r0, n)
+                tab.putcol(ORIGINAL_FLAG_COLUMN, flag, r0, n)
+            else:
+                flag = tab.getcol(ORIGINAL_FLAG_COLUMN, r0, n)
+
+            for d in directions:
+                selected = ant_flags[d][ant1] | ant_flags[d][ant2]
+                tab.putcol(direction_flag_column(d), flag | selected[:, None, None], r0, n)
+
+            logger.debug(f"Processed rows {r0}-{r0 + n} of {nrows}")
+
+    logger.info(f"Wrote flag columns {[direction_flag_column(d) for d in directions]} to {ms}")
+
+def use_direction_flags(ms: Union[str, Path], direction: str) -> None:
+    """Replace the FLAG (and FLAG_ROW) column with the flags of a direction,
+    previously written by write_direction_flag_columns()
+
+    Args:
+        ms (Union[str,Path]): Measurement set with the direction flag columns
+        direction (str): Direction of interest
+    """
+    col = direction_flag_column(direction)
+    logger.info(f"Setting FLAG of {ms} from {col}")
+    ms = str(ms)
+    taql(f"UPDATE $ms SET FLAG={col}, FLAG_ROW=all({col})")
+
+def ms_flag_all_directions(
+    ms: Union[str,Path], plot: bool=False, dump_table: bool=False, write_columns: bool=False
+) -> pd.DataFrame:
+    """Derive the antenna flags of all directions from a single parse of the ANTENNA table
+    and ENU conversion, optionally writing them as one flag column per direction.
+
+    Args:
+        ms (Union[str,Path]): Path to a measurement set of interest
+        plot (bool, optional): Create a plot of the MWA layout and flagged tiles of each direction. Defaults to False.
+        dump_table (bool, optional): Save the processed ANTENNA table of each direction to a csv. Defaults to False.
+        write_columns (bool, optional): Write the flag columns of every direction (see write_direction_flag_columns()). Defaults to False.
+
+    Returns:
+        pd.DataFrame: Antenna flags of each direction
+    """
+    ms = Path(ms)
+    if not ms.exists():
+        logger.error(f"{ms} does not exist. Exiting. ")
+        sys.exit(2)
+
+    ant_table = add_enu_positions(parse_antenna_ms(ms))
+    flags = get_all_subarray_flags(ant_table)
+
+    for d in DIRECTIONS:
+        logger.info(f"{np.sum(flags[d])} antennas will be flagged for direction {d}")
+        ant_table['FLAGGED'] = flags[d]
+        make_products(ms, ant_table, d, plot=plot, dump_table=dump_table)
+
+    if write_columns:
+        write_direction_flag_columns(ms, flags)
+
+    return flags
 
 def ms_flag_by_direction(
-    ms: Union[str,Path], direction: str = "north", apply: bool = True, plot: bool=False, dump_table: bool=False
+    ms: Union[str,Path], direction: str = "north", apply: bool = True, plot: bool=False, dump_table: bool=False, old_method: bool=False
 ) -> None:
     """Flag an MWA measurment set of interest into a quadrant. Antennas will be 
     flagged using taql, and flagged antennas are identified by converting the 
@@ -263,6 +572,7 @@ def ms_flag_by_direction(
         apply (bool, optional): Apply the antenna flagging using taql. Defaults to True.
         plot (bool, optional): Create a plot of the MWA layout and which tiles are to be flagged. Defaults to False.
         dump_table (bool, optional): Save the processed ANTENNA table, with ENU positions, to a csv. File name is based on the measurment set name. Defaults to False.
+        old_method (bool, optional): Flag with two taql updates per antenna, rather than a single pass. Defaults to False.
     """
     ms = Path(ms)
     if not ms.exists():
@@ -273,55 +583,31 @@ def ms_flag_by_direction(
         logger.error(f"Direction {direction} is not valid.")
         raise ValueError(f"Direction {direction} not valid. Acceptable values are {DIRECTIONS}.")
 
-    ant_table = parse_antenna_ms(ms)
-
-    logger.info(f"Using reference position of {MWA.lon} {MWA.lat}")
-
-    # do transformation from XYZ-> ENU
-    res = ant_table['POSITION'].apply(
-        derive_local_tangent_plane, 
-        args=(MWA,),
-    )
-
-    # and save them to the table
-    ant_table[['East', 'North', 'Height']] = pd.DataFrame(res.tolist(), index=ant_table.index)
-
-    logger.debug(ant_table[['POSITION', 'East', 'North']])
+    ant_table = add_enu_positions(parse_antenna_ms(ms))
 
     # apply quadrant splitting criteria
     flag_mask = get_ant_subarray_flags(ant_table, direction)
     ant_table['FLAGGED'] = flag_mask
 
     # data products are produced below
-    if plot:
-        ext = f"_{direction}.png"
-        out_path = f"{Path(str(ms).replace('.ms', ext))}"
-        logger.info(f"Creating {out_path}")
-        plot_layout(
-            ant_table,
-            direction,
-            path=out_path
-        )
-
-    if dump_table:
-        ext = f"_{direction}_table.csv"
-        out_path = f"{Path(str(ms).replace('.ms', ext))}"
-        logger.info(f"Creating {out_path}")
-        ant_table.to_csv(out_path)
+    make_products(ms, ant_table, direction, plot=plot, dump_table=dump_table)
 
     # and now apply the flags
     if apply:
         idx_to_flag = np.argwhere(
             np.array(ant_table['FLAGGED'])
         ).squeeze()
-        apply_flagging_to_ms(ms, idx_to_flag)
+        if old_method:
+            old_apply_flagging_to_ms(ms, idx_to_flag)
+        else:
+            apply_flagging_to_ms(ms, idx_to_flag)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(
         description="Flag all antenna that do not correspond to a desired direction. "
     )
-    parser.add_argument("ms", type=str, help="Path to a measurement set to flag")
+    parser.add_argument("ms", type=str, nargs="?", default=None, help="Path to a measurement set to flag")
     
     parser.add_argument(
         "-d",
@@ -359,21 +645,54 @@ if __name__ == "__main__":
         help='Run against all direction. If enable, apply is forced to be False. '
     )
 
+    parser.add_argument(
+        '--write-columns',
+        default=False,
+        action='store_true',
+        help='With --all, write one flag column per direction (e.g. FLAG_NORTH), in a single pass over the measurement set'
+    )
+    parser.add_argument(
+        '--use-column',
+        default=False,
+        action='store_true',
+        help='Set FLAG from the column of --direction previously written with --all --write-columns, rather than flagging antennas'
+    )
+    parser.add_argument(
+        '--old-method',
+        default=False,
+        action='store_true',
+        help='Flag with two taql updates per antenna, as originally done, rather than in a single pass over the measurement set'
+    )
+    parser.add_argument(
+        '--benchmark',
+        default=False,
+        action='store_true',
+        help='Compare the single-pass and original flagging on a small synthetic measurement set, then exit'
+    )
+
     args = parser.parse_args()
 
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
+    if args.benchmark:
+        benchmark_flagging()
+        sys.exit(0)
+
+    if args.ms is None:
+        parser.error("A measurement set is required")
+
     if args.all:
-        for d in DIRECTIONS:
-                # Will never apply the flagging
-                ms_flag_by_direction(
-                    args.ms,
-                    direction=d,
-                    apply=False,
-                    plot=args.products,
-                    dump_table=args.products
-                )
+        # Will never apply the flagging to the FLAG column
+        ms_flag_all_directions(
+            args.ms,
+            plot=args.products,
+            dump_table=args.products,
+            write_columns=args.write_columns
+        )
+
+    elif args.use_column:
+        use_direction_flags(args.ms, args.direction)
 
     else:
         ms_flag_by_direction(
@@ -381,5 +700,6 @@ if __name__ == "__main__":
             direction=args.direction,
             apply=args.apply,
             plot=args.products,
-            dump_table=args.products
+            dump_table=args.products,
+            old_method=args.old_method
         )
@@ -4,6 +4,8 @@ from __future__ import print_function
 
 import copy, os, shutil, glob, sys, string, re, types
 import math
+import json
+import shlex
 from astropy.io import fits
 
 yes=0
@@ -192,17 +194,111 @@ def getcardmatches(hdr, template):
     return matchedcards
 
     
+######################################################################
+def pyhead_query(filelist, keylist, doparse=1):
+    """ gets the values of many keywords/expressions from many files,
+    opening each file only once
+    returns a list of (file, extn, {keyword: value}) in the order of filelist
+    keywords with wildcards (*,?) are expanded to all matching cards
+    missing keywords have the value None
+    """
+
+    results=[]
+    for file in filelist:
+        file,extn=splitextn(file)
+        values={}
+        try:
+            with fits.open(file) as inf:
+                hdr=inf[extn].header
+                for key in keylist:
+                    if (key.count("$") == 0 and (key.count("*") > 0 or key.count("?") > 0)):
+                        for card in getcardmatches(hdr,key):
+                            values[card]=hdr.get(card)
+                    elif (key.count("$") > 0 and doparse):
+                        values[key]=evalhdr(hdr,key)
+                    else:
+                        values[key]=hdr.get(key)
+        except Exception as e:
+            print("Could not open file {0}: {1}".format(file,e), file=sys.stderr)
+            values=None
+        results.append((file,extn,values))
+    return results
+######################################################################
+def shellname(key):
+    """ converts a keyword/expression into a valid shell variable name
+    """
+
+    name=re.sub("[^A-Za-z0-9_]","_",key)
+    if (re.match("[0-9]",name)):
+        name="_" + name
+    return name
+######################################################################
+def format_shell(results):
+    """ formats the output of pyhead_query as shell assignments, suitable for
+    eval "$(pyhead.py -s -p KEY1 -p KEY2 file)"
+    with a single file, KEY1=value; with many files, KEY1[i]=value where
+    i is the position of the file on the command line (a bash array)
+    """
+
+    lines=[]
+    for i in range(0,len(results)):
+        file,extn,values=results[i]
+        if (values is None):
+            continue
+        for key,val in values.items():
+            if (val is None):
+                val=""
+            name=shellname(key)
+            if (len(results)>1):
+                name="%s[%d]" % (name,i)
+            lines.append("%s=%s" % (name,shlex.quote(str(val))))
+    return "\n".join(lines)
+######################################################################
+def format_json(results):
+    """ formats the output of pyhead_query as JSON,
+    {file: {keyword: value}}, with file[extn] for extensions other than 0
+    """
+
+    out={}
+    for file,extn,values in results:
+        if (extn != 0):
+            file="%s[%s]" % (file,extn)
+        if (values is not None):
+            values={key: (val if isinstance(val,(bool,int,float,str)) or val is None else str(val))
+                    for key,val in values.items()}
+        out[file]=values
+    return json.dumps(out,indent=1)
+######################################################################
+def splitextn(file):
+    """ splits file[extn] into the file and extension
+    """
+
+    if (file.find("[") > -1):
+        i1=file.find("[")
+        i2=file.find("]")
+        ext=file[i1+1:i2]
+        file=file[0:i1]
+        try:
+            ext=int(ext)
+        except:
+            pass
+    else:
+        ext=0
+    return file,ext
 ######################################################################
 def usage():
     (xdir,xname)=os.path.split(sys.argv[0])
 
-    print("Usage:  {0} [-p keyword/expression] [-d keyword] [-u/-a keyword value/expression]  [-H value/expression] [-f <command_filename>] [-i] <filename(s)>".format(xname))
+    print("Usage:  {0} [-p keyword/expression] [-d keyword] [-u/-a keyword value/expression]  [-H value/expression] [-f <command_filename>] [-i] [-s|-j] <filename(s)>".format(xname))
     print("\t-p will print the value of the keyword")
     print("\t-d will delete the keyword")
     print("\t-u will update the keyword")
     print("\t-a will add a keyword")
     print("\t-H will add to the history")
     print("\t-i will force ignoring of possible variables")
+    print("\t-s will print all keywords of all files at once as shell assignments (KEY=value, or KEY[i]=value for many files)")
+    print("\t   e.g. eval \"$({0} -s -p CENTCHAN -p RA -p DEC obs.metafits)\"".format(xname))
+    print("\t-j will print all keywords of all files at once as JSON")
     print("\tcommands can also be included in <command_filename>, without -s")
     print("\tenclose expressions in single quotes")
     print("\tkeywords to print can have wildcards (*,?)")
@@ -224,6 +320,7 @@ def main():
     i=1
     update=0
     doparse=1
+    query=None
     while (i<len(sys.argv)):
         arg=sys.argv[i]
         isarg=0
@@ -248,6 +345,14 @@ def main():
             i+=1
             isarg=1
             update+=1
+        if (arg.startswith("-s")):
+            # print all keywords at once as shell assignments
+            query='shell'
+            isarg=1
+        if (arg.startswith("-j")):
+            # print all keywords at once as JSON
+            query='json'
+            isarg=1
         if (arg.startswith("-i")):
             # ignore parsing
             doparse=0
@@ -298,15 +403,22 @@ def main():
     if (len(cmdlist)==0 and len(filelist)>0):
         cmdlist.append('p')
         arglist.append("*")
-    
-    for file in filelist:
-        if (file.find("[") > -1):
-            i1=file.find("[")
-            i2=file.find("]")
-            ext=file[i1+1:i2]
-            file=file[0:i1]
+
+    if (query is not None):
+        if (len([cmd for cmd in cmdlist if cmd.lower() != 'p']) > 0):
+            print("Only -p can be used with -s or -j", file=sys.stderr)
+            sys.exit(1)
+        results=pyhead_query(filelist, arglist, doparse=doparse)
+        if (query == 'json'):
+            print(format_json(results))
         else:
-            ext=0
+            print(format_shell(results))
+        if (len([r for r in results if r[2] is None]) > 0):
+            sys.exit(1)
+        return
+
+    for file in filelist:
+        file,ext=splitextn(file)
             
         pyhead(file, ext, cmdlist, arglist, 1, len(filelist)>1, ext != 0, update,doparse=doparse)
 
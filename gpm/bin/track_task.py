@@ -10,6 +10,8 @@ if "GPMTRACK" not in os.environ.keys() or os.environ["GPMTRACK"] != "track":
     print("Task process tracking is disabled. ")
     sys.exit(0)
 
+# Statements are run on a single connection per process, and spooled locally
+# (to be run later) if the database cannot be reached, see gpm.db.mysql_db
 import gpm.db.mysql_db as mdb
 
 # This is the list of acceptable observation status' that are 'hard coded' in the
@@ -18,6 +20,39 @@ OBS_STATUS = ["unprocessed", "downloaded", "calibrated", "imaged", "archived", "
 
 # Bit of record keeping for potential future use / sanity
 BATCH_OBS_IDS_TASKS = ["queue_mosaic", "start_mosaic", "finish_mosaic"]
+# Directives that accept many task ids (e.g. every task of an array job) and
+# update them all in a single statement
+BATCH_TASK_IDS_TASKS = ["queue", "start", "finish", "fail", "start_mosaic", "finish_mosaic", "fail_mosaic"]
+
+
+def as_list(ids):
+    """A single id, or a collection of ids, as a list"""
+    if isinstance(ids, (list, tuple, set)):
+        return list(ids)
+    return [ids]
+
+
+def update_tasks(table, status, time_column, time, job_id, task_id, host_cluster):
+    """Set the status and time of many tasks of a job with one set-based UPDATE
+
+    Args:
+        table (str): Either processing or mosaic
+        status (str): The new status
+        time_column (str): Either start_time or end_time
+        time (int): The time to set
+        job_id (int): Job id from slurm
+        task_id (int or list[int]): Task id(s) from slurm
+        host_cluster (str): Cluster the job runs on
+    """
+    task_ids = as_list(task_id)
+    mdb.execute(
+        """UPDATE {0}
+                   SET status=%s, {1}=%s
+                   WHERE job_id=%s AND task_id IN ({2}) AND host_cluster=%s""".format(
+            table, time_column, ", ".join(["%s"] * len(task_ids))
+        ),
+        (status, time, job_id, *task_ids, host_cluster),
+    )
 
 
 def queue_job(
@@ -32,69 +67,45 @@ def queue_job(
     stdout,
     task,
 ):
-    conn = mdb.connect()
-    cur = conn.cursor()
-    cur.execute(
+    """Creates a new item in the `processing` table for each task id, with a single
+    executemany() (which mysql.connector sends as one multi-row INSERT)
+    """
+    mdb.execute(
         """
                 INSERT INTO processing
                 (job_id, task_id, host_cluster, submission_time, obs_id, user, batch_file, stderr, stdout, task, status)
                 VALUES 
                 ( %s,%s,%s,%s,%s,%s,%s,%s,%s, %s, 'queued')
                 """,
-        (
-            job_id,
-            task_id,
-            host_cluster,
-            submission_time,
-            obs_id,
-            user,
-            batch_file,
-            stderr,
-            stdout,
-            task,
-        ),
+        [
+            (
+                job_id,
+                tid,
+                host_cluster,
+                submission_time,
+                obs_id,
+                user,
+                batch_file,
+                stderr,
+                stdout,
+                task,
+            )
+            for tid in as_list(task_id)
+        ],
+        many=True,
     )
-    conn.commit()
-    conn.close()
 
 
 def start_job(job_id, task_id, host_cluster, start_time):
-    conn = mdb.connect()
-    cur = conn.cursor()
-    cur.execute(
-        """UPDATE processing 
-                   SET status='started', start_time=%s 
-                   WHERE job_id =%s AND task_id=%s and host_cluster=%s""",
-        (start_time, job_id, task_id, host_cluster),
-    )
-    conn.commit()
-    conn.close()
+    update_tasks("processing", "started", "start_time", start_time, job_id, task_id, host_cluster)
 
 
 def finish_job(job_id, task_id, host_cluster, end_time):
-    conn = mdb.connect()
-    cur = conn.cursor()
-    cur.execute(
-        """UPDATE processing 
-                   SET status='finished', end_time=%s 
-                   WHERE job_id =%s AND task_id=%s and host_cluster=%s""",
-        (end_time, job_id, task_id, host_cluster),
-    )
-    conn.commit()
-    conn.close()
+    update_tasks("processing", "finished", "end_time", end_time, job_id, task_id, host_cluster)
 
 
 def fail_job(job_id, task_id, host_cluster, time):
-    conn = mdb.connect()
-    cur = conn.cursor()
-    cur.execute(
-        """UPDATE processing 
-                   SET status='failed', end_time=%s 
-                   WHERE job_id =%s AND task_id=%s and host_cluster=%s""",
-        (time, job_id, task_id, host_cluster),
-    )
-    conn.commit()
-    conn.close()
+    update_tasks("processing", "failed", "end_time", time, job_id, task_id, host_cluster)
 
 
 def observation_status(obs_id, status):
@@ -104,9 +115,7 @@ def observation_status(obs_id, status):
         obs_id (int): observation id to update the status of
         status (str): the status to insert for the observation 
     """
-    conn = mdb.connect()
-    cur = conn.cursor()
-    cur.execute(
+    mdb.execute(
         """
                 UPDATE observation 
                 SET status=%s 
@@ -114,8 +123,6 @@ def observation_status(obs_id, status):
                 """,
         (status.lower(), obs_id,),
     )
-    conn.commit()
-    conn.close()
 
 
 def observation_calibrator_id(obs_id, cal_id):
@@ -126,9 +133,7 @@ def observation_calibrator_id(obs_id, cal_id):
         cali_id (int): observation id of the calibrator to insert  
         value (str):  
     """
-    conn = mdb.connect()
-    cur = conn.cursor()
-    cur.execute(
+    mdb.execute(
         """
                 UPDATE observation 
                 SET cal_obs_id=%s 
@@ -136,27 +141,23 @@ def observation_calibrator_id(obs_id, cal_id):
                 """,
         (cal_id, obs_id,),
     )
-    conn.commit()
-    conn.close()
 
 
 def queue_mosaic(
     batch_obs_ids, job_id, task_id, host_cluster, submission_time, user, subband
 ):
     """Creates a new item in the `mosaic` table to signify that a new batch
-    of `obs_ids` are being `swarp`ed together
+    of `obs_ids` are being `swarp`ed together. All the rows are inserted with
+    a single executemany() (which mysql.connector sends as one multi-row INSERT)
     """
-    conn = mdb.connect()
-    cur = conn.cursor()
-
-    for obs_id in batch_obs_ids:
-        cur.execute(
-            """ 
-                    INSERT INTO mosaic
-                    (obs_id, job_id, task_id, host_cluster, submission_time, user, subband, status)
-                    VALUES
-                    (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
+    mdb.execute(
+        """ 
+                INSERT INTO mosaic
+                (obs_id, job_id, task_id, host_cluster, submission_time, user, subband, status)
+                VALUES
+                (%s, %s, %s, %s, %s, %s, %s, %s)
+                """,
+        [
             (
                 obs_id,
                 job_id,
@@ -166,68 +167,29 @@ def queue_mosaic(
                 user,
                 subband,
                 "queued",
-            ),
-        )
-
-    conn.commit()
-    conn.close()
+            )
+            for obs_id in batch_obs_ids
+        ],
+        many=True,
+    )
 
 
 def start_mosaic(job_id, task_id, host_cluster, start_time):
     """Update all rows that form a `mos_id` job that their mosaic operation has started
     """
-    conn = mdb.connect()
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-                UPDATE mosaic
-                SET status='started', start_time=%s
-                WHERE job_id=%s AND task_id=%s AND host_cluster=%s
-                """,
-        (start_time, job_id, task_id, host_cluster),
-    )
-
-    conn.commit()
-    conn.close()
+    update_tasks("mosaic", "started", "start_time", start_time, job_id, task_id, host_cluster)
 
 
 def finish_mosaic(job_id, task_id, host_cluster, end_time):
     """Update all rows that form a `mos_id` job that their mosaic operation has started
     """
-    conn = mdb.connect()
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-                UPDATE mosaic
-                SET status='finished', end_time=%s
-                WHERE job_id=%s AND task_id=%s AND host_cluster=%s
-                """,
-        (end_time, job_id, task_id, host_cluster),
-    )
-
-    conn.commit()
-    conn.close()
+    update_tasks("mosaic", "finished", "end_time", end_time, job_id, task_id, host_cluster)
 
 
 def fail_mosaic(job_id, task_id, host_cluster, end_time):
     """Update all rows that form a `mos_id` job that their mosaic operation has failed
     """
-    conn = mdb.connect()
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-                UPDATE mosaic
-                SET status='failed', end_time=%s
-                WHERE job_id=%s AND task_id=%s AND host_cluster=%s
-                """,
-        (end_time, job_id, task_id, host_cluster),
-    )
-
-    conn.commit()
-    conn.close()
+    update_tasks("mosaic", "failed", "end_time", end_time, job_id, task_id, host_cluster)
 
 
 def require(args, reqlist):
@@ -266,7 +228,15 @@ if __name__ == "__main__":
     ps = argparse.ArgumentParser(description="track tasks")
     ps.add_argument("directive", type=str, help="Directive", default=None)
     ps.add_argument("--jobid", type=int, help="Job id from slurm", default=None)
-    ps.add_argument("--taskid", type=int, help="Task id from slurm", default=None)
+    ps.add_argument(
+        "--taskid",
+        type=int,
+        nargs="+",
+        help="Task id from slurm. Many may be given for {0} directives".format(
+            BATCH_TASK_IDS_TASKS
+        ),
+        default=None,
+    )
     ps.add_argument("--task", type=str, help="task being run", default=None)
     ps.add_argument("--submission_time", type=int, help="submission time", default=None)
     ps.add_argument("--start_time", type=int, help="job start time", default=None)
@@ -367,10 +337,13 @@ if __name__ == "__main__":
                 "subband",
             ],
         )
+        if len(args.taskid) > 1:
+            print("Directive queue_mosaic accepts a single taskid")
+            sys.exit(1)
         queue_mosaic(
             args.batch_obs_ids,
             args.jobid,
-            args.taskid,
+            args.taskid[0],
             args.host_cluster,
             args.submission_time,
             args.user,
@@ -389,8 +362,14 @@ if __name__ == "__main__":
         require(args, ["jobid", "taskid", "host_cluster", "finish_time"])
         fail_mosaic(args.jobid, args.taskid, args.host_cluster, args.finish_time)
 
+    elif args.directive.lower() == "flush_spool":
+        # Run any statements that were spooled while the database was unreachable
+        mdb.flush_spool()
+
     else:
         print(
             "I don't know what you are asking; please include a queue/start/finish/fail directive"
         )
 
+    mdb.close()
+
@@ -2,10 +2,13 @@
 
 import os
 import numpy as np
+import h5py
+from multiprocessing import Pool
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.coordinates import SkyCoord
 from astropy.time import Time
+from astropy.table import Table
 from astropy.wcs.utils import skycoord_to_pixel
 import astropy.units as u
 import argparse
@@ -15,6 +18,8 @@ import mysql.connector as mysql
 import matplotlib.pyplot as plt
 
 from transient_search import *
+from gpm.utils.local_stats import sigma_clipped_std
+from gpm.bin.extract_lightcurves import load_sources
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
@@ -45,10 +50,7 @@ def gpmdb_connect():
     return db_con
 
 
-def sc(data):
-    std = np.nanstd(data)
-    std = np.nanstd(data[np.abs(data) < 3*std])
-    return std
+sc = sigma_clipped_std
 
 def main(transient_cube_dir, obsid, coord, output_path=None):
     # Open the transient cube
@@ -74,35 +76,201 @@ def main(transient_cube_dir, obsid, coord, output_path=None):
     plt.savefig(output_path)
 
     output_txt = output_path[:-4] + ".txt"
-    print("---WARNING!!!---\nTimestep assumed to be 4 seconds\n----------------")
-    dt = 4 # seconds per timestep. WARNING WARNING HARDCODED VALUE
-    t = timesteps*dt + int(obsid)
+    t = cube_times(path.format(obsid, "transient.hdf5"))[:len(values)]
     np.savetxt(output_txt, np.stack((t, values, np.full(values.shape, obs.rms))).T, fmt="%d %.18e %.18e")
 
+
+def cube_times(hdf5_file):
+    """The start time (GPS seconds) of each timestep of a transient cube, taken
+    from the DATE-OBS of the individual images (the 'timestamp' dataset)"""
+    with h5py.File(hdf5_file, "r") as h5:
+        timestamps = [t.decode("utf-8") for t in h5["timestamp"][:]]
+
+    return Time(timestamps, format="isot", scale="utc").gps
+
+
+def cube_wcs(h5):
+    """The celestial WCS of a transient cube, from the FITS header stored as
+    attributes of its 'header' dataset"""
+    header = fits.Header()
+    for key, item in h5["header"].attrs.items():
+        header[key] = item
+
+    return WCS(header, naxis=2)
+
+
+def extract_cube_timeseries(hdf5_file, coords, suffix="image", nclip=3):
+    """Pixel time series towards many positions from a single transient cube.
+
+    Only the chunks (stamps) containing the requested pixels are read, one read
+    per chunk, however many sources fall in it. The rms at each timestep is the
+    clipped std of the stamp the source lies in.
+
+    Args:
+        hdf5_file (str): Path to the transient cube (as made by make_imstack.py)
+        coords (SkyCoord): Positions of the sources
+        suffix (str, optional): The dataset to read. Defaults to "image".
+        nclip (float, optional): Clipping threshold used for the rms. Defaults to 3.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The times (GPS seconds, ntimes), and the values and rms (nsources x ntimes, NaN for sources outside the cube)
+    """
+    with h5py.File(hdf5_file, "r") as h5:
+        dataset = h5[suffix]
+        # Shape is (pol, y, x, channel, time), chunked in (y, x) stamps
+        _, ny, nx, _, nt = dataset.shape
+        _, sy, sx, _, _ = dataset.chunks or (1, ny, nx, 1, nt)
+
+        timestamps = [t.decode("utf-8") for t in h5["timestamp"][:]]
+        times = Time(timestamps, format="isot", scale="utc").gps
+
+        x, y = skycoord_to_pixel(coords, cube_wcs(h5))
+        x = np.round(np.atleast_1d(x)).astype(int)
+        y = np.round(np.atleast_1d(y)).astype(int)
+        inside = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+
+        values = np.full((len(x), nt), np.nan)
+        rms = np.full((len(x), nt), np.nan)
+
+        stamps = {}
+        for i in np.where(inside)[0]:
+            stamps.setdefault((y[i]//sy, x[i]//sx), []).append(i)
+
+        for (cy, cx), idxs in stamps.items():
+            y0, x0 = cy*sy, cx*sx
+            stamp = dataset[0, y0:min(y0+sy, ny), x0:min(x0+sx, nx), 0, :].astype(np.float64)
+            stamp_rms = sigma_clipped_std(stamp, nclip=nclip, axis=(0, 1))
+            for i in idxs:
+                values[i] = stamp[y[i]-y0, x[i]-x0]
+                rms[i] = stamp_rms
+
+    return times, values, rms
+
+
+def batch_timeseries(transient_cube_dir, obsids, names, coords, suffix="image"):
+    """Extract the time series towards many sources from the transient cubes of
+    many observations into a single table, with one row per (obsid, source, timestep)
+
+    Args:
+        transient_cube_dir (str): Directory containing the [obsid]_transient.hdf5 cubes
+        obsids (list[int]): The observations to process
+        names (list[str]): Names of the sources
+        coords (SkyCoord): Coordinates of the sources
+        suffix (str, optional): The dataset to read. Defaults to "image".
+
+    Returns:
+        astropy.table.Table: The time series of every source that lies in each cube
+    """
+    names = np.asarray(names)
+    columns = {key: [] for key in ("obs_id", "source", "timestep", "gps_time", "flux_Jy", "rms_Jy")}
+
+    for obsid in obsids:
+        hdf5_file = os.path.join(transient_cube_dir, f"{obsid}_transient.hdf5")
+        if not os.path.exists(hdf5_file):
+            logger.warning(f"{hdf5_file} not found, skipping")
+            continue
+
+        times, values, rms = extract_cube_timeseries(hdf5_file, coords, suffix=suffix)
+        found = np.where(np.any(np.isfinite(values), axis=1))[0]
+        logger.info(f"{obsid}: {len(found)} of {len(names)} sources in the cube")
+
+        nt = len(times)
+        columns["obs_id"].append(np.full(len(found)*nt, int(obsid)))
+        columns["source"].append(np.repeat(names[found], nt))
+        columns["timestep"].append(np.tile(np.arange(nt), len(found)))
+        columns["gps_time"].append(np.tile(times, len(found)))
+        columns["flux_Jy"].append(values[found].ravel())
+        columns["rms_Jy"].append(rms[found].ravel())
+
+    if len(columns["obs_id"]) == 0:
+        return Table(names=tuple(columns), dtype=(int, str, int, float, float, float))
+
+    return Table({key: np.concatenate(column) for key, column in columns.items()})
+
+
+def plot_timeseries(obsid, source, times, values, rms, output_path):
+    """Plot one source's time series from one observation"""
+    fig, ax = plt.subplots()
+    ax.errorbar(times - times[0], values, yerr=rms, fmt='o-')
+    ax.set_xlabel(f"Time since GPS {times[0]:.0f} (s)")
+    ax.set_ylabel("Flux density (Jy)")
+    ax.set_title(f"ObsID: {obsid}, Source: {source}")
+
+    fig.tight_layout()
+    fig.savefig(output_path)
+    plt.close(fig)
+
+
+def _plot_timeseries(args):
+    plot_timeseries(*args)
+
+
+def plot_table(table, nprocs=1):
+    """Make one plot per (obsid, source) from the output of batch_timeseries(), in parallel"""
+    jobs = []
+    for group in table.group_by(["obs_id", "source"]).groups:
+        obsid, source = group["obs_id"][0], group["source"][0]
+        output_path = f"{obsid}_{source.replace(' ', '_')}.png"
+        jobs.append((obsid, source, np.array(group["gps_time"]), np.array(group["flux_Jy"]), np.array(group["rms_Jy"]), output_path))
+
+    with Pool(nprocs) as pool:
+        pool.map(_plot_timeseries, jobs)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pull out the value of an image at the specified coordinates")
     parser.add_argument("transient_cube_dir", help="The (absolute!) directory containing the transient cube to open")
-    parser.add_argument("obsid", help="The ObsID (GPS seconds)")
-    parser.add_argument("source", help="The source name (which must exist in the database) to use for coordinates")
+    parser.add_argument("obsid", nargs="?", default=None, help="The ObsID (GPS seconds)")
+    parser.add_argument("source", nargs="?", default=None, help="The source name (which must exist in the database) to use for coordinates")
     #parser.add_argument("--error_ctr_coords", help="The coords (in 'HH:MM:SS.S_DD:MM:SS.S' format) for the centre of a region used to calculate the rms error. Default: same as COORDS")
+    batch_group = parser.add_argument_group("batch mode", "Extract many sources from many cubes into a single table")
+    batch_group.add_argument("--obsid_list", default=None, help="A file containing the ObsIDs to process, one per line")
+    batch_group.add_argument("--sources", nargs="+", default=None, help="The source names (which must exist in the database) to use for coordinates")
+    batch_group.add_argument("--all_sources", action="store_true", help="Use all sources in the database")
+    batch_group.add_argument("--output", default="transient_timeseries.fits", help="The output table (format determined by the extension, e.g. .csv, .fits). Default: transient_timeseries.fits")
+    batch_group.add_argument("--plot", action="store_true", help="Also make one plot per ObsID and source")
+    batch_group.add_argument("--nprocs", default=1, type=int, help="Number of processes used to make the plots. Default: 1")
     args = parser.parse_args()
 
+    batch = args.obsid_list is not None or args.sources is not None or args.all_sources
+    if not batch and (args.obsid is None or args.source is None):
+        parser.error("Either an obsid and source, or the batch mode options, must be given")
+
     # Connect to the database
     conn = gpmdb_connect()
     cur = conn.cursor()
 
-    # Get the source coordinates for the named source from the database
-    cur.execute("SELECT raj2000, decj2000 FROM source WHERE name = %s", (args.source,))
+    if batch:
+        obsids = [] if args.obsid is None else [int(args.obsid)]
+        if args.obsid_list is not None:
+            obsids += [int(o) for o in np.loadtxt(args.obsid_list, ndmin=1)]
+        if len(obsids) == 0:
+            parser.error("No ObsIDs supplied")
+
+        source_names = args.sources
+        if args.source is not None:
+            source_names = [args.source] + (source_names or [])
+        ids, names, coords = load_sources(cur, names=None if args.all_sources else source_names)
+
+        table = batch_timeseries(args.transient_cube_dir, obsids, names, coords)
+        table.write(args.output, overwrite=True)
+        logger.info(f"Wrote {len(table)} rows to {args.output}")
+
+        if args.plot:
+            plot_table(table, nprocs=args.nprocs)
+
+    else:
+        # Get the source coordinates for the named source from the database
+        cur.execute("SELECT raj2000, decj2000 FROM source WHERE name = %s", (args.source,))
 
-    res = cur.fetchone()
-    if not res or len(res) == 0:
-        raise Exception(f"No source with was found with the name \"{args.source}\"")
-    ra, dec = res
+        res = cur.fetchone()
+        if not res or len(res) == 0:
+            raise Exception(f"No source with was found with the name \"{args.source}\"")
+        ra, dec = res
 
-    coord = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="fk5")
+        coord = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="fk5")
 
-    # Start main
-    main(args.transient_cube_dir, args.obsid, coord, output_path=f"{args.obsid}_{args.source.replace(' ', '_')}.png")
+        # Start main
+        main(args.transient_cube_dir, args.obsid, coord, output_path=f"{args.obsid}_{args.source.replace(' ', '_')}.png")
 
     # Disconnect from the database
     conn.close()
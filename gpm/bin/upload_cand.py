@@ -7,13 +7,20 @@ import argparse
 import urllib.request
 import requests
 import json
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from astropy.coordinates import Angle
 import astropy.units as u
 from astropy.io import fits
 
 import logging
 
+from gpm.utils import metadata_cache
+from gpm.utils.sky_index import format_sexagesimal
+
 __version__ = "1.1"
 __date__ = "2024-09-11"
 __author__ = ["Nick Swainston", "Paul Hancock"]
@@ -27,6 +34,15 @@ if SYSTEM_ENV == "DEVELOPMENT":
 else:
     BASE_URL = "http://mwa-image-plane.duckdns.org"
 
+# Number of concurrent uploads
+UPLOAD_THREADS = 4
+# Number of times a failed request is retried, with exponential back-off
+RETRIES = 3
+BACKOFF = 1.0
+
+# Observations already uploaded by this process
+_uploaded_obsids = set()
+
 
 class TokenAuth(requests.auth.AuthBase):
     def __init__(self, token):
@@ -37,6 +53,36 @@ class TokenAuth(requests.auth.AuthBase):
         return r
 
 
+def make_session(nthreads=UPLOAD_THREADS, retries=RETRIES, backoff=BACKOFF):
+    """A session authenticated with IMAGE_PLANE_TOKEN, whose connection pool is
+    sized for `nthreads` concurrent requests. Requests that could not connect are
+    retried. Server errors and lost responses are only retried for idempotent
+    methods, so that a POST the server may already have committed is not repeated.
+
+    Parameters
+    ----------
+    nthreads : `int`, optional
+        Number of threads that will share the session. Default: UPLOAD_THREADS.
+    retries : `int`, optional
+        Number of times a request is retried. Default: RETRIES.
+    backoff : `float`, optional
+        Back-off factor between retries, in seconds. Default: BACKOFF.
+    """
+    session = requests.session()
+    session.auth = TokenAuth(os.environ["IMAGE_PLANE_TOKEN"])
+    # The default allowed_methods excludes POST from read and status retries
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=nthreads, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def getmeta(servicetype="metadata", service="obs", params=None):
     """
     Function to call a JSON web service and return a dictionary:
@@ -70,19 +116,22 @@ def getmeta(servicetype="metadata", service="obs", params=None):
     return result
 
 
-def upload_obsid(obsid):
+def upload_obsid(obsid, session=None):
     """Upload an MWA observation to the database.
 
     Parameters
     ----------
     obsid : `int`
         MWA observation ID.
+    session : `requests.Session`, optional
+        Session to upload with. Default: a new session from make_session().
     """
-    data = getmeta(params={"obsid": obsid})
+    # The metadata is cached locally, so is only fetched once per obsid
+    data = metadata_cache.get_json(obsid, service="obs")
 
     # Upload
-    session = requests.session()
-    session.auth = TokenAuth(os.environ["IMAGE_PLANE_TOKEN"])
+    if session is None:
+        session = make_session()
     url = f"{BASE_URL}/observation_create/"
     data = {
         "observation_id": obsid,
@@ -110,12 +159,127 @@ def upload_obsid(obsid):
         "freq_res": data["freq_res"],
         "int_time": data["int_time"],
     }
-    # r = session.post(url, data=data)
-    session.post(url, data=data)
+    r = session.post(url, data=data)
+    logger.debug(f"observation_create {obsid}: {r.status_code}")
 
 
-def upload_candidate(fits_files, image_gif_directory):
-    """Upload an MWA observation to the database.
+def upload_obsids(obsids, session=None, nthreads=UPLOAD_THREADS):
+    """Upload many MWA observations to the database, concurrently. Each
+    observation is only uploaded once per process.
+
+    Parameters
+    ----------
+    obsids : `list`
+        MWA observation IDs, which may be repeated.
+    session : `requests.Session`, optional
+        Session to upload with. Default: a new session from make_session().
+    nthreads : `int`, optional
+        Number of concurrent uploads. Default: UPLOAD_THREADS.
+    """
+    new_obsids = sorted(set(int(o) for o in obsids) - _uploaded_obsids)
+    if len(new_obsids) == 0:
+        return
+
+    if session is None:
+        session = make_session(nthreads=nthreads)
+
+    logger.info(f"Uploading {len(new_obsids)} observations")
+    with ThreadPool(max(1, min(nthreads, len(new_obsids)))) as pool:
+        pool.map(lambda obsid: upload_obsid(obsid, session=session), new_obsids)
+    _uploaded_obsids.update(new_obsids)
+
+
+def serialise_candidates(table):
+    """Convert a table of candidates, column by column, to the fields posted to
+    candidate_create. Every value is formatted as a string, as it would be in a
+    form, and RA/Dec columns gain sexagesimal (hms/dms) companions.
+
+    Parameters
+    ----------
+    table : `astropy.io.fits.FITS_rec`
+        The candidates.
+
+    Returns
+    -------
+    columns : `dict`
+        An array of strings per field, in the order of the table columns.
+    """
+    columns = {}
+    for name in table.columns.names:
+        col = np.asarray(table[name])
+        if name == "obs_cent_freq":
+            # Skip because already have that data in obsid
+            continue
+        elif name in ["obs_id", "observation_id"]:
+            # the observation is uploaded by upload_obsids()
+            columns["obs_id"] = col.astype(str)
+        elif name.endswith("ra_deg"):
+            # parse to hms
+            columns[name] = col.astype(str)
+            hms = format_sexagesimal(Angle(col, unit=u.deg).hourangle)
+            columns[name[:-3] + "hms"] = hms.astype("U11")
+        elif name.endswith("dec_deg"):
+            # parse to dms
+            columns[name] = col.astype(str)
+            dms = format_sexagesimal(Angle(col, unit=u.deg).degree)
+            columns[name[:-3] + "dms"] = dms.astype("U12")
+        else:
+            columns[name] = col.astype(str)
+
+    return columns
+
+
+def read_candidates(fits_path, image_gif_directory):
+    """The candidates of a fits table, as they are posted to candidate_create
+
+    Parameters
+    ----------
+    fits_path : `str`
+        The fits file of candidates.
+    image_gif_directory : `str`
+        The directory containing all the images and gifs.
+
+    Returns
+    -------
+    candidates : `list`
+        A (data, image_path, gif_path) tuple per candidate.
+    """
+    with fits.open(fits_path) as hdul:
+        table = hdul[1].data
+        columns = serialise_candidates(table)
+
+        # Work out image and gif paths
+        base_paths = np.char.add(f"{image_gif_directory}/", columns["obs_id"])
+        base_paths = np.char.add(base_paths, "_")
+        base_paths = np.char.add(base_paths, np.asarray(table["filter_id"]).astype(str))
+        base_paths = np.char.add(base_paths, "_")
+        base_paths = np.char.add(base_paths, np.char.mod("%03d", np.asarray(table["cand_id"])))
+
+    names = list(columns.keys())
+    rows = zip(*(columns[name].tolist() for name in names))
+    return [
+        (dict(zip(names, row)), f"{base_path}.png", f"{base_path}.gif")
+        for row, base_path in zip(rows, base_paths.tolist())
+    ]
+
+
+def post_candidate(session, data, image_path, gif_path):
+    """Upload a single candidate, with its image and gif, to the database"""
+    url = f"{BASE_URL}/candidate_create/"
+
+    # open the image file
+    with open(image_path, "rb") as image, open(gif_path, "rb") as gif:
+        # upload to database
+        logger.debug(f"files are {image_path} and {gif_path}")
+        logger.debug("sending data %s", data)
+        r = session.post(url, data=data, files={"png": image, "gif": gif})
+    r.raise_for_status()
+
+
+def upload_candidate(fits_files, image_gif_directory, nthreads=UPLOAD_THREADS):
+    """Upload the candidates of many fits tables to the database. The observation
+    of each candidate is uploaded first (once per obsid), then the candidates are
+    posted concurrently.
 
     Parameters
     ----------
@@ -123,67 +287,22 @@ def upload_candidate(fits_files, image_gif_directory):
         A list of the file locations of each fits file you would like to upload.
     image_gif_directory : `str`
         The directory containing all the images and gifs.
+    nthreads : `int`, optional
+        Number of concurrent uploads. Default: UPLOAD_THREADS.
     """
     # Set up session
-    session = requests.session()
-    session.auth = TokenAuth(os.environ["IMAGE_PLANE_TOKEN"])
-    url = f"{BASE_URL}/candidate_create/"
+    session = make_session(nthreads=nthreads)
 
-    # Loop over fits files
+    candidates = []
     for fits_path in fits_files:
-        # Read fits file
-        hdul = fits.open(fits_path)
-
-        # loop over each candidate
-        for cand in hdul[1].data:
-            data = {}
-            # Loop over each header and append data to the upload dictionary
-            for hi, dat in enumerate(cand):
-                fits_header = f"TTYPE{hi+1}"
-                header = hdul[1].header[fits_header]
-                logger.debug(f"{header}: {dat}")
-                if f"TCOMM{hi+1}" in hdul[1].header.keys():
-                    logger.debug(hdul[1].header[f"TCOMM{hi+1}"])
-                if header == "obs_cent_freq":
-                    # Skip because already have that data in obsid
-                    pass
-                elif header in ["obs_id", "observation_id"]:
-                    # upload obsid
-                    upload_obsid(dat)
-                    data["obs_id"] = dat
-                elif header.endswith("ra_deg"):
-                    # parse to hms
-                    data[header] = dat
-                    hms_header = header[:-3] + "hms"
-                    data[hms_header] = Angle(dat, unit=u.deg).to_string(
-                        unit=u.hour, sep=":"
-                    )[:11]
-                elif header.endswith("dec_deg"):
-                    # parse to dms
-                    data[header] = dat
-                    dms_header = header[:-3] + "dms"
-                    data[dms_header] = Angle(dat, unit=u.deg).to_string(
-                        unit=u.deg, sep=":"
-                    )[:12]
-                else:
-                    data[header] = dat
-
-            # Work out image and gif path
-            base_path = (
-                f"{image_gif_directory}/{data['obs_id']}_"
-                + f"{data['filter_id']}_{data['cand_id']:03d}"
-            )
-            image_path = f"{base_path}.png"
-            gif_path = f"{base_path}.gif"
-
-            # open the image file
-            with open(image_path, "rb") as image, open(gif_path, "rb") as gif:
-                # upload to database
-                logger.debug(f"files are {image_path} and {gif_path}")
-                logger.debug("sending data %s", data)
-                r = session.post(url, data=data, files={"png": image, "gif": gif})
-            # print(r.text)
-            r.raise_for_status()
+        candidates.extend(read_candidates(fits_path, image_gif_directory))
+
+    upload_obsids([data["obs_id"] for data, _, _ in candidates], session=session, nthreads=nthreads)
+
+    logger.info(f"Uploading {len(candidates)} candidates")
+    if len(candidates) > 0:
+        with ThreadPool(max(1, min(nthreads, len(candidates)))) as pool:
+            pool.starmap(post_candidate, [(session, *cand) for cand in candidates])
 
 
 if __name__ == "__main__":
@@ -210,6 +329,12 @@ if __name__ == "__main__":
         choices=loglevels.keys(),
         default="INFO",
     )
+    parser.add_argument(
+        "--nthreads",
+        type=int,
+        help=f"Number of concurrent uploads. Default: {UPLOAD_THREADS}",
+        default=UPLOAD_THREADS,
+    )
     args = parser.parse_args()
 
     # set up the logger for stand-alone execution
@@ -233,4 +358,4 @@ if __name__ == "__main__":
         fits_files = [args.fits]
     else:
         fits_files = glob.glob(f"{args.data_directory}/*fits")
-    upload_candidate(fits_files, args.data_directory)
+    upload_candidate(fits_files, args.data_directory, nthreads=args.nthreads)
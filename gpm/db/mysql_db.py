@@ -1,13 +1,36 @@
 #!/usr/bin/env python
 
-"""Small set of utility functions to keep the mysql connections in one location. 
+"""Small set of utility functions to keep the mysql connections in one location.
+
+Besides connect(), which opens a new connection on every call, statements can be
+run with execute(). This uses a single connection per process, which is opened
+on first use (with retries and exponential back-off) and reused until close().
+If the database cannot be reached, the statement is appended to a local spool
+file instead of blocking the caller, and the spool is replayed (in order, in
+batches) by the next execute() or flush_spool() that reaches the database.
+Only one process at a time flushes a shared spool (with a lock file next to it).
+The lock is never waited for: a process that cannot take it, or finds statements
+still spooled, spools its own statement, so that a statement is never run ahead
+of statements spooled before it by another process.
 """
 import os
+import json
+import time
+import fcntl
+import socket
+import sqlite3
+import logging
+from contextlib import contextmanager
+
 import mysql.connector as mysql
 
 __author__ = "Tim Galvin"
 dbname = "gpm-processing"
 
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
 # TODO: Remove this database_configuration business
 try:
     import gpm.db.database_configuration as dbc
@@ -34,21 +57,350 @@ dbconn = "mysql://{0}:{1}@{2}:{3}/{4}".format(
     dbconfig["user"], dbconfig["password"], dbconfig["host"], dbconfig["port"], dbname
 )
 
+# Number of attempts to reach the database before spooling a statement, and the
+# delay (s) before the first retry, which doubles with every further attempt
+RETRIES = int(os.environ.get("GPMDBRETRIES", 3))
+BACKOFF = float(os.environ.get("GPMDBBACKOFF", 1.0))
+# Time (s) to wait for a new connection to be established
+CONNECT_TIMEOUT = int(os.environ.get("GPMDBTIMEOUT", 10))
+# File of statements that could not be run because the database was unreachable
+SPOOL_PATH = os.environ.get(
+    "GPMDBSPOOL", os.path.join(os.path.expanduser("~"), ".cache", "gpm", "db_spool.jsonl")
+)
+# Number of spooled statements replayed per transaction
+SPOOL_BATCH = 500
+
+# Errors that mean the database could not be reached (rather than that a statement is invalid)
+CONNECTION_ERRORS = (mysql.errors.InterfaceError, mysql.errors.OperationalError, sqlite3.OperationalError, OSError)
+# All other errors raised by the database
+DATABASE_ERRORS = (mysql.errors.Error, sqlite3.Error)
 
-def connect(switch_db=False):
+
+class StatementError(Exception):
+    """A statement failed even though the database could be reached"""
+
+
+def connect(switch_db=False, **kwargs):
     """Returns an activate connection to the mysql gpm database
-    
+
     Keyword Paramters:
         switch_db {bool} -- Switch to the gpm database before returning the connection object (Default: {True})
+        kwargs -- Passed to mysql.connector.connect(), e.g. connection_timeout
     """
     if dbconfig == None:
         raise ConnectionError(
             "No database connection configuration detected. Ensure an importable `database_configuration` or appropriately set GPMDB* environment variables"
         )
 
-    conn = mysql.connect(**dbconfig)
+    conn = mysql.connect(**dbconfig, **kwargs)
 
     if switch_db:
         conn.cursor().execute("USE '{0}'".format(dbname))
 
     return conn
+
+
+def _connect_mysql():
+    return connect(connection_timeout=CONNECT_TIMEOUT)
+
+
+# The connection shared by everything in this process, and how to (re)open it.
+# For testing, GPMDBSQLITE may name a SQLite database to use in place of MySQL.
+_connection = None
+if "GPMDBSQLITE" in os.environ:
+    _connector = lambda: sqlite3.connect(os.environ["GPMDBSQLITE"])
+    _paramstyle = "qmark"
+else:
+    _connector = _connect_mysql
+    _paramstyle = "format"
+
+
+def set_connector(connector, paramstyle="format"):
+    """Replace how the shared connection is opened, e.g. with a SQLite stand-in for testing:
+
+        set_connector(lambda: sqlite3.connect("test.db"), paramstyle="qmark")
+
+    Args:
+        connector (callable): Returns a new DB-API connection
+        paramstyle (str, optional): "format" (%s placeholders, as written in all statements) or "qmark" (?). Defaults to "format".
+    """
+    global _connector, _paramstyle
+    close()
+    _connector = connector
+    _paramstyle = paramstyle
+
+
+def _is_alive(conn):
+    try:
+        if hasattr(conn, "is_connected"):
+            return conn.is_connected()
+        conn.execute("SELECT 1")
+        return True
+    except Exception:
+        return False
+
+
+def get_connection(retries=RETRIES, backoff=BACKOFF):
+    """The connection shared by this process, (re)opened if necessary
+
+    Args:
+        retries (int, optional): Number of attempts to connect. Defaults to RETRIES.
+        backoff (float, optional): Delay (s) before the first retry, doubled for each further retry. Defaults to BACKOFF.
+
+    Raises:
+        ConnectionError: The database could not be reached
+
+    Returns:
+        The connection
+    """
+    global _connection
+
+    if _connection is not None and _is_alive(_connection):
+        return _connection
+    close()
+
+    for attempt in range(max(retries, 1)):
+        if attempt > 0:
+            delay = backoff * 2 ** (attempt - 1)
+            logger.debug(f"Retrying the connection in {delay} s")
+            time.sleep(delay)
+        try:
+            _connection = _connector()
+            return _connection
+        except CONNECTION_ERRORS as e:
+            logger.warning(f"Could not connect to the database (attempt {attempt + 1} of {retries}): {e}")
+
+    raise ConnectionError("Could not connect to the database")
+
+
+def close():
+    """Close the connection shared by this process, if it is open"""
+    global _connection
+
+    if _connection is not None:
+        try:
+            _connection.close()
+        except Exception:
+            pass
+    _connection = None
+
+
+def _run(conn, statement, params, many):
+    if _paramstyle == "qmark":
+        statement = statement.replace("%s", "?")
+    cur = conn.cursor()
+    try:
+        if many:
+            cur.executemany(statement, params)
+        else:
+            cur.execute(statement, params)
+    except CONNECTION_ERRORS:
+        raise
+    except DATABASE_ERRORS as e:
+        # e.g. an IntegrityError: the statement itself is at fault
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise StatementError(str(e)) from e
+    return cur.rowcount
+
+
+@contextmanager
+def _spool_lock(path):
+    """Try to take an exclusive lock on the spool, shared by all processes that use it,
+    without waiting for it. Yields whether the lock was taken."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _spool_pending(path):
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+
+def spool(statement, params=(), many=False, path=SPOOL_PATH):
+    """Append a statement to the spool file, to be run by flush_spool()"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    line = json.dumps({"statement": statement, "params": params, "many": many, "time": time.time()})
+    # A single append of a line is atomic, so that many processes can share the spool
+    with open(path, "a") as f:
+        f.write(line + "\n")
+    logger.debug(f"Spooled the statement to {path}")
+
+
+def flush_spool(path=SPOOL_PATH, batch_size=SPOOL_BATCH, retries=RETRIES, backoff=BACKOFF):
+    """Run the spooled statements, in the order they were spooled, committing
+    once per batch. Statements that are themselves invalid are logged and dropped.
+    Nothing is run if another process is already flushing the spool.
+
+    Args:
+        path (str, optional): The spool file. Defaults to SPOOL_PATH.
+        batch_size (int, optional): Number of statements per transaction. Defaults to SPOOL_BATCH.
+        retries (int, optional): As for get_connection(). Defaults to RETRIES.
+        backoff (float, optional): As for get_connection(). Defaults to BACKOFF.
+
+    Returns:
+        int: The number of statements that were run
+    """
+    if not _spool_pending(path):
+        return 0
+
+    # Connect before taking the lock, so that the lock is never held while retrying
+    try:
+        conn = get_connection(retries=retries, backoff=backoff)
+    except ConnectionError as e:
+        logger.warning(f"Could not flush the spool: {e}")
+        return 0
+
+    with _spool_lock(path) as locked:
+        if not locked:
+            logger.info(f"{path} is being flushed by another process")
+            return 0
+        return _flush_spool(conn, path, batch_size=batch_size)
+
+
+def _flush_spool(conn, path=SPOOL_PATH, batch_size=SPOOL_BATCH):
+    # The caller holds the spool lock
+    if not os.path.exists(path):
+        return 0
+
+    # Claim the spool, so that statements spooled meanwhile by other processes are left for later
+    claimed = f"{path}.{socket.gethostname()}.{os.getpid()}.flush"
+    try:
+        os.replace(path, claimed)
+    except FileNotFoundError:
+        return 0
+
+    entries = []
+    with open(claimed) as f:
+        for line in f:
+            try:
+                if line.strip():
+                    entries.append(json.loads(line))
+            except ValueError:
+                logger.error(f"Dropping unreadable spooled statement: {line.strip()}")
+
+    nrun = 0
+    try:
+        for b0 in range(0, len(entries), batch_size):
+            for entry in entries[b0 : b0 + batch_size]:
+                try:
+                    _run(conn, entry["statement"], entry["params"], entry["many"])
+                except CONNECTION_ERRORS as e:
+                    if not _is_alive(conn):
+                        raise
+                    logger.error(f"Dropping spooled statement that failed ({e}): {entry['statement']} {entry['params']}")
+                except StatementError as e:
+                    logger.error(f"Dropping spooled statement that failed ({e}): {entry['statement']} {entry['params']}")
+            conn.commit()
+            nrun = min(b0 + batch_size, len(entries))
+    except CONNECTION_ERRORS as e:
+        logger.warning(f"Could not flush the spool: {e}")
+        close()
+    finally:
+        # Return whatever was not run to the front of the spool
+        remaining = entries[nrun:]
+        if len(remaining) > 0:
+            newer = []
+            if os.path.exists(path):
+                os.replace(path, f"{claimed}.newer")
+                with open(f"{claimed}.newer") as f:
+                    newer = [line for line in f if line.strip()]
+                os.remove(f"{claimed}.newer")
+            with open(path, "a") as f:
+                for entry in remaining:
+                    f.write(json.dumps(entry) + "\n")
+                f.writelines(newer)
+        os.remove(claimed)
+
+    if nrun > 0:
+        logger.info(f"Ran {nrun} spooled statements")
+
+    return nrun
+
+
+def execute(statement, params=(), many=False, use_spool=True, spool_path=SPOOL_PATH, retries=RETRIES, backoff=BACKOFF):
+    """Run and commit a single statement on the connection shared by this process.
+
+    With the spool, callers never wait on each other: the statement is only run
+    directly if this process can take the spool lock straight away and the spool is
+    empty once any spooled statements have been run first. Otherwise (or if the
+    database cannot be reached) it is appended to the spool, so that statements
+    are always applied in order.
+
+    Args:
+        statement (str): The statement, with %s placeholders
+        params (tuple or list[tuple], optional): Parameters of the statement, or of each row if many. Defaults to ().
+        many (bool, optional): Run the statement once per set of parameters, with executemany(). Defaults to False.
+        use_spool (bool, optional): Spool the statement (rather than raise) if the database cannot be reached. Defaults to True.
+        spool_path (str, optional): The spool file. Defaults to SPOOL_PATH.
+        retries (int, optional): As for get_connection(). Defaults to RETRIES.
+        backoff (float, optional): As for get_connection(). Defaults to BACKOFF.
+
+    Raises:
+        ConnectionError: The database could not be reached, and use_spool is False
+        StatementError: The statement failed for a reason other than the database being unreachable
+
+    Returns:
+        int: The number of affected rows, or None if the statement was spooled
+    """
+    params = [tuple(p) for p in params] if many else tuple(params)
+
+    # Connect (with retries) before taking the lock, so that the lock is never held while waiting on the database
+    try:
+        conn = get_connection(retries=retries, backoff=backoff)
+    except ConnectionError:
+        if not use_spool:
+            raise ConnectionError("Could not run the statement, as the database could not be reached")
+        logger.warning(f"Database unreachable, spooling the statement to {spool_path}")
+        spool(statement, params, many, path=spool_path)
+        return None
+
+    if not use_spool:
+        try:
+            return _execute(conn, statement, params, many, reconnect=True)
+        except (ConnectionError,) + CONNECTION_ERRORS:
+            close()
+            raise ConnectionError("Could not run the statement, as the database could not be reached")
+
+    with _spool_lock(spool_path) as locked:
+        if locked:
+            _flush_spool(conn, spool_path)
+            if not _spool_pending(spool_path):
+                try:
+                    return _execute(conn, statement, params, many, reconnect=False)
+                except CONNECTION_ERRORS:
+                    close()
+                    logger.warning(f"Lost the database connection, spooling the statement to {spool_path}")
+        else:
+            logger.debug(f"{spool_path} is being flushed by another process")
+
+        spool(statement, params, many, path=spool_path)
+    return None
+
+
+def _execute(conn, statement, params, many, reconnect):
+    try:
+        rowcount = _run(conn, statement, params, many)
+    except CONNECTION_ERRORS as e:
+        if _is_alive(conn):
+            # The statement itself is at fault
+            raise StatementError(str(e)) from e
+        if not reconnect:
+            raise
+        # The connection went away between the check and the statement, so try once more with a new one
+        logger.debug(f"Statement failed: {e}")
+        close()
+        conn = get_connection(retries=1)
+        rowcount = _run(conn, statement, params, many)
+    conn.commit()
+    return rowcount
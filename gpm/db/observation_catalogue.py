@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""A locally cached copy of the GPM observation table, with commonly used derived
+columns (declination strip, hour-angle and galactic coordinates) already attached.
+
+The cache is refreshed incrementally: only observations with an obs_id larger than
+the largest one already cached are pulled from the database. The derived columns
+depend only on the obs_id and pointing of each observation, so they are computed
+once, when a row first enters the cache.
+"""
+
+import os
+import hashlib
+import logging
+from argparse import ArgumentParser
+from typing import Collection, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, EarthLocation
+
+try:
+    from gpm.db import mysql_db as mdb
+except:
+    mdb = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+MWA = EarthLocation.from_geodetic(
+    lat=-26.703319 * u.deg, lon=116.67081 * u.deg, height=377 * u.m
+)
+# The declinations that pointings are snapped to when assigning dec strips
+DEC_STRIPS = [-71.0, -55.0, -41.0, -39.0, -26.0, -12.0, 3.0, 20.0]
+GALACTIC_PLANE_LIMITS = [-10, 10, 90, 270]
+CACHE_DIR = os.environ.get("GPMOBSCACHE", os.path.join(os.path.expanduser("~"), ".cache", "gpm"))
+
+
+def dec_strips(dec_pointing: Collection[float], strips: Collection[float]=DEC_STRIPS) -> np.ndarray:
+    """Assign each declination to its nearest declination strip
+
+    Args:
+        dec_pointing (Collection[float]): Declinations of the pointings (deg)
+        strips (Collection[float], optional): Declinations of the strips (deg). Defaults to DEC_STRIPS.
+
+    Returns:
+        np.ndarray: The declination strip nearest to each pointing
+    """
+    strips = np.asarray(strips, dtype=float)
+    dec_pointing = np.asarray(dec_pointing, dtype=float)
+
+    return strips[np.argmin(np.abs(dec_pointing[:, None] - strips[None, :]), axis=1)]
+
+
+def hour_angles(obs_ids: Collection[int], ra_pointing: Collection[float]) -> np.ndarray:
+    """Hour-angle of each pointing at the start of its observation, rounded to the nearest hour
+
+    Args:
+        obs_ids (Collection[int]): Observation ids (GPS seconds)
+        ra_pointing (Collection[float]): RA of each pointing (deg)
+
+    Returns:
+        np.ndarray: Hour-angles, in the range [-12, 12]
+    """
+    if len(obs_ids) == 0:
+        return np.zeros(0, dtype=int)
+
+    gps = Time(np.asarray(obs_ids), format="gps", location=MWA)
+    lst = gps.sidereal_time("mean")
+
+    ha = np.round((lst.deg - np.asarray(ra_pointing, dtype=float)) / 15)
+
+    ha[ha > 12] -= 24.0
+    ha[ha < -12] += 24.0
+
+    return ha.astype(int)
+
+
+def galactic_coords(ra_pointing: Collection[float], dec_pointing: Collection[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """Galactic coordinates of a set of pointings
+
+    Args:
+        ra_pointing (Collection[float]): RA of each pointing (deg)
+        dec_pointing (Collection[float]): Dec of each pointing (deg)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Galactic longitude and latitude (deg) of each pointing
+    """
+    sky = SkyCoord(np.asarray(ra_pointing, dtype=float), np.asarray(dec_pointing, dtype=float), unit=(u.deg, u.deg))
+    gal = sky.galactic
+
+    return gal.l.deg, gal.b.deg
+
+
+def galactic_mask(gal_l: Collection[float], gal_b: Collection[float], limits: Collection[float]=GALACTIC_PLANE_LIMITS) -> np.ndarray:
+    """Whether each position lies in the region near the galactic plane
+
+    Args:
+        gal_l (Collection[float]): Galactic longitudes (deg)
+        gal_b (Collection[float]): Galactic latitudes (deg)
+        limits (Collection[float], optional): Region limits as [b_min, b_max, l_min, l_max]. Defaults to GALACTIC_PLANE_LIMITS.
+
+    Returns:
+        np.ndarray: True for positions inside the region
+    """
+    l = np.asarray(gal_l, dtype=float)
+    b = np.asarray(gal_b, dtype=float)
+
+    return (
+        (b >= limits[0])
+        & (b <= limits[1])
+        & ((l <= limits[2]) | (l >= limits[3]))
+    )
+
+
+def add_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Attach the dec strip, hour-angle and galactic coordinate columns to an observation table
+
+    Args:
+        df (pd.DataFrame): Table in the GPM observation table format
+
+    Returns:
+        pd.DataFrame: The same table with 'lst_deg_wrap', 'dec_strip', 'ha', 'gal_l', 'gal_b' and 'in_galactic_plane' columns
+    """
+    df = df.copy()
+
+    # Unwrap the LST which is going above 360 degrees
+    df["lst_deg_wrap"] = df["lst_deg"] % 360
+    df["dec_strip"] = dec_strips(df["dec_pointing"])
+    df["ha"] = hour_angles(df["obs_id"], df["ra_pointing"])
+
+    if len(df) > 0:
+        df["gal_l"], df["gal_b"] = galactic_coords(df["ra_pointing"], df["dec_pointing"])
+    else:
+        df["gal_l"], df["gal_b"] = np.zeros(0), np.zeros(0)
+    df["in_galactic_plane"] = galactic_mask(df["gal_l"], df["gal_b"])
+
+    return df
+
+
+def default_cache_path(dbconn: str) -> str:
+    """The cache file used for a given database, so that different databases never share a cache
+
+    Args:
+        dbconn (str): Database connection URL
+
+    Returns:
+        str: Path to the cache file
+    """
+    key = hashlib.md5(dbconn.encode("utf-8")).hexdigest()[:12]
+
+    return os.path.join(CACHE_DIR, f"observation_{key}.parquet")
+
+
+def load_observations(
+    dbconn: Optional[str]=None,
+    cache_path: Optional[str]=None,
+    refresh: bool=True,
+    rebuild: bool=False,
+    filter_obsids: Optional[Collection[int]]=None,
+) -> pd.DataFrame:
+    """Load the observation table, with derived columns, from the local cache,
+    pulling any newer observations from the database first
+
+    Only rows with an obs_id beyond the largest cached one are retrieved when
+    refreshing, so columns that change after an observation is imported (e.g.
+    'status', 'cal_obs_id') reflect the time the row was first cached. Use
+    `rebuild` to pull the whole table again.
+
+    Args:
+        dbconn (str, optional): Database connection URL. Defaults to the GPM database (gpm.db.mysql_db.dbconn).
+        cache_path (str, optional): Path of the cache file. Defaults to a per-database file in CACHE_DIR.
+        refresh (bool, optional): Pull newer observations from the database. Defaults to True.
+        rebuild (bool, optional): Discard the cache and pull the whole table. Defaults to False.
+        filter_obsids (Collection[int], optional): Only return these observations. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The observation table
+    """
+    if dbconn is None:
+        if mdb is None:
+            raise ValueError("GPM database module not available")
+        dbconn = mdb.dbconn
+
+    if cache_path is None:
+        cache_path = default_cache_path(dbconn)
+
+    df = None
+    if not rebuild and os.path.exists(cache_path):
+        df = pd.read_parquet(cache_path)
+        logger.debug(f"Loaded {len(df)} cached observations from {cache_path}")
+
+    if df is None or refresh:
+        if df is None or len(df) == 0:
+            logger.info("Pulling the full observation table")
+            new_df = pd.read_sql("SELECT * FROM observation", dbconn)
+        else:
+            last = int(df["obs_id"].max())
+            logger.info(f"Pulling observations with obs_id > {last}")
+            new_df = pd.read_sql(
+                "SELECT * FROM observation WHERE obs_id > %(last)s",
+                dbconn,
+                params={"last": last},
+            )
+
+        logger.info(f"{len(new_df)} new observations")
+
+        if len(new_df) > 0 or df is None:
+            new_df = add_derived_columns(new_df)
+            df = new_df if df is None else pd.concat([df, new_df], ignore_index=True)
+            write_cache(df, cache_path)
+
+    if filter_obsids is not None:
+        df = df[df["obs_id"].isin(filter_obsids)]
+
+    return df
+
+
+def write_cache(df: pd.DataFrame, cache_path: str):
+    """Write the observation table to the cache file. The file is written to a
+    temporary name and moved into place, so concurrent readers never see a partial file.
+
+    Args:
+        df (pd.DataFrame): Observation table to write
+        cache_path (str): Path of the cache file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp_path, index=False)
+    except ImportError as e:
+        logger.warning(f"Could not write observation cache ({e})")
+        return
+
+    os.replace(tmp_path, cache_path)
+    logger.debug(f"Wrote {len(df)} observations to {cache_path}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Refresh the local cache of the GPM observation table")
+    parser.add_argument("--cache-path", type=str, default=None, help="Path of the cache file (default = a per-database file in $GPMOBSCACHE or ~/.cache/gpm)")
+    parser.add_argument("--rebuild", action="store_true", default=False, help="Discard the existing cache and pull the whole observation table")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Enable debug logging")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    df = load_observations(cache_path=args.cache_path, rebuild=args.rebuild)
+    logger.info(f"{len(df)} observations cached")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""A shared, on-disk cache of MWA lookup-beam responses.
+
+The primary beam response towards a set of positions depends only on the
+pointing (gridnum), the frequency and the time. Responses are evaluated for all
+the requested positions at once, and stored under a key built from those
+parameters and the positions themselves. Tools that model the sky of the same
+observation (e.g. crop_catalogue.py and generate_ateam_subtract_model.py, or
+reruns of either) therefore look up the beam only once. Responses are only kept
+on disk by callers that pass a cache_dir (those two tools pass CACHE_DIR), as
+callers that look up a new time on every call would never reuse them.
+"""
+
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from mwa_pb_lookup.lookup_beam import beam_lookup_1d
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+CACHE_DIR = os.environ.get(
+    "GPMBEAMCACHE", os.path.join(os.path.expanduser("~"), ".cache", "gpm", "beam")
+)
+
+# Number of responses kept in memory by this process
+MEMORY_ENTRIES = 16
+
+# The most recently used responses looked up by this process, keyed by response_key()
+_responses = OrderedDict()
+
+
+def response_key(ra, dec, gridnum, t, freq):
+    """Cache key of the beam response towards a set of positions
+
+    Args:
+        ra (np.ndarray): RA of each position (deg)
+        dec (np.ndarray): Dec of each position (deg)
+        gridnum (int): Gridpoint number of the pointing
+        t (astropy.time.Time): Time of the observation
+        freq (float): Frequency (Hz)
+
+    Returns:
+        str: The key
+    """
+    sha = hashlib.sha256()
+    sha.update(f"{int(gridnum)}|{float(freq):.1f}|{t.utc.isot}".encode("utf-8"))
+    sha.update(np.ascontiguousarray(ra, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(dec, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def beam_response(ra, dec, gridnum, t, freq, cache_dir=None):
+    """The XX and YY lookup-beam response towards many positions, from the cache if
+    this exact set of positions has been looked up for the same pointing, frequency
+    and time before
+
+    Args:
+        ra (float or np.ndarray): RA of each position (deg)
+        dec (float or np.ndarray): Dec of each position (deg)
+        gridnum (int): Gridpoint number of the pointing
+        t (astropy.time.Time): Time of the observation
+        freq (float): Frequency (Hz)
+        cache_dir (str, optional): Directory of cached responses (e.g. CACHE_DIR). If None, only the in-process cache is used. Defaults to None.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The XX and YY responses, as returned by beam_lookup_1d
+    """
+    key = response_key(ra, dec, gridnum, t, freq)
+
+    if key in _responses:
+        _responses.move_to_end(key)
+        rX, rY = _responses[key]
+        return rX.copy(), rY.copy()
+
+    cache_path = os.path.join(cache_dir, key[:2], f"{key}.npz") if cache_dir is not None else None
+
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.debug(f"Using cached beam response {cache_path}")
+        with np.load(cache_path) as cached:
+            rX, rY = cached["rX"], cached["rY"]
+    else:
+        logger.debug(f"Looking up the beam towards {np.size(ra)} positions for {gridnum=} {freq=} {t.isot}")
+        rX, rY = beam_lookup_1d(ra, dec, gridnum, t, freq)
+        rX, rY = np.asarray(rX), np.asarray(rY)
+
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # np.savez appends .npz to names without it
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, rX=rX, rY=rY)
+            os.replace(tmp_path, cache_path)
+
+    _responses[key] = (rX, rY)
+    while len(_responses) > MEMORY_ENTRIES:
+        _responses.popitem(last=False)
+
+    return rX.copy(), rY.copy()
@@ -7,16 +7,43 @@ import numpy as np
 import astropy.units as u
 from argparse import ArgumentParser
 from astropy.time import Time
-from astropy.coordinates import SkyCoord, EarthLocation
 
 from gpm.db import mysql_db as mdb
+from gpm.db import observation_catalogue as obscat
+from gpm.db.observation_catalogue import GALACTIC_PLANE_LIMITS
 
-MWA = EarthLocation.from_geodetic(
-    lat=-26.703319 * u.deg, lon=116.67081 * u.deg, height=377 * u.m
-)
 # DEC_POINTINGS = [-71, -55, -41, -39, -26, -12, 3, 20]
 DEC_POINTINGS = [-71, -55, -40, -26, -12, 3, 20]
-GALACTIC_PLANE_LIMITS = [-10, 10, 90, 270]
+
+# Galactic (l, b) of each observation's pointing, keyed by obs_id. The pointing
+# of an observation never changes, so these only need to be computed once.
+_galactic_cache = {}
+
+
+def galactic_coords(obs_ids, ra, dec):
+    """Galactic coordinates of a set of observation pointings, converting only
+    those obs_ids that have not been seen before
+
+    Args:
+        obs_ids (Iterable[int]): Observation ids
+        ra (Iterable[float]): RA of each pointing (deg)
+        dec (Iterable[float]): Dec of each pointing (deg)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Galactic longitude and latitude (deg) of each pointing
+    """
+    obs_ids = np.asarray(obs_ids, dtype=int)
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+
+    missing = np.array([obs_id not in _galactic_cache for obs_id in obs_ids], dtype=bool)
+    if np.any(missing):
+        l, b = obscat.galactic_coords(ra[missing], dec[missing])
+        _galactic_cache.update(zip(obs_ids[missing].tolist(), zip(l, b)))
+
+    lb = np.array([_galactic_cache[obs_id] for obs_id in obs_ids.tolist()], dtype=float).reshape(-1, 2)
+
+    return lb[:, 0], lb[:, 1]
 
 
 def get_observations(
@@ -34,65 +61,55 @@ def get_observations(
     if all_obs is True and only_calobs is True:
         raise ValueError("Both all_obs and only_calobs can not be True.")
 
-    df = pd.read_sql_table("observation", mdb.dbconn)
+    # Do as much of the selection as possible in the database, so that only
+    # the matching rows are sent over the network
+    conditions = []
+    params = {}
 
     # The default behaviour of this script is to only return the 
     # GPM science fields, not the MWA calibration scans. 
     if only_calobs:
-        df = df[~df["obsname"].str.contains("FDS")]    
+        conditions.append("obsname NOT LIKE '%%FDS%%'")
     elif not all_obs:
-        df = df[df["obsname"].str.contains("FDS")]
-  
-    if mask_gp:
-        sky = SkyCoord(df["ra_pointing"], df["dec_pointing"], unit=(u.deg, u.deg))
-
-        l = sky.galactic.l.deg
-        b = sky.galactic.b.deg
-
-        mask = (
-            (b >= GALACTIC_PLANE_LIMITS[0])
-            & (b <= GALACTIC_PLANE_LIMITS[1])
-            & ((l <= GALACTIC_PLANE_LIMITS[2]) | (l >= GALACTIC_PLANE_LIMITS[3]))
-        )
-
-        df = df[~mask]
+        conditions.append("obsname LIKE '%%FDS%%'")
 
     if start_obsid is not None:
-        df = df[df["obs_id"] >= int(start_obsid)]
+        conditions.append("obs_id >= %(start_obsid)s")
+        params["start_obsid"] = int(start_obsid)
 
     if finish_obsid is not None:
-        df = df[df["obs_id"] <= int(finish_obsid)]
+        conditions.append("obs_id <= %(finish_obsid)s")
+        params["finish_obsid"] = int(finish_obsid)
 
     if obs_date is not None:
-        gps = Time(df["obs_id"], format="gps", location=MWA)
-        gps_date = gps.strftime("%Y-%m-%d")
-
-        df = df[gps_date == obs_date]
+        # Obsids are GPS seconds, so a (UTC) date is a range of obsids
+        day_start = Time(obs_date, format="iso", scale="utc")
+        conditions.append("obs_id >= %(day_start)s AND obs_id < %(day_end)s")
+        params["day_start"] = int(np.ceil(day_start.gps))
+        params["day_end"] = int(np.ceil((day_start + 1 * u.day).gps))
 
-    if dec_pointing is not None:
-        dec = np.array([-71.0, -55.0, -41.0, -39.0, -26.0, -12.0, 3.0, 20.0])
-        min_dec = lambda x: dec[np.argmin(np.abs(dec - x["dec_pointing"]))]
-        df["Dec Strip"] = df.apply(min_dec, axis=1)
+    if cen_chan is not None:
+        conditions.append("cenchan = %(cen_chan)s")
+        params["cen_chan"] = int(cen_chan)
 
-        df = df[df["Dec Strip"] == dec_pointing]
+    query = "SELECT * FROM observation"
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
 
-    if hour_angle is not None:
-        gps = Time(df["obs_id"], format="gps", location=MWA)
-        lst = gps.sidereal_time("mean")
+    df = pd.read_sql(query, mdb.dbconn, params=params)
 
-        ra = df["ra_pointing"].values
-        ha = np.round((lst.deg - ra) / 15)
+    if mask_gp:
+        l, b = galactic_coords(df["obs_id"], df["ra_pointing"], df["dec_pointing"])
 
-        mask = ha > 12
-        ha[mask] = ha[mask] - 24.0
+        df = df[~obscat.galactic_mask(l, b)]
 
-        mask = ha < -12
-        ha[mask] = ha[mask] + 24.0
+    if dec_pointing is not None:
+        df["Dec Strip"] = obscat.dec_strips(df["dec_pointing"])
 
-        df = df[ha.astype(int) == hour_angle]
+        df = df[df["Dec Strip"] == dec_pointing]
 
-    if cen_chan is not None:
-        df = df[df["cenchan"] == cen_chan]
+    if hour_angle is not None:
+        df = df[obscat.hour_angles(df["obs_id"], df["ra_pointing"]) == hour_angle]
 
     return df
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os
-import requests
+import shutil
 import numpy as np
 import astropy.units as u
 from astropy.time import Time
@@ -10,7 +10,7 @@ from astropy.table import Table
 from argparse import ArgumentParser
 from casacore.tables import taql
 
-BASEURL = "http://ws.mwatelescope.org/metadata"
+from gpm.utils import metadata_cache
 
 
 def download(obsid, service="fits"):
@@ -21,40 +21,35 @@ def download(obsid, service="fits"):
         service (str, optional): Metaservice to call upon. Defaults to "fits".
 
     Returns:
-        requests.models.Response: The response from the URL call
+        bytes: The body of the response
     """
-    url = f"{BASEURL}/{service}"
-
-    response = requests.get(url, params={"obsid": obsid}, timeout=1.0)
-
-    return response
+    return metadata_cache.download(obsid, service=service)
 
 
 def parse_service(obsid, service="fits", out_file=None):
-    """Call and oarse the response of the metadata service appropriately. 
+    """Call and oarse the response of the metadata service appropriately. Responses
+    are read from (and stored in) the local metadata cache.
 
     Args:
         obsid (int): Observation ID of interest
         service (str, optional): Which aspect of the metadata service to poll. Defaults to "fits".
-        out_file (str, optional): Name of the file to write the resonse to. Only relevant for when a metafits file has been pulled from the fits service. 
-                                  A default file suffix of 'down.metafits' will be used if this is None when service is fits. Defaults to None.
+        out_file (str, optional): Name of the file to write a copy of the response to. Only relevant for when a metafits file has been pulled from the fits service. 
+                                  If None, no copy is written. Defaults to None.
 
     Returns:
         [astropy.table.Table,dict]: If service is fits, a table of the tile / input / antenna mappings is returned. Otherwise, a dict of the formated JSON content is returned
     """
-    response = download(obsid, service=service)
-
     if service == "fits":
-        out_file = f"{obsid}_down.metafite" if out_file is None else out_file
-        with open(out_file, "wb") as outfile:
-            for i in response:
-                outfile.write(i)
+        metafits = metadata_cache.get_metafits(obsid)
+
+        if out_file is not None:
+            shutil.copyfile(metafits, out_file)
 
-        tab = Table.read(out_file)
+        tab = Table.read(metafits, format="fits")
 
         return tab
     else:
-        json_res = response.json()
+        json_res = metadata_cache.get_json(obsid, service=service)
 
         return json_res
 
@@ -67,7 +62,7 @@ def dead_dipole_antenna_flag(obsid, meta_outfile=None, dead_tolerance=0, ms=None
 
     Args:
         obsid (int): Observation ID of interest
-        meta_outfile (str, optional): Path to save the metafits file to. If None, one is generated.. Defaults to None.
+        meta_outfile (str, optional): Path to save a copy of the metafits file to. If None, no copy is saved. Defaults to None.
         dead_tolerance (int, optional): Number of dead dipoles before the tile is considered flagged. Defaults to 0.
         ms (str, optional): Path to the measurement set that shoule be flagged. Defaults to None.
     """
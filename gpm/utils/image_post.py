@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""Streaming post-processing of FITS images (mosaics and clean component models).
+
+The image is memory-mapped and read a block of rows at a time. Each block is
+processed in the same way:
+- pixels within +/- clip_level of zero are set to zero (see clip_clean_components.py)
+- pixels that are identically zero are masked, i.e. set to NaN (see fits_trim.py)
+and, if the image is to be trimmed, the rows and columns that contain any finite
+pixel are recorded with np.isfinite(...).any(). The processed blocks are then
+written, cropped to the bounding box of the finite pixels, with a StreamingHDU.
+Many images can be processed in one invocation, e.g.
+
+    image_post.py --mask-zeros --trim --suffix _trim mosaic1.fits mosaic2.fits
+"""
+
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+# Default number of pixels processed at a time
+STRIDE = 2**24
+
+
+def process_block(block, mask_zeros=False, clip_level=None):
+    """Clip and mask a block of pixels
+
+    Args:
+        block (np.ndarray): The pixels. Not modified.
+        mask_zeros (bool, optional): Set pixels that are (or have been clipped to) zero to NaN. Defaults to False.
+        clip_level (float, optional): Set pixels in the range (-clip_level, clip_level) to zero. Defaults to None (no clipping).
+
+    Returns:
+        tuple[np.ndarray, int, int]: The processed block, and the number of pixels clipped and masked
+    """
+    block = np.array(block)
+    nclipped = nmasked = 0
+
+    if clip_level is not None:
+        clip = np.abs(block) < clip_level
+        block[clip] = 0
+        nclipped = int(np.count_nonzero(clip))
+
+    if mask_zeros:
+        zero = block == 0
+        block[zero] = np.nan
+        nmasked = int(np.count_nonzero(zero))
+
+    return block, nclipped, nmasked
+
+
+def finite_bounds(data, mask_zeros=False, clip_level=None, stride=STRIDE):
+    """The bounding box of the pixels that are finite after processing, found in one pass
+    over the image. Only the last two (y, x) axes are cropped, so a row or column is kept
+    if it has a finite pixel in any plane of the leading axes.
+
+    Args:
+        data (np.ndarray): The (memory-mapped) image
+        mask_zeros (bool, optional): As for process_block(). Defaults to False.
+        clip_level (float, optional): As for process_block(). Defaults to None.
+        stride (int, optional): Approximate number of pixels to process at a time. Defaults to STRIDE.
+
+    Returns:
+        tuple[int, int, int, int]: jmin, jmax, imin, imax (inclusive), or None if there are no finite pixels
+    """
+    *lead, nrows, ncols = data.shape
+    block_rows = max(stride // (ncols * int(np.prod(lead, dtype=int))), 1)
+
+    rows = np.zeros(nrows, dtype=bool)
+    cols = np.zeros(ncols, dtype=bool)
+    lead_axes = tuple(range(len(lead)))
+
+    for r0 in range(0, nrows, block_rows):
+        r1 = min(r0 + block_rows, nrows)
+        block, _, _ = process_block(data[..., r0:r1, :], mask_zeros=mask_zeros, clip_level=clip_level)
+        finite = np.isfinite(block)
+        if len(lead) > 0:
+            finite = finite.any(axis=lead_axes)
+        rows[r0:r1] = finite.any(axis=1)
+        cols |= finite.any(axis=0)
+
+    if not np.any(rows):
+        return None
+
+    jmin, jmax = np.flatnonzero(rows)[[0, -1]]
+    imin, imax = np.flatnonzero(cols)[[0, -1]]
+
+    return int(jmin), int(jmax), int(imin), int(imax)
+
+
+def process_image(fin, fout=None, mask_zeros=False, clip_level=None, trim=False, stride=STRIDE):
+    """Clip, mask and trim an image, streaming it through memory a block of rows at a time
+
+    Args:
+        fin (str): Path to the input image
+        fout (str, optional): Path to the output image. If None, nothing is written. Defaults to None.
+        mask_zeros (bool, optional): As for process_block(). Defaults to False.
+        clip_level (float, optional): As for process_block(). Defaults to None.
+        trim (bool, optional): Crop the output to the smallest rectangle that contains all the finite pixels. Defaults to False.
+        stride (int, optional): Approximate number of pixels to process at a time. Defaults to STRIDE.
+
+    Returns:
+        dict: Summary of the processing: the input and output shapes, the crop box
+        (jmin, jmax, imin, imax) and the number of pixels, and of clipped and masked pixels
+    """
+    with fits.open(fin, memmap=True) as hdul:
+        data = hdul[0].data
+        header = hdul[0].header.copy()
+        *lead, nrows, ncols = data.shape
+
+        jmin, jmax, imin, imax = 0, nrows - 1, 0, ncols - 1
+        if trim:
+            bounds = finite_bounds(data, mask_zeros=mask_zeros, clip_level=clip_level, stride=stride)
+            if bounds is None:
+                logger.warning(f"{fin} has no finite pixels, so it will not be trimmed")
+            else:
+                jmin, jmax, imin, imax = bounds
+
+        out_shape = (*lead, jmax - jmin + 1, imax - imin + 1)
+        summary = {
+            "input": fin,
+            "output": fout,
+            "input_shape": data.shape,
+            "output_shape": out_shape,
+            "bounds": (jmin, jmax, imin, imax),
+            "npix": int(np.prod(data.shape, dtype=np.int64)),
+            "nclipped": 0,
+            "nmasked": 0,
+        }
+
+        if fout is not None:
+            # Scaled integer images are read as floats, so are written as floats
+            header["BITPIX"] = fits.DTYPE2BITPIX[data.dtype.name]
+            for key in ("BSCALE", "BZERO"):
+                header.remove(key, ignore_missing=True)
+            header["NAXIS1"] = out_shape[-1]
+            header["NAXIS2"] = out_shape[-2]
+            # recenter the image so the coordinates are correct.
+            if "CRPIX1" in header:
+                header["CRPIX1"] -= imin
+            if "CRPIX2" in header:
+                header["CRPIX2"] -= jmin
+
+            if os.path.exists(fout):
+                os.remove(fout)
+            out = fits.StreamingHDU(fout, header)
+
+        block_rows = max(stride // (ncols * int(np.prod(lead, dtype=int))), 1)
+        try:
+            # The data are stored plane by plane, so the rows of each plane of the leading axes are written in turn
+            for plane in np.ndindex(*lead):
+                for r0 in range(jmin, jmax + 1, block_rows):
+                    r1 = min(r0 + block_rows, jmax + 1)
+                    block, nclipped, nmasked = process_block(
+                        data[plane + (slice(r0, r1), slice(imin, imax + 1))],
+                        mask_zeros=mask_zeros,
+                        clip_level=clip_level,
+                    )
+                    summary["nclipped"] += nclipped
+                    summary["nmasked"] += nmasked
+                    if fout is not None:
+                        out.write(block)
+        finally:
+            if fout is not None:
+                out.close()
+
+    if fout is not None:
+        logger.debug(f"Wrote {fout}")
+
+    return summary
+
+
+def _process_image(args):
+    fin, fout, kwargs = args
+    try:
+        return process_image(fin, fout, **kwargs)
+    except Exception as e:
+        logger.error(f"Failed to process {fin}: {e}")
+        return None
+
+
+def process_images(fins, fouts, nprocs=1, **kwargs):
+    """process_image() of many images, in parallel
+
+    Args:
+        fins (list[str]): Paths to the input images
+        fouts (list[str]): Paths to the output images (or None, to not write the corresponding image)
+        nprocs (int, optional): Number of worker processes. Defaults to 1.
+        kwargs: Passed to process_image()
+
+    Returns:
+        list[dict]: Summary of each image, or None where the image could not be processed
+    """
+    jobs = [(fin, fout, kwargs) for fin, fout in zip(fins, fouts)]
+    if nprocs == 1:
+        return [_process_image(job) for job in jobs]
+
+    with Pool(nprocs) as pool:
+        return pool.map(_process_image, jobs)
+
+
+def output_name(fin, suffix):
+    """Path of the output image, with the suffix inserted before the extension"""
+    root, ext = os.path.splitext(fin)
+    return f"{root}{suffix}{ext}"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Clip, mask and trim many FITS images, streaming each through memory")
+    parser.add_argument("images", nargs="+", help="The input images")
+    parser.add_argument("--suffix", default="_post", help="Output images are named [image][suffix].fits (default = _post)")
+    parser.add_argument("--mask-zeros", default=False, action="store_true", help="Set pixels that are identically zero to NaN")
+    parser.add_argument("--clip-level", default=None, type=float, help="Set pixels in the range +/- clip_level to zero (default = no clipping)")
+    parser.add_argument("--trim", default=False, action="store_true", help="Crop to the smallest rectangle that contains all the finite pixels")
+    parser.add_argument("--nprocs", default=1, type=int, help="Number of worker processes (default = 1)")
+    parser.add_argument("-s", "--stride", default=STRIDE, type=int, help=f"The number of pixels to process at a time (rounded to whole rows). Default: {STRIDE}")
+    parser.add_argument("-v", "--verbose", default=False, action="store_true", help="Enable debug logging")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    summaries = process_images(
+        args.images,
+        [output_name(f, args.suffix) for f in args.images],
+        nprocs=args.nprocs,
+        mask_zeros=args.mask_zeros,
+        clip_level=args.clip_level,
+        trim=args.trim,
+        stride=args.stride,
+    )
+
+    for s in summaries:
+        if s is not None:
+            logger.info(f"{s['input']} {s['input_shape']} => {s['output']} {s['output_shape']}")
+
+    if any(s is None for s in summaries):
+        sys.exit(1)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+"""Local image statistics shared by the light-curve and leakage tools."""
+
+import numpy as np
+
+
+def sigma_clipped_std(data, nclip=3, axis=None):
+    """Two-pass clipped standard deviation: the std of the pixels whose absolute
+    value is below `nclip` times the std of all the (finite) pixels
+
+    Args:
+        data (np.ndarray): Pixel values
+        nclip (float, optional): Clipping threshold in units of the unclipped std. Defaults to 3.
+        axis (int or tuple[int], optional): Axes over which the std is computed. Defaults to None (all pixels).
+
+    Returns:
+        float or np.ndarray: The clipped standard deviation
+    """
+    data = np.asarray(data, dtype=np.float64)
+    std = np.nanstd(data, axis=axis, keepdims=True)
+    with np.errstate(invalid="ignore"):
+        clipped = np.where(np.abs(data) < nclip*std, data, np.nan)
+    std = np.nanstd(clipped, axis=axis)
+    return std
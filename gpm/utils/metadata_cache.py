@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""A local cache of responses from the MWA metadata web services, and of parsed
+metafits headers.
+
+Responses are stored content-addressed: the body of each response is written once
+under its SHA-256 digest, and a small index entry per (obsid, service) records
+which digest it resolved to and when it was fetched. Compute nodes without
+outbound network access can use a cache that was warmed beforehand with the
+`prefetch` command, e.g.
+
+    metadata_cache.py prefetch obsids.txt --services fits obs con
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from argparse import ArgumentParser
+from functools import lru_cache
+
+import numpy as np
+import requests
+from astropy.io import fits
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+BASEURL = "http://ws.mwatelescope.org/metadata"
+SERVICES = ("fits", "obs", "con")
+CACHE_DIR = os.environ.get(
+    "GPMMETACACHE", os.path.join(os.path.expanduser("~"), ".cache", "gpm", "metadata")
+)
+# Number of seconds before a cached response is considered stale (None = never)
+DEFAULT_TTL = 7 * 86400
+TIMEOUT = 10.0
+RETRIES = 3
+
+
+def _index_path(obsid, service, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, "index", service, f"{int(obsid)}.json")
+
+
+def _object_path(digest, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, "objects", digest[:2], digest)
+
+
+def _atomic_write(path, content):
+    """Write to a temporary file and move it into place, so that concurrent
+    readers never see a partially written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def download(obsid, service="fits", timeout=TIMEOUT, retries=RETRIES):
+    """Downloads a component from the MWA metadata service, retrying with
+    exponential back-off if the request fails
+
+    Args:
+        obsid (int): Observation ID of interest
+        service (str, optional): Metaservice to call upon. Defaults to "fits".
+        timeout (float, optional): Timeout of each request in seconds. Defaults to TIMEOUT.
+        retries (int, optional): Number of times to retry a failed request. Defaults to RETRIES.
+
+    Returns:
+        bytes: The body of the response
+    """
+    url = f"{BASEURL}/{service}"
+
+    for attempt in range(retries + 1):
+        try:
+            logger.debug(f"Requesting {url} for {obsid=}")
+            response = requests.get(url, params={"obsid": obsid}, timeout=timeout)
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as error:
+            if attempt == retries:
+                raise error
+            wait = 2 ** attempt
+            logger.debug(f"{error}. Retrying in {wait} s...")
+            time.sleep(wait)
+
+
+def cached_path(obsid, service="fits", ttl=DEFAULT_TTL, cache_dir=CACHE_DIR, offline=False):
+    """Path to the locally cached response of a metadata service, fetching it
+    first if it is missing or older than `ttl`
+
+    If the response is stale but cannot be fetched again (e.g. on a node with no
+    network access), the stale copy is used instead.
+
+    Args:
+        obsid (int): Observation ID of interest
+        service (str, optional): Metaservice to call upon. Defaults to "fits".
+        ttl (float, optional): Maximum age of a cached response in seconds, or None to never refetch. Defaults to DEFAULT_TTL.
+        cache_dir (str, optional): Root directory of the cache. Defaults to CACHE_DIR.
+        offline (bool, optional): Never contact the metadata service. Defaults to False.
+
+    Returns:
+        str: Path to the cached response
+    """
+    index_path = _index_path(obsid, service, cache_dir=cache_dir)
+
+    entry = None
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            entry = json.load(f)
+
+        fresh = ttl is None or time.time() - entry["fetched"] < ttl
+        if fresh or offline:
+            return _object_path(entry["sha256"], cache_dir=cache_dir)
+    elif offline:
+        raise FileNotFoundError(f"No cached '{service}' metadata for {obsid=} in {cache_dir}")
+
+    try:
+        content = download(obsid, service=service)
+    except requests.RequestException as error:
+        if entry is None:
+            raise error
+        logger.warning(f"Could not refresh '{service}' metadata for {obsid=} ({error}). Using the cached copy.")
+        return _object_path(entry["sha256"], cache_dir=cache_dir)
+
+    digest = hashlib.sha256(content).hexdigest()
+    object_path = _object_path(digest, cache_dir=cache_dir)
+    if not os.path.exists(object_path):
+        _atomic_write(object_path, content)
+
+    entry = {"obsid": int(obsid), "service": service, "sha256": digest, "fetched": time.time()}
+    _atomic_write(index_path, json.dumps(entry).encode("utf-8"))
+
+    return object_path
+
+
+def get_json(obsid, service="obs", **kwargs):
+    """The (cached) JSON response of a metadata service
+
+    Args:
+        obsid (int): Observation ID of interest
+        service (str, optional): Metaservice to call upon. Defaults to "obs".
+
+    Returns:
+        dict: The decoded JSON response
+    """
+    with open(cached_path(obsid, service=service, **kwargs), "r") as f:
+        return json.load(f)
+
+
+def get_metafits(obsid, **kwargs):
+    """Path to the (cached) metafits file of an observation
+
+    Args:
+        obsid (int): Observation ID of interest
+
+    Returns:
+        str: Path to the metafits file
+    """
+    return cached_path(obsid, service="fits", **kwargs)
+
+
+@lru_cache(maxsize=256)
+def _read_header(path, mtime, size, ext):
+    with fits.open(path) as hdus:
+        return hdus[ext].header.copy()
+
+
+def read_header(path, ext=0):
+    """A parsed FITS header, which is only read from disk once per process for
+    as long as the file is unchanged
+
+    Args:
+        path (str): Path to the FITS file
+        ext (int, optional): The HDU whose header is returned. Defaults to 0.
+
+    Returns:
+        astropy.io.fits.Header: A copy of the header, which may be freely modified
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    return _read_header(path, stat.st_mtime_ns, stat.st_size, ext).copy()
+
+
+def prefetch(obsids, services=SERVICES, ttl=DEFAULT_TTL, cache_dir=CACHE_DIR):
+    """Warm the cache for a set of observations
+
+    Args:
+        obsids (Iterable[int]): Observation IDs to fetch
+        services (Iterable[str], optional): Metaservices to fetch. Defaults to SERVICES.
+        ttl (float, optional): Responses younger than this (in seconds) are not fetched again. Defaults to DEFAULT_TTL.
+        cache_dir (str, optional): Root directory of the cache. Defaults to CACHE_DIR.
+
+    Returns:
+        list[tuple[int, str]]: The (obsid, service) pairs that could not be fetched
+    """
+    failed = []
+    for obsid in obsids:
+        for service in services:
+            try:
+                cached_path(obsid, service=service, ttl=ttl, cache_dir=cache_dir)
+            except requests.RequestException as error:
+                logger.error(f"Failed to fetch '{service}' metadata for {obsid=}: {error}")
+                failed.append((obsid, service))
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Manage the local cache of MWA metadata service responses")
+    subparsers = parser.add_subparsers(dest="mode")
+
+    prefetch_parser = subparsers.add_parser(
+        "prefetch", help="Fetch the metadata for a set of obsids into the cache"
+    )
+    prefetch_parser.add_argument("obsids", type=str, help="Path to new-line delimited set of obsids")
+    prefetch_parser.add_argument(
+        "--services", nargs="+", default=list(SERVICES), choices=SERVICES, help=f"Metadata services to fetch (default = {SERVICES})"
+    )
+    prefetch_parser.add_argument(
+        "--ttl", type=float, default=DEFAULT_TTL, help=f"Refetch responses older than this many seconds (default = {DEFAULT_TTL})"
+    )
+
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Enable debug logging")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    if args.mode == "prefetch":
+        obsids = [int(o) for o in np.loadtxt(args.obsids, ndmin=1)]
+        failed = prefetch(obsids, services=args.services, ttl=args.ttl)
+        logger.info(f"Cached metadata for {len(obsids)} obsids in {CACHE_DIR} ({len(failed)} failures)")
+
+    else:
+        print(f"Directive mode {args.mode} not present. ")
@@ -12,13 +12,15 @@ from argparse import ArgumentParser
 from astropy.coordinates import SkyCoord
 from astropy.stats.circstats import circmean
 
+from gpm.db import observation_catalogue as obscat
+from gpm.db.observation_catalogue import GALACTIC_PLANE_LIMITS
+
 try:
     from gpm.db import mysql_db as gpmdb
 except:
     gpmdb = None
 
 CHECK_MODES = ["gpu", "vis", "folder"]
-GALACTIC_PLANE_LIMITS = [-10, 10, 90, 270]
 
 
 def clean_obsids(obsids):
@@ -165,18 +167,9 @@ def mask_gp(path):
     obsids = read_obsids_file(path)
 
     df = obsids_from_db(obsids)
-    sky = SkyCoord(df["ra_pointing"], df["dec_pointing"], unit=(u.deg, u.deg))
-
-    l = sky.galactic.l.deg
-    b = sky.galactic.b.deg
-
-    mask = (
-        (b >= GALACTIC_PLANE_LIMITS[0])
-        & (b <= GALACTIC_PLANE_LIMITS[1])
-        & ((l <= GALACTIC_PLANE_LIMITS[2]) | (l >= GALACTIC_PLANE_LIMITS[3]))
-    )
+    l, b = obscat.galactic_coords(df["ra_pointing"], df["dec_pointing"])
 
-    df = df[~mask]
+    df = df[~obscat.galactic_mask(l, b)]
 
     obsids = clean_obsids(df["obs_id"])
 
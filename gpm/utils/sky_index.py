@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""A spatial index of a sky-model catalogue (e.g. the GGSM) for fast cone searches.
+
+The columns needed to write model components are copied from the catalogue into
+a sidecar file next to it ([catalogue].index.npz), which is rebuilt whenever the
+catalogue changes. Positions are held as unit vectors in a KD-tree, so that the
+components around many positions are found at once without computing the
+separation to every row of the catalogue, e.g.
+
+    sky_index.py $GPMBASE/models/GGSM.fits
+"""
+
+import os
+import logging
+from argparse import ArgumentParser
+from functools import lru_cache
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(module)s:%(lineno)d:%(levelname)s %(message)s")
+logger.setLevel(logging.INFO)
+
+SIDECAR_SUFFIX = ".index.npz"
+# Columns of the GGSM used when writing model components
+GGSM_COLUMNS = ("Name", "RAJ2000", "DEJ2000", "a", "b", "pa", "S_200", "alpha", "beta")
+
+
+def radec_to_xyz(ra, dec):
+    """Unit vectors towards positions given in degrees, of shape (n, 3)"""
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)), axis=-1)
+
+
+def format_ra(ra, precision=4):
+    """Vectorised sexagesimal formatting of RAs in the style of Angle.to_string(u.hour), e.g. 23h23m24.0000s
+
+    Args:
+        ra (np.ndarray): RAs in degrees
+        precision (int, optional): Number of decimal places of the seconds. Defaults to 4.
+
+    Returns:
+        np.ndarray: The formatted RAs
+    """
+    scale = 10 ** precision
+    # Round once, in integer units of the last decimal place, so that seconds never round up to 60
+    total = np.round(np.mod(np.asarray(ra, dtype=np.float64), 360.0) / 15.0 * 3600 * scale).astype(np.int64)
+    total %= 24 * 3600 * scale
+    h, rem = np.divmod(total, 3600 * scale)
+    m, rem = np.divmod(rem, 60 * scale)
+    s, frac = np.divmod(rem, scale)
+
+    out = np.char.add(np.char.mod("%d", h), "h")
+    out = np.char.add(out, np.char.mod("%02dm", m))
+    out = np.char.add(out, np.char.mod("%02d", s))
+    if precision > 0:
+        out = np.char.add(out, np.char.mod(f".%0{precision}d", frac))
+    return np.char.add(out, "s")
+
+
+def format_dec(dec, precision=3):
+    """Vectorised sexagesimal formatting of declinations in the style of Angle.to_string(u.deg), e.g. -45d46m43.853s
+
+    Args:
+        dec (np.ndarray): Declinations in degrees
+        precision (int, optional): Number of decimal places of the seconds. Defaults to 3.
+
+    Returns:
+        np.ndarray: The formatted declinations
+    """
+    scale = 10 ** precision
+    dec = np.asarray(dec, dtype=np.float64)
+    total = np.round(np.abs(dec) * 3600 * scale).astype(np.int64)
+    d, rem = np.divmod(total, 3600 * scale)
+    m, rem = np.divmod(rem, 60 * scale)
+    s, frac = np.divmod(rem, scale)
+
+    out = np.char.add(np.where((dec < 0) & (total > 0), "-", ""), np.char.mod("%d", d))
+    out = np.char.add(out, "d")
+    out = np.char.add(out, np.char.mod("%02dm", m))
+    out = np.char.add(out, np.char.mod("%02d", s))
+    if precision > 0:
+        out = np.char.add(out, np.char.mod(f".%0{precision}d", frac))
+    return np.char.add(out, "s")
+
+
+def format_sexagesimal(value, sep=":"):
+    """Vectorised sexagesimal formatting in the style of Angle.to_string(sep=sep) with the
+    default precision, i.e. up to 8 decimal places of seconds with trailing zeros removed,
+    e.g. 0:40:29.62962936 or -20:00:00
+
+    Args:
+        value (np.ndarray): Angles in the unit to be formatted (e.g. Angle.hourangle or Angle.degree)
+        sep (str, optional): Separator of the fields. Defaults to ":".
+
+    Returns:
+        np.ndarray: The formatted angles
+    """
+    value = np.asarray(value, dtype=np.float64)
+    sign = np.copysign(1.0, value)
+    # Split into fields exactly as astropy does, so that the strings are identical
+    d_frac, d = np.modf(np.fabs(value))
+    m_frac, m = np.modf(d_frac * 60.0)
+    s = m_frac * 60.0
+
+    carry = np.round(s, 8) >= 60.0
+    s = np.where(carry, 0.0, s)
+    m = m + carry
+    carry = m >= 60.0
+    m = np.where(carry, 0.0, m)
+    d = d + carry
+
+    sec = np.char.rstrip(np.char.rstrip(np.char.mod("%.8f", s), "0"), ".")
+    sec = np.where((np.char.str_len(sec) == 1) | (np.char.find(sec, ".") == 1), np.char.add("0", sec), sec)
+
+    out = np.char.add(np.char.mod("%.0f", np.copysign(d, sign)), sep)
+    out = np.char.add(out, np.char.mod("%02d", m.astype(np.int64)))
+    out = np.char.add(out, sep)
+    return np.char.add(out, sec)
+
+
+class SkyIndex:
+    """Cone searches over the rows of a catalogue
+
+    Args:
+        columns (dict[str, np.ndarray]): Catalogue columns, which must include RAJ2000 and DEJ2000 (deg)
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.tree = cKDTree(radec_to_xyz(columns["RAJ2000"], columns["DEJ2000"]))
+
+    def __len__(self):
+        return len(self.columns["RAJ2000"])
+
+    @classmethod
+    def from_catalogue(cls, catalogue, columns=GGSM_COLUMNS):
+        """Build the index by reading a catalogue"""
+        logger.info(f"Reading {catalogue}")
+        tab = Table.read(catalogue)
+        return cls({c: np.asarray(tab[c]) for c in columns})
+
+    @classmethod
+    def load(cls, catalogue, columns=GGSM_COLUMNS, rebuild=False):
+        """Load the index of a catalogue from its sidecar file, (re)building the
+        sidecar first if it is missing, out of date or lacks any of `columns`
+
+        Args:
+            catalogue (str): Path to the catalogue
+            columns (tuple[str], optional): Columns to keep. Defaults to GGSM_COLUMNS.
+            rebuild (bool, optional): Always rebuild the sidecar. Defaults to False.
+
+        Returns:
+            SkyIndex: The index
+        """
+        sidecar = f"{catalogue}{SIDECAR_SUFFIX}"
+        stat = os.stat(catalogue)
+
+        if not rebuild and os.path.exists(sidecar):
+            with np.load(sidecar) as f:
+                current = (
+                    int(f["_mtime_ns"]) == stat.st_mtime_ns
+                    and int(f["_size"]) == stat.st_size
+                    and all(c in f.files for c in columns)
+                )
+                if current:
+                    logger.debug(f"Using index {sidecar}")
+                    return cls({c: f[c] for c in columns})
+
+        index = cls.from_catalogue(catalogue, columns=columns)
+        index.save(sidecar, stat)
+        return index
+
+    def save(self, sidecar, stat):
+        """Write the index columns to a sidecar file, recording the catalogue's
+        modification time and size so that stale sidecars can be detected"""
+        # np.savez appends .npz to names without it
+        tmp_path = f"{sidecar}.{os.getpid()}.tmp.npz"
+        try:
+            np.savez(tmp_path, _mtime_ns=stat.st_mtime_ns, _size=stat.st_size, **self.columns)
+            os.replace(tmp_path, sidecar)
+            logger.info(f"Wrote index of {len(self)} rows to {sidecar}")
+        except OSError as e:
+            logger.warning(f"Could not write index {sidecar} ({e})")
+
+    @u.quantity_input(radius=u.deg)
+    def query(self, ra, dec, radius):
+        """Rows within `radius` of each of many positions
+
+        Args:
+            ra (np.ndarray): RAs of the search positions (deg)
+            dec (np.ndarray): Declinations of the search positions (deg)
+            radius (astropy.units.Quantity): Search radius
+
+        Returns:
+            list[np.ndarray]: Sorted row indices within the radius of each position
+        """
+        # Distance between unit vectors subtending the search radius
+        chord = 2 * np.sin(radius.to_value(u.rad) / 2)
+        matches = self.tree.query_ball_point(radec_to_xyz(np.atleast_1d(ra), np.atleast_1d(dec)), r=chord)
+        return [np.array(sorted(m), dtype=int) for m in matches]
+
+    def table(self, idx):
+        """The catalogue rows at the given indices"""
+        return Table({c: v[idx] for c, v in self.columns.items()})
+
+
+@lru_cache(maxsize=4)
+def load_index(catalogue, columns=GGSM_COLUMNS):
+    """SkyIndex.load(), shared by all callers in this process"""
+    return SkyIndex.load(catalogue, columns=columns)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build the spatial index sidecar of a sky-model catalogue")
+    parser.add_argument("catalogue", type=str, help="Path to the catalogue (e.g. GGSM.fits)")
+    parser.add_argument("--columns", nargs="+", default=list(GGSM_COLUMNS), help=f"Columns to copy into the index (default = {GGSM_COLUMNS})")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Enable debug logging")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    index = SkyIndex.load(args.catalogue, columns=tuple(args.columns), rebuild=True)
@@ -9,6 +9,7 @@ import json
 import logging
 import argparse
 import datetime
+from multiprocessing.pool import ThreadPool
 from astropy.time import Time
 import astropy.units as u
 
@@ -26,6 +27,8 @@ BASEURL = "http://ws.mwatelescope.org/metadata"
 # This is the list of acceptable observation status' that are 'hard coded' in the
 # gleam-x website data/ui models.
 OBS_STATUS = ("unprocessed", "checking" ,"downloaded", "calibrated", "imaged", "archived")
+# Number of concurrent requests to the metadata service when importing many observations
+META_THREADS = 4
 DIRECTIVES = (
     "create_job",
     "create_jobs",
@@ -39,6 +42,7 @@ DIRECTIVES = (
     "set_epoch_cal",
     "iono_update",
     "import_obs",
+    "import_obs_list",
     "check_obs",
     "update_apply_cal",
     "obs_flagantennae",
@@ -105,13 +109,70 @@ def getmeta(service="obs", params=None, level=0):
         if level <= 2:
             logger.debug("HTTP encountered. Retrying...")
             time.sleep(3)
-            getmeta(service=service, params=params, level=level + 1)
+            return getmeta(service=service, params=params, level=level + 1)
         else:
             raise error
 
     return response.json()
 
 
+OBSERVATION_INSERT = """
+    INSERT INTO observation
+    (obs_id, projectid,  lst_deg, starttime, duration_sec, obsname, creator,
+    azimuth_pointing, elevation_pointing, ra_pointing, dec_pointing,
+    cenchan, freq_res, int_time, delays,
+    calibration, cal_obs_id, calibrators,
+    peelsrcs, flags, selfcal, ion_phs_med, ion_phs_peak, ion_phs_std,
+    nfiles, archived, status
+    )
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
+    """
+
+
+def observation_row(obs_id, meta):
+    """The values of a new row of the observation table, from the metadata of an observation
+
+    Args:
+        obs_id (int): observation id
+        meta (dict): metadata, as returned by getmeta(service="obs", ...)
+
+    Returns:
+        tuple: values in the order of the columns of OBSERVATION_INSERT
+    """
+    metadata = meta["metadata"]
+    logger.debug(f"Returned {metadata=}")
+
+    return (
+        obs_id,
+        meta["projectid"],
+        metadata["local_sidereal_time_deg"],
+        meta["starttime"],
+        meta["stoptime"] - meta["starttime"],
+        meta["obsname"],
+        meta["creator"],
+        metadata["azimuth_pointing"],
+        metadata["elevation_pointing"],
+        metadata["ra_pointing"],
+        metadata["dec_pointing"],
+        meta["rfstreams"]["0"]["frequencies"][12],
+        meta["freq_res"],
+        meta["int_time"],
+        json.dumps(meta["rfstreams"]["0"]["xdelays"]),
+        metadata["calibration"],
+        None,
+        metadata["calibrators"],
+        None,
+        None,
+        None,
+        None,
+        None,
+        None,
+        len(meta["files"]),
+        False,
+        "unprocessed",
+    )
+
+
 def copy_obs_info(obs_id):
 
     conn = gpmdb_connect()
@@ -133,51 +194,7 @@ def copy_obs_info(obs_id):
 
         return
 
-    metadata = meta["metadata"]
-    logger.debug(f"Returned {metadata=}")
-
-    cur.execute(
-    """
-    INSERT INTO observation
-    (obs_id, projectid,  lst_deg, starttime, duration_sec, obsname, creator,
-    azimuth_pointing, elevation_pointing, ra_pointing, dec_pointing,
-    cenchan, freq_res, int_time, delays,
-    calibration, cal_obs_id, calibrators,
-    peelsrcs, flags, selfcal, ion_phs_med, ion_phs_peak, ion_phs_std,
-    nfiles, archived, status
-    )
-    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s);
-    """,
-        (
-            obs_id,
-            meta["projectid"],
-            metadata["local_sidereal_time_deg"],
-            meta["starttime"],
-            meta["stoptime"] - meta["starttime"],
-            meta["obsname"],
-            meta["creator"],
-            metadata["azimuth_pointing"],
-            metadata["elevation_pointing"],
-            metadata["ra_pointing"],
-            metadata["dec_pointing"],
-            meta["rfstreams"]["0"]["frequencies"][12],
-            meta["freq_res"],
-            meta["int_time"],
-            json.dumps(meta["rfstreams"]["0"]["xdelays"]),
-            metadata["calibration"],
-            None,
-            metadata["calibrators"],
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            len(meta["files"]),
-            False,
-            "unprocessed",
-        ),
-    )
+    cur.execute(OBSERVATION_INSERT, observation_row(obs_id, meta))
 
     logger.info(f"Inserted {obs_id=} meta-data")
 
@@ -187,6 +204,85 @@ def copy_obs_info(obs_id):
     return
 
 
+def _obs_row(obs_id):
+    """observation_row() of an obs_id, or None if its metadata could not be retrieved"""
+    try:
+        meta = getmeta(service="obs", params={"obs_id": obs_id})
+        if meta is None:
+            logger.error(f"{obs_id=} has no metadata!")
+            return None
+        return observation_row(obs_id, meta)
+    except Exception as e:
+        logger.error(f"Could not retrieve the metadata of {obs_id=}: {e}")
+        return None
+
+
+def copy_obs_infos(obs_ids, nthreads=META_THREADS):
+    """Import many observations into the observation table, using a single
+    database connection and inserting all of them in one transaction.
+    Observations that are already imported are skipped, and the metadata of
+    the rest are retrieved concurrently.
+
+    Args:
+        obs_ids (Iterable[int]): observation ids to import
+        nthreads (int, optional): number of concurrent metadata requests. Defaults to META_THREADS.
+
+    Returns:
+        List[int]: the obs_ids that were inserted
+    """
+    # Preserve the order, but drop any repeats
+    obs_ids = list(dict.fromkeys(int(o) for o in obs_ids))
+    if len(obs_ids) == 0:
+        logger.info("No observations to import")
+        return []
+
+    conn = gpmdb_connect()
+    cur = conn.cursor()
+
+    format_string = ','.join(['%s'] * len(obs_ids)) # = '%s,%s,%s,...'
+    cur.execute(f"SELECT obs_id FROM observation WHERE obs_id IN ({format_string})", tuple(obs_ids))
+    imported = {int(row[0]) for row in cur.fetchall()}
+    if len(imported) > 0:
+        logger.info(f"{len(imported)} of {len(obs_ids)} observations are already imported")
+
+    new_obs_ids = [o for o in obs_ids if o not in imported]
+
+    with ThreadPool(max(1, min(nthreads, len(new_obs_ids)))) as pool:
+        rows = pool.map(_obs_row, new_obs_ids)
+    rows = [row for row in rows if row is not None]
+
+    try:
+        if len(rows) > 0:
+            cur.executemany(OBSERVATION_INSERT, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+
+    conn.close()
+
+    inserted = [row[0] for row in rows]
+    for obs_id in inserted:
+        logger.info(f"Inserted {obs_id=} meta-data")
+    logger.info(f"Imported {len(inserted)} new observations")
+
+    return inserted
+
+
+def read_obs_ids(obs_file):
+    """Read obs_ids, one per line (or whitespace separated), from a file, or from stdin if obs_file is '-'"""
+    try:
+        if obs_file == "-":
+            tokens = sys.stdin.read().split()
+        else:
+            with open(obs_file) as f:
+                tokens = f.read().split()
+        return [int(o) for o in tokens]
+    except Exception:
+        raise ValueError(f"Could not load obsids from '{obs_file}'")
+
+
 def check_imported_obs_id(obs_id):
 
     conn = gpmdb_connect()
@@ -447,6 +543,39 @@ def check_observation_status(obs_id):
     return res[0][0]
 
 
+def check_observation_statuses(obs_ids):
+    """Retrieve the recorded status of many observations with a single query
+
+    Args:
+        obs_ids (Iterable[int]): observation ids whose statuses are to be retrieved
+
+    Returns:
+        Dict[int, str]: mapping of each obs_id to its status, or 'notimported' if it is not in the observation table
+    """
+    obs_ids = tuple(int(o) for o in obs_ids)
+    if len(obs_ids) == 0:
+        return {}
+
+    format_string = ','.join(['%s'] * len(obs_ids)) # = '%s,%s,%s,...'
+
+    conn = gpmdb_connect()
+    cur = conn.cursor()
+    cur.execute(f"""
+                SELECT obs_id, status
+                FROM observation
+                WHERE obs_id IN ({format_string})
+                """,
+                obs_ids,
+    )
+    res = cur.fetchall()
+    conn.close()
+
+    statuses = {obs_id: 'notimported' for obs_id in obs_ids}
+    statuses.update({int(row[0]): row[1] for row in res})
+
+    return statuses
+
+
 def observation_epoch(obs_id):
     """Retrieves the epoch for a given observation
 
@@ -994,7 +1123,7 @@ if __name__ == "__main__":
     ps.add_argument("--batch_file", type=str, help="batch file name", default=None)
     obs_group = ps.add_mutually_exclusive_group()
     obs_group.add_argument("--obs_id", type=int, nargs='*', help="observation id", default=None)
-    obs_group.add_argument("--obs_file", type=str, help="File containing Observation IDs", default=None)
+    obs_group.add_argument("--obs_file", type=str, help="File containing Observation IDs (\"-\" to read them from stdin, for import_obs_list)", default=None)
     ps.add_argument(
         "--cal_id", type=int, help="observation id of calibration data", default=None
     )
@@ -1137,7 +1266,18 @@ if __name__ == "__main__":
 
     elif args.directive.lower() == "import_obs":
         require(args, ["obs_id"])
-        copy_obs_info(args.obs_id)
+        if isinstance(args.obs_id, list):
+            copy_obs_infos(args.obs_id)
+        else:
+            copy_obs_info(args.obs_id)
+
+    elif args.directive.lower() == "import_obs_list":
+        require(args, ["obs"])
+        if args.obs_file is not None:
+            obs_ids = read_obs_ids(args.obs_file)
+        else:
+            obs_ids = np.atleast_1d(args.obs_id)
+        copy_obs_infos(obs_ids)
 
     elif args.directive.lower() == "check_obs":
         require(args, ["obs_id"])